@@ -0,0 +1,190 @@
+"""Backfill the Operator KBs from the steps.json logs of earlier runs.
+
+run_single_task leaves logs/<model>/mobile_agent_rag/<run>/<task>/steps.json plus the screenshot of
+every step. This script walks one or more log trees, streams each steps.json with a bounded-memory
+reader (src.json_stream) and extracts the (subtask, action, screenshot) of every action the action
+reflector judged successful (outcome "A"). Records are de-duplicated on (App, subtask, action), also
+against the passages already in the KBs, and appended to the KB of their app in chunks, in the format
+the Operator server writes. The indexes are then built once for all apps with one model load: one run
+of generate_embedding.sh for the TSV KBs, or one in-process sync per retriever for the sqlite KB.
+
+The KB layout and backend follow the server (OPERATOR_KB_LAYOUT, OPERATOR_KB_BACKEND). Run it while
+the Operator server is stopped, from the directory the server runs in.
+
+    python backfill_operator_kb.py logs/ --dry_run
+    python backfill_operator_kb.py logs/gpt-4o/mobile_agent_rag logs/gemini/mobile_agent_rag
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import time
+from collections import Counter
+
+import passage_retrieval_operator_server as server
+from passage_retrieval_operator_client import format_action_text
+from src.json_stream import iter_json_array
+
+STEPS_FILE = "steps.json"
+
+
+def find_step_logs(roots):
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            if STEPS_FILE in filenames:
+                yield os.path.join(dirpath, STEPS_FILE)
+
+
+def resolve_screenshot(log_dir, path, step):
+    # the logged path is relative to the directory the agent ran in; fall back to the log's own copy
+    if path and os.path.exists(path):
+        return path
+    name = os.path.basename(path) if path else f"{step}.jpg"
+    path = os.path.join(log_dir, "screenshots", name)
+    return path if os.path.exists(path) else None
+
+
+def iter_successful_steps(steps_path, stats):
+    """Yield (subtask, action_object, screenshot path) of the actions of one run whose reflection
+    outcome was A, reading the log one entry at a time."""
+    log_dir = os.path.dirname(steps_path)
+    screenshots = {}  # step -> screenshot taken before its action
+    subtask = None
+    action = None  # (step, subtask, action_object) waiting for its reflection
+    for entry in iter_json_array(steps_path):
+        if not isinstance(entry, dict):
+            continue
+        operation, step = entry.get("operation"), entry.get("step")
+        if operation == "perception":
+            screenshots[step] = entry.get("screenshot")
+            for old in [s for s in screenshots if isinstance(s, int) and isinstance(step, int) and s < step - 1]:
+                del screenshots[old]
+        elif operation == "planning":
+            subtask = entry.get("current_subtask")
+        elif operation == "action":
+            action = (step, subtask, entry.get("action_object"))
+        elif operation == "action_reflection":
+            if action is None or action[0] != step:
+                continue
+            stats["actions"] += 1
+            # same precedence as the agent: "A" anywhere in the outcome means success
+            if "A" not in str(entry.get("outcome", "")):
+                action = None
+                continue
+            _, action_subtask, action_object = action
+            action = None
+            screenshot = resolve_screenshot(log_dir, screenshots.get(step), step)
+            if not action_subtask or not isinstance(action_object, dict) or screenshot is None:
+                stats["incomplete"] += 1
+                continue
+            yield action_subtask, action_object, screenshot
+
+
+def record_key(app_name, instruction, action_text):
+    return hashlib.blake2b(f"{app_name}\x00{instruction}\x00{action_text}".encode("utf-8"), digest_size=8).digest()
+
+
+def passage_key(app_name, passage):
+    # inverse of make_passage: title "subtask: <instruction>", text "Action: <action_text>. Image: <path>"
+    title, text = passage.get("title", ""), passage.get("text", "")
+    if not title.startswith("subtask: ") or not text.startswith("Action: ") or ". Image:" not in text:
+        return None
+    return record_key(app_name, title[len("subtask: "):], text[len("Action: "):text.rfind(". Image:")])
+
+
+def existing_keys(app_name):
+    # keys of the passages already in the app's KB, so a second backfill of the same logs adds nothing
+    keys = set()
+    if server.kb is not None:
+        after_id = 0
+        while True:
+            changes = server.kb.changes(after_id, app_name)
+            if not changes:
+                break
+            keys.update(passage_key(app_name, p) for _, p in changes)
+            after_id = int(changes[-1][1]["id"])
+    else:
+        tsv_path = os.path.join(server.BASE_IMG_DIR, app_name, "passage.tsv")  # get_app_paths would create the app
+        if os.path.exists(tsv_path):
+            with open(tsv_path, encoding="utf-8") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) >= 3:
+                        keys.add(passage_key(app_name, {"text": fields[1], "title": fields[2]}))
+    keys.discard(None)
+    return keys
+
+
+def build_indexes(app_names):
+    if server.kb is None:
+        # one embedding run for all apps; the existing passages come from the embedding caches
+        server.update_app_embeddings(app_names)
+        return
+    saved = set()
+    for app_name in app_names:
+        retriever = server.load_app_kb(app_name)
+        if id(retriever) not in saved and server.args.save_or_load_index:
+            retriever.save_index()
+            saved.add(id(retriever))
+
+
+def main(args):
+    start = time.time()
+    stats = Counter()
+    seen = {}  # app -> record keys in its KB or pending
+    pending = []
+    app_names = set()
+
+    def flush():
+        if pending and not args.dry_run:
+            server.write_passage_records(pending)
+        stats["appended"] += len(pending)
+        pending.clear()
+
+    for steps_path in find_step_logs(args.log_dirs):
+        stats["logs"] += 1
+        for subtask, action_object, screenshot in iter_successful_steps(steps_path, stats):
+            instruction = re.sub(r'^\s*\d+\.\s*', '', subtask)
+            app_name = server.extract_app_name(instruction)
+            if not app_name:
+                stats["no_app"] += 1
+                continue
+            if app_name not in seen:
+                if not args.dry_run:
+                    server.init_app_kb(app_name)
+                seen[app_name] = existing_keys(app_name)
+            action_text = format_action_text(action_object)
+            key = record_key(app_name, instruction, action_text)
+            if key in seen[app_name]:
+                stats["duplicates"] += 1
+                continue
+            seen[app_name].add(key)
+            app_names.add(app_name)
+            pending.append((app_name, instruction, action_text, screenshot))
+            if len(pending) >= args.chunk_size:
+                flush()
+        if stats["logs"] % 100 == 0:
+            print(f"{stats['logs']} logs, {stats['appended'] + len(pending)} new passages")
+    flush()
+
+    print(
+        f"{stats['logs']} logs, {stats['actions']} actions: {stats['appended']} new passages for "
+        f"{len(app_names)} apps, {stats['duplicates']} duplicates, {stats['no_app']} without App field, "
+        f"{stats['incomplete']} without subtask or screenshot ({time.time() - start:.1f} s)"
+    )
+    if args.dry_run or not app_names or args.no_index:
+        return
+    start = time.time()
+    build_indexes(sorted(app_names))
+    print(f"Indexed {len(app_names)} apps in {time.time() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log_dirs", nargs="+", help="Directories searched recursively for steps.json run logs")
+    parser.add_argument("--chunk_size", type=int, default=1000, help="Records written to the KBs at a time")
+    parser.add_argument("--dry_run", action="store_true", help="Only count the records that would be added")
+    parser.add_argument("--no_index", action="store_true", help="Append to the KBs but leave indexing to the server")
+    main(parser.parse_args())
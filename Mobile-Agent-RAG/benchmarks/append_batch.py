@@ -0,0 +1,94 @@
+"""Ingestion rate of the Operator KB: one /append_tsv request per record versus /append_batch.
+
+The Operator server runs in-process under uvicorn on a local port, on a synthetic app KB, with
+Contriever replaced by the CPU stand-in from benchmarks.standin. Each /append_tsv request encodes and
+indexes its one record; an /append_batch request writes all its records at once, encodes them in one
+batched forward pass and adds them to the index once.
+
+    python -m benchmarks.append_batch --n_records 500 --batch_size 100
+"""
+
+import argparse
+import io
+import os
+import tempfile
+import time
+from unittest import mock
+
+from PIL import Image
+
+import src.contriever
+import passage_retrieval_operator_server as server
+from src.http_client import get_client
+from benchmarks.operator_retrieve_latency import write_app_kb, standin_embedding_job
+from benchmarks.retrieve_batch import free_port, start_server
+from benchmarks.standin import load_standin_retriever
+
+APP_NAME = "BenchApp"
+
+
+def screenshot_bytes():
+    out = io.BytesIO()
+    Image.new("RGB", (270, 600), (40, 90, 160)).save(out, format="PNG")
+    return out.getvalue()
+
+
+def records(n, offset):
+    return [(f"subtask: backfill step {offset + i} App: {APP_NAME}", f"Tap at {{\"x\": {i}, \"y\": {i}}}") for i in range(n)]
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as kb_dir, \
+            mock.patch.object(server, "BASE_IMG_DIR", kb_dir), \
+            mock.patch.object(server, "INDEX_CACHE_DIR", os.path.join(kb_dir, "index_cache")), \
+            mock.patch.object(server, "PASSAGE_STORE_DIR", os.path.join(kb_dir, "passage_store")), \
+            mock.patch.object(server, "shared_retriever", None), \
+            mock.patch.object(server, "encoder", None), \
+            mock.patch.object(server, "embedding_caches", {}), \
+            mock.patch.object(server.subprocess, "run", standin_embedding_job), \
+            mock.patch.object(src.contriever, "load_retriever", load_standin_retriever):
+        write_app_kb(APP_NAME, args.n_passages)
+        server.load_app_kb(APP_NAME)
+        url = f"http://127.0.0.1:{free_port()}"
+        uv = start_server(int(url.rsplit(":", 1)[1]))
+        client = get_client(url)
+        image = screenshot_bytes()
+
+        start = time.perf_counter()
+        for instruction, action_text in records(args.n_records, 0):
+            resp = client.post(
+                "/append_tsv",
+                data={"instruction": instruction, "action_text": action_text},
+                files={"screenshot": ("s.png", image, "image/png")},
+            )
+            resp.raise_for_status()
+        single_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch = records(args.n_records, args.n_records)
+        for i in range(0, len(batch), args.batch_size):
+            chunk = batch[i:i + args.batch_size]
+            resp = client.post(
+                "/append_batch",
+                data=[(key, value) for instruction, action_text in chunk
+                      for key, value in (("instruction", instruction), ("action_text", action_text))],
+                files=[("screenshot", ("s.png", image, "image/png")) for _ in chunk],
+                timeout=600,
+            )
+            resp.raise_for_status()
+        batch_s = time.perf_counter() - start
+        uv.should_exit = True
+
+        print(f"{args.n_records} records into a KB of {args.n_passages} passages")
+        print(f"{'endpoint':>13} {'requests':>9} {'wall s':>8} {'records/min':>12}")
+        print(f"{'/append_tsv':>13} {args.n_records:>9} {single_s:>8.2f} {60 * args.n_records / single_s:>12.0f}")
+        n_requests = -(-args.n_records // args.batch_size)
+        print(f"{'/append_batch':>13} {n_requests:>9} {batch_s:>8.2f} {60 * args.n_records / batch_s:>12.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_passages", type=int, default=2000, help="Number of passages in the synthetic app KB")
+    parser.add_argument("--n_records", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=100, help="Records per /append_batch request")
+    main(parser.parse_args())
@@ -0,0 +1,102 @@
+"""CPU query-encoding latency of Contriever in fp32, with int8 dynamic quantization and (with
+--onnx_model) under onnxruntime, and the retrieval quality lost to each, on the manager KB.
+
+The passages are embedded once with the fp32 encoder, as generate_passage_embeddings does; only the
+query encoder changes, as in the servers. Queries are the task instructions (passage titles)
+of the KB. For each encoder the benchmark reports single-query latency, recall@k of its results against
+the fp32 results, and hit@k of the passage the query was taken from.
+
+    python -m benchmarks.cpu_quantization --model_name_or_path facebook/contriever-msmarco --num_threads 4 \
+        --onnx_model contriever-msmarco-onnx
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import src.data
+from src.index import Indexer
+from generate_passage_embeddings import embed_passages
+from passage_retrieval_manager import Retriever
+
+
+def encoder_args(args, quantize_int8=False, onnx_model=None):
+    return argparse.Namespace(
+        model_name_or_path=args.model_name_or_path,
+        device="cpu",
+        num_threads=args.num_threads,
+        quantize_int8=quantize_int8,
+        onnx_model=onnx_model,
+        no_fp16=True,
+        per_gpu_batch_size=args.per_gpu_batch_size,
+        passage_maxlength=args.passage_maxlength,
+        question_maxlength=args.question_maxlength,
+        no_title=False,
+        lowercase=False,
+        normalize_text=False,
+    )
+
+
+def load_encoder(args, **backend):
+    enc_args = encoder_args(args, **backend)
+    retriever = Retriever(enc_args)
+    retriever.load_model()
+    return enc_args, retriever
+
+
+def time_queries(retriever, enc_args, queries, repeats):
+    latencies, embeddings = [], []
+    retriever.encode_queries(enc_args, queries[:1])  # warm-up
+    for _ in range(repeats):
+        embeddings = []
+        for query in queries:
+            start = time.perf_counter()
+            embeddings.append(retriever.encode_queries(enc_args, [query])[0])
+            latencies.append(time.perf_counter() - start)
+    return np.percentile(np.array(latencies) * 1000, [50, 99]), np.stack(embeddings)
+
+
+def main(args):
+    passages = src.data.load_passages(args.passages)
+    queries = [p["title"] for p in passages]
+
+    fp32_args, fp32 = load_encoder(args)
+    ids, passage_embeddings = embed_passages(fp32_args, passages, fp32.model, fp32.tokenizer)
+    index = Indexer(passage_embeddings.shape[1])
+    index.index_data(ids, passage_embeddings)
+
+    backends = [("fp32", None), ("int8", {"quantize_int8": True})]
+    if args.onnx_model:
+        backends.append(("onnx", {"onnx_model": args.onnx_model}))
+    results = {}
+    for name, backend in backends:
+        enc_args, retriever = (fp32_args, fp32) if backend is None else load_encoder(args, **backend)
+        latency, query_embeddings = time_queries(retriever, enc_args, queries, args.repeats)
+        top = index.search_knn(query_embeddings, args.k)
+        results[name] = (latency, query_embeddings, top)
+
+    _, fp32_embeddings, fp32_top = results["fp32"]
+    print(f"passages={len(passages)} queries={len(queries)} threads={torch.get_num_threads()}")
+    print(f"{'encoder':>8} {'p50 ms':>8} {'p99 ms':>8} {'recall@' + str(args.k) + ' vs fp32':>17} {'hit@' + str(args.k):>7} {'cos vs fp32':>12}")
+    for name, (latency, query_embeddings, top) in results.items():
+        overlap = np.mean([len(set(a) & set(b)) / len(b) for (a, _), (b, _) in zip(top, fp32_top)])
+        hits = np.mean([p["id"] in set(ids) for p, (ids, _) in zip(passages, top)])
+        cos = np.mean(np.sum(query_embeddings * fp32_embeddings, axis=1) / (
+            np.linalg.norm(query_embeddings, axis=1) * np.linalg.norm(fp32_embeddings, axis=1)))
+        print(f"{name:>8} {latency[0]:>8.2f} {latency[1]:>8.2f} {overlap:>17.3f} {hits:>7.3f} {cos:>12.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name_or_path", type=str, default="contriever-msmarco")
+    parser.add_argument("--passages", type=str, default="mobile_eval_rag_retrieve/manager/passage.tsv")
+    parser.add_argument("--onnx_model", type=str, default=None, help="Dir written by export_onnx.py, adds an onnxruntime row")
+    parser.add_argument("--num_threads", type=int, default=0, help="Intra-op threads, 0 keeps the torch default")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=5, help="Passes over the queries when timing")
+    parser.add_argument("--per_gpu_batch_size", type=int, default=64)
+    parser.add_argument("--passage_maxlength", type=int, default=512)
+    parser.add_argument("--question_maxlength", type=int, default=512)
+    main(parser.parse_args())
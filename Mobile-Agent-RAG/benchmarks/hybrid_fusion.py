@@ -0,0 +1,113 @@
+"""Recall of dense, BM25 and fused (rrf / weighted) retrieval on the manager KB, with queries from Mobile_Eval_RAG.
+
+The gold passage of a Mobile_Eval_RAG task is the manager KB passage whose task instruction (title)
+is the task's instruction. Querying with the instruction itself would be trivial, so the queries are
+built from the task's completion criteria, which name the app and the search terms the way a plan
+step does:
+
+    criteria:  all completion criteria of the task, joined
+    search:    the "Opened ..." and "Searched for ..." criteria only
+
+The benchmark reports hit@1, hit@3 and MRR@10 per retrieval mode, and the BM25 search time per query.
+
+    python -m benchmarks.hybrid_fusion --model_name_or_path facebook/contriever-msmarco
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+
+import src.data
+from src.bm25 import BM25Index
+from src.fusion import fuse
+from src.index import Indexer
+from generate_passage_embeddings import embed_passages, passage_text
+from passage_retrieval_manager import Retriever
+from benchmarks.standin import load_standin_retriever
+
+
+def load_tasks(eval_dir, passages):
+    gold = {p["title"].strip(): p["id"] for p in passages}
+    tasks = []
+    for path in sorted(glob.glob(os.path.join(eval_dir, "*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                task = json.loads(line)
+                if task["task_instruction"].strip() in gold:
+                    tasks.append((task, gold[task["task_instruction"].strip()]))
+    return tasks
+
+
+def task_queries(task, variant):
+    criteria = task["completion_criteria"]
+    if variant == "search":
+        criteria = [c for c in criteria if c.lower().startswith(("opened", "searched"))] or criteria
+    return ". ".join(criteria)
+
+
+def ranking_metrics(rankings, gold_ids, k=10):
+    hit1 = hit3 = mrr = 0.0
+    for (ids, _), gold in zip(rankings, gold_ids):
+        ids = list(ids)[:k]
+        if gold in ids:
+            rank = ids.index(gold)
+            hit1 += rank == 0
+            hit3 += rank < 3
+            mrr += 1 / (rank + 1)
+    n = len(gold_ids)
+    return hit1 / n, hit3 / n, mrr / n
+
+
+def main(args):
+    passages = src.data.load_passages(args.passages)
+    tasks = load_tasks(args.eval_dir, passages)
+    gold_ids = [gold for _, gold in tasks]
+
+    enc_args = argparse.Namespace(
+        model_name_or_path=args.model_name_or_path, device=args.device, num_threads=0, no_fp16=args.device == "cpu",
+        per_gpu_batch_size=64, passage_maxlength=512, question_maxlength=512,
+        no_title=False, lowercase=False, normalize_text=False,
+    )
+    retriever = Retriever(enc_args)
+    if args.model_name_or_path == "standin":
+        retriever.model, retriever.tokenizer, _ = load_standin_retriever()
+    else:
+        retriever.load_model()
+    ids, embeddings = embed_passages(enc_args, passages, retriever.model, retriever.tokenizer)
+    dense_index = Indexer(embeddings.shape[1])
+    dense_index.index_data(ids, embeddings)
+    sparse_index = BM25Index()
+    sparse_index.index_data(ids, [passage_text(enc_args, p) for p in passages])
+
+    print(f"passages={len(passages)} tasks with a gold passage={len(tasks)} alpha={args.alpha}")
+    print(f"{'queries':>9} {'mode':>9} {'hit@1':>7} {'hit@3':>7} {'MRR@10':>7}")
+    for variant in ("criteria", "search"):
+        queries = [task_queries(task, variant) for task, _ in tasks]
+        dense = dense_index.search_knn(retriever.encode_queries(enc_args, queries), args.candidates)
+        start = time.perf_counter()
+        sparse = sparse_index.search(queries, args.candidates)
+        sparse_ms = 1000 * (time.perf_counter() - start) / len(queries)
+        modes = {
+            "dense": dense,
+            "bm25": sparse,
+            "rrf": fuse(dense, sparse, "rrf", args.candidates, args.alpha, args.rrf_k),
+            "weighted": fuse(dense, sparse, "weighted", args.candidates, args.alpha),
+        }
+        for mode, rankings in modes.items():
+            hit1, hit3, mrr = ranking_metrics(rankings, gold_ids)
+            print(f"{variant:>9} {mode:>9} {hit1:>7.3f} {hit3:>7.3f} {mrr:>7.3f}")
+        print(f"{variant:>9} BM25 search {sparse_ms:.3f} ms/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name_or_path", type=str, default="contriever-msmarco", help="'standin' uses the CPU stand-in encoder")
+    parser.add_argument("--passages", type=str, default="mobile_eval_rag_retrieve/manager/passage.tsv")
+    parser.add_argument("--eval_dir", type=str, default="Mobile_Eval_RAG")
+    parser.add_argument("--device", type=str, default="auto")
+    parser.add_argument("--alpha", type=float, default=0.5, help="Weight of the dense ranking in the fusion")
+    parser.add_argument("--rrf_k", type=int, default=60)
+    parser.add_argument("--candidates", type=int, default=20, help="Candidates taken from each ranking before fusion")
+    main(parser.parse_args())
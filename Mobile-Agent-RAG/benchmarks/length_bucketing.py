@@ -0,0 +1,98 @@
+"""Passage-encoding cost with file-order batches (padded to the longest passage of each batch) versus
+length-bucketed batches, on an Operator-like KB.
+
+The synthetic KB mixes single actions with long subtask strings, like the Operator app KBs; pass
+--passages to use a real passage.tsv instead. The benchmark reports padded tokens per passage, which
+is what the encoder pays for, and wall time per passage.
+
+    python -m benchmarks.length_bucketing --model_name_or_path facebook/contriever-msmarco --device cpu
+"""
+
+import argparse
+import random
+import time
+
+import torch
+
+import src.contriever
+import src.data
+import src.device
+from src.bucketing import encode_length_bucketed
+from benchmarks.standin import load_standin_retriever
+
+
+def synthetic_operator_kb(n, rng):
+    passages = []
+    for i in range(n):
+        if rng.random() < 0.7:
+            subtask = "open app"
+            action = f"Tap at {{\"x\": {rng.randint(0, 1080)}, \"y\": {rng.randint(0, 2400)}}}"
+        else:
+            subtask = " ".join(rng.choice(["search", "for", "the", "latest", "news", "and", "summarize", "it", "in", "notes"]) for _ in range(rng.randint(40, 200)))
+            action = "Type {\"text\": \"" + " ".join("word" for _ in range(rng.randint(10, 60))) + "\"}"
+        passages.append({"id": str(i + 1), "title": f"subtask: {subtask}", "text": f"Action: {action}. Image: {i + 1}.png"})
+    return passages
+
+
+def encode_file_order(model, tokenizer, texts, batch_size, max_length, device):
+    # the batching embed_passages used before: consecutive passages, padded to the longest of the batch
+    embeddings, padded_tokens = [], 0
+    with torch.no_grad():
+        for start in range(0, len(texts), batch_size):
+            batch = tokenizer.batch_encode_plus(
+                texts[start:start + batch_size], return_tensors="pt", max_length=max_length, padding=True, truncation=True
+            )
+            padded_tokens += batch["input_ids"].numel()
+            embeddings.append(model(**src.device.to_device(batch, device)).cpu())
+    return torch.cat(embeddings), padded_tokens
+
+
+def bucketed_padded_tokens(tokenizer, texts, batch_size, max_length):
+    lengths = sorted(len(ids) for ids in tokenizer(texts, max_length=max_length, truncation=True)["input_ids"])
+    return sum(lengths[min(start + batch_size, len(lengths)) - 1] * len(lengths[start:start + batch_size])
+               for start in range(0, len(lengths), batch_size))
+
+
+def main(args):
+    if args.model_name_or_path == "standin":
+        model, tokenizer, _ = load_standin_retriever()
+    else:
+        model, tokenizer, _ = src.contriever.load_retriever(args.model_name_or_path)
+    device_args = argparse.Namespace(device=args.device, num_threads=args.num_threads, no_fp16=args.no_fp16)
+    model, device = src.device.setup_encoder(device_args, model)
+
+    if args.passages:
+        passages = src.data.load_passages(args.passages)
+    else:
+        passages = synthetic_operator_kb(args.n_passages, random.Random(args.seed))
+    texts = [p["title"] + " " + p["text"] for p in passages]
+
+    start = time.perf_counter()
+    file_order, file_order_tokens = encode_file_order(model, tokenizer, texts, args.batch_size, args.passage_maxlength, device)
+    file_order_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bucketed = encode_length_bucketed(model, tokenizer, texts, args.batch_size, args.passage_maxlength, device)
+    bucketed_time = time.perf_counter() - start
+    bucketed_tokens = bucketed_padded_tokens(tokenizer, texts, args.batch_size, args.passage_maxlength)
+
+    max_diff = (file_order.float() - bucketed.float()).abs().max().item()
+    n = len(texts)
+    print(f"passages={n} batch_size={args.batch_size} device={device} max |diff|={max_diff:.2e}")
+    print(f"{'batching':>10} {'tokens/passage':>15} {'ms/passage':>11}")
+    print(f"{'file order':>10} {file_order_tokens / n:>15.1f} {1000 * file_order_time / n:>11.2f}")
+    print(f"{'bucketed':>10} {bucketed_tokens / n:>15.1f} {1000 * bucketed_time / n:>11.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name_or_path", type=str, default="contriever-msmarco", help="'standin' uses the CPU stand-in encoder")
+    parser.add_argument("--passages", type=str, default=None, help="passage.tsv to encode instead of the synthetic KB")
+    parser.add_argument("--n_passages", type=int, default=2000)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--passage_maxlength", type=int, default=512)
+    parser.add_argument("--device", type=str, default="auto")
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--no_fp16", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
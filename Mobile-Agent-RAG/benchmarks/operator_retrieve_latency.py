@@ -0,0 +1,99 @@
+"""p50/p99 latency of the Operator /retrieve endpoint before and after serving from the retriever cache.
+
+"before" forces update_embedding=True on every call, which is what /retrieve did when every
+query re-embedded the app KB and rebuilt the retriever; "after" is the cached read path of the
+per_app and partitioned KB layouts. Contriever is replaced by the CPU stand-in from benchmarks.standin.
+
+    python -m benchmarks.operator_retrieve_latency --n_passages 2000 --n_queries 50
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+import src.contriever
+import src.data
+import src.embedding_shards
+import passage_retrieval_operator_server as server
+from generate_passage_embeddings import embed_passages
+from benchmarks.standin import load_standin_retriever
+
+APP_NAME = "BenchApp"
+
+
+def write_app_kb(app_name, n_passages):
+    paths = server.get_app_paths(app_name)
+    os.makedirs(paths["img_dir"], exist_ok=True)
+    Image.new("RGB", (8, 8)).save(os.path.join(paths["img_dir"], "1.png"))
+    with open(paths["tsv"], "w", encoding="utf-8") as f:
+        for i in range(1, n_passages + 1):
+            f.write(f"{i}\tAction: Tap at {{\"x\": {i % 1080}, \"y\": {i % 2400}}}. Image: {i}.png\tsubtask: step {i % 97} App: {app_name}\n")
+
+
+def standin_embedding_job(cmd, check=True, env=None):
+    # replaces `bash generate_embedding.sh <app> ...`: re-embed the whole passage.tsv of each app
+    model, tokenizer, _ = load_standin_retriever()
+    for app_name in cmd[2:]:
+        paths = server.get_app_paths(app_name)
+        passages = src.data.load_passages(paths["tsv"])
+        ids, embeddings = embed_passages(server.args, passages, model, tokenizer)
+        src.embedding_shards.write_shard(os.path.join(paths["embedding_dir"], "passages_00"), ids, embeddings, "standin")
+
+
+def time_retrieve(queries, n_docs):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        asyncio.run(server.retrieve_documents(server.QueryRequest(query=query, n_docs=n_docs)))
+        latencies.append(time.perf_counter() - start)
+    return np.percentile(np.array(latencies) * 1000, [50, 99])
+
+
+def main(args):
+    queries = [f"subtask: step {i % 97} App: {APP_NAME}" for i in range(args.n_queries)]
+    rebuild_every_call = server.get_or_create_retriever
+
+    with tempfile.TemporaryDirectory() as kb_dir, \
+            mock.patch.object(server, "BASE_IMG_DIR", kb_dir), \
+            mock.patch.object(server, "INDEX_CACHE_DIR", os.path.join(kb_dir, "index_cache")), \
+            mock.patch.object(server, "PASSAGE_STORE_DIR", os.path.join(kb_dir, "passage_store")), \
+            mock.patch.object(server, "retriever_cache", server.RetrieverCache(server.args.retriever_cache_max_bytes)), \
+            mock.patch.object(server, "shared_retriever", None), \
+            mock.patch.object(server, "encoder", None), \
+            mock.patch.object(server, "embedding_caches", {}), \
+            mock.patch.object(server.subprocess, "run", standin_embedding_job), \
+            mock.patch.object(src.contriever, "load_retriever", load_standin_retriever):
+        write_app_kb(APP_NAME, args.n_passages)
+
+        with mock.patch.object(server.args, "kb_layout", "per_app"):
+            with mock.patch.object(
+                server, "get_or_create_retriever",
+                lambda app_name, update_embedding=False: rebuild_every_call(app_name, update_embedding=True),
+            ):
+                before = time_retrieve(queries, args.n_docs)
+
+            server.load_app_kb(APP_NAME)  # warm the cache once
+            after = time_retrieve(queries, args.n_docs)
+
+        with mock.patch.object(server.args, "kb_layout", "partitioned"):
+            server.load_app_kb(APP_NAME)
+            after_partitioned = time_retrieve(queries, args.n_docs)
+
+    print(f"passages={args.n_passages} queries={args.n_queries}")
+    print(f"before (rebuild per query): p50={before[0]:.2f} ms p99={before[1]:.2f} ms")
+    print(f"after  (cached, per_app):   p50={after[0]:.2f} ms p99={after[1]:.2f} ms")
+    print(f"after  (cached, partitioned): p50={after_partitioned[0]:.2f} ms p99={after_partitioned[1]:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_passages", type=int, default=2000, help="Number of passages in the synthetic app KB")
+    parser.add_argument("--n_queries", type=int, default=50, help="Number of /retrieve calls per mode")
+    parser.add_argument("--n_docs", type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,97 @@
+"""Startup time and resident memory of the passages of a retriever: load_passages plus an id dict
+(as setup_retriever did) versus opening a PassageStore, and the cost of looking up top-k hits.
+
+Each variant runs in a fresh process so RSS is not shared between them. The synthetic KB is written
+once to --workdir; pass --passages to use a real passage file instead.
+
+    python -m benchmarks.passage_store --n_passages 1000000
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import time
+
+import src.data
+from src.passage_store import PassageStore, default_store_dir
+
+
+def write_synthetic_kb(path, n, seed):
+    rng = random.Random(seed)
+    words = ["open", "tap", "the", "search", "bar", "type", "news", "swipe", "up", "notes", "app", "home"]
+    with open(path, "w") as f:
+        for i in range(n):
+            text = " ".join(rng.choice(words) for _ in range(rng.randint(5, 60)))
+            f.write(f"{i + 1}\tAction: {text}. Image: {i + 1}.png\tsubtask: {text[:40]}\n")
+
+
+def rss_mb():
+    # anonymous (private) resident memory; the store's mapped pages are page cache the OS can reclaim
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("RssAnon:")) / 1024
+    except (OSError, StopIteration):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(variant, path, n_lookups, k, queue):
+    base = rss_mb()
+    start = time.perf_counter()
+    if variant == "dicts":
+        passages = src.data.load_passages(path)
+        id_map = {x["id"]: x for x in passages}
+    else:
+        id_map = PassageStore(path)
+    startup = time.perf_counter() - start
+
+    rng = random.Random(0)
+    ids = [str(rng.randint(1, len(id_map))) for _ in range(n_lookups * k)]
+    start = time.perf_counter()
+    for i in range(0, len(ids), k):
+        [id_map[x] for x in ids[i:i + k]]
+    lookup = (time.perf_counter() - start) / n_lookups
+    queue.put((variant, startup, lookup, rss_mb() - base))
+
+
+def measure(variant, path, args):
+    queue = multiprocessing.get_context("spawn").Queue()
+    process = multiprocessing.get_context("spawn").Process(target=run, args=(variant, path, args.n_lookups, args.k, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(args):
+    os.makedirs(args.workdir, exist_ok=True)
+    path = args.passages
+    if path is None:
+        path = os.path.join(args.workdir, "passage.tsv")
+        if not os.path.exists(path):
+            write_synthetic_kb(path, args.n_passages, args.seed)
+    shutil.rmtree(default_store_dir(path), ignore_errors=True)
+
+    # the first PassageStore open converts the passage file, later ones only map it
+    rows = [
+        ("load_passages+dict", measure("dicts", path, args)),
+        ("store (conversion)", measure("store", path, args)),
+        ("store (reopen)", measure("store", path, args)),
+    ]
+    print(f"passages file {os.path.getsize(path) / 2**20:.0f} MB, top-{args.k} lookups")
+    print(f"{'variant':>20} {'startup s':>10} {'lookup us':>10} {'anon RSS MB':>12}")
+    for label, (_, startup, lookup, rss) in rows:
+        print(f"{label:>20} {startup:>10.2f} {1e6 * lookup:>10.1f} {rss:>12.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--passages", type=str, default=None, help="passage file to use instead of the synthetic KB")
+    parser.add_argument("--workdir", type=str, default="/tmp/passage_store_benchmark")
+    parser.add_argument("--n_passages", type=int, default=500000)
+    parser.add_argument("--n_lookups", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,86 @@
+"""Wall time of answering a query set with one /retrieve request per query versus /retrieve_batch.
+
+The Operator server runs in-process under uvicorn on a local port and the queries go through the
+client functions, so the per-request HTTP overhead is included; on a remote server every saved round
+trip also saves the network latency. Contriever is replaced by the CPU stand-in from benchmarks.standin.
+
+    python -m benchmarks.retrieve_batch --n_queries 200 --batch_size 64
+"""
+
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import uvicorn
+
+import src.contriever
+import passage_retrieval_operator_server as server
+from passage_retrieval_operator_client import query_operator_server, query_operator_server_batch
+from benchmarks.operator_retrieve_latency import write_app_kb, standin_embedding_job
+from benchmarks.standin import load_standin_retriever
+
+APP_NAMES = ["BenchA", "BenchB", "BenchC"]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port):
+    uv = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=uv.run, daemon=True).start()
+    while not uv.started:
+        time.sleep(0.05)
+    return uv
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as kb_dir, \
+            mock.patch.object(server, "BASE_IMG_DIR", kb_dir), \
+            mock.patch.object(server, "INDEX_CACHE_DIR", os.path.join(kb_dir, "index_cache")), \
+            mock.patch.object(server, "PASSAGE_STORE_DIR", os.path.join(kb_dir, "passage_store")), \
+            mock.patch.object(server, "shared_retriever", None), \
+            mock.patch.object(server, "encoder", None), \
+            mock.patch.object(server, "embedding_caches", {}), \
+            mock.patch.object(server.query_cache, "max_entries", 0), \
+            mock.patch.object(server.subprocess, "run", standin_embedding_job), \
+            mock.patch.object(src.contriever, "load_retriever", load_standin_retriever):
+        for app_name in APP_NAMES:
+            write_app_kb(app_name, args.n_passages)
+            server.load_app_kb(app_name)
+        url = f"http://127.0.0.1:{free_port()}"
+        uv = start_server(int(url.rsplit(":", 1)[1]))
+
+        queries = [
+            f"subtask: step {i} App: {APP_NAMES[i % len(APP_NAMES)]}" for i in range(args.n_queries)
+        ]
+        start = time.perf_counter()
+        single = [query_operator_server(q, url, args.n_docs, save_images=False) for q in queries]
+        single_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = query_operator_server_batch(queries, url, args.n_docs, save_images=False, batch_size=args.batch_size)
+        batch_s = time.perf_counter() - start
+        uv.should_exit = True
+
+        same = [[d["id"] for d in r] for r in single] == [[d["id"] for d in r] for r in batched]
+        n_requests = -(-len(queries) // args.batch_size)
+        print(f"{len(queries)} queries over {len(APP_NAMES)} apps, same results: {same}")
+        print(f"{'endpoint':>15} {'requests':>9} {'wall s':>8} {'ms/query':>9}")
+        print(f"{'/retrieve':>15} {len(queries):>9} {single_s:>8.2f} {1000 * single_s / len(queries):>9.2f}")
+        print(f"{'/retrieve_batch':>15} {n_requests:>9} {batch_s:>8.2f} {1000 * batch_s / len(queries):>9.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_passages", type=int, default=2000, help="Number of passages in each synthetic app KB")
+    parser.add_argument("--n_queries", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=64, help="Queries per /retrieve_batch request")
+    parser.add_argument("--n_docs", type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,70 @@
+"""Throughput of the Operator /retrieve endpoint with and without micro-batching of concurrent requests.
+
+`--concurrency` clients each send `--n_queries` queries back to back against one app KB. With a batch
+size of 1 every query gets its own encoder pass and search; with micro-batching, queries that arrive
+together share both. Contriever is replaced by the CPU stand-in from benchmarks.standin, so absolute
+numbers understate the gain on a GPU encoder.
+
+    python -m benchmarks.retrieve_microbatch --concurrency 1 8 32 --batch_size 32
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from unittest import mock
+
+import src.contriever
+import passage_retrieval_operator_server as server
+from src.microbatch import MicroBatcher
+from benchmarks.operator_retrieve_latency import write_app_kb, standin_embedding_job
+from benchmarks.standin import load_standin_retriever
+
+APP_NAME = "BenchApp"
+
+
+async def run_clients(concurrency, n_queries, n_docs):
+    async def client(c):
+        for i in range(n_queries):
+            query = f"subtask: client {c} step {i} App: {APP_NAME}"
+            await server.retrieve_documents(server.QueryRequest(query=query, n_docs=n_docs))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(c) for c in range(concurrency)))
+    return concurrency * n_queries / (time.perf_counter() - start)
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as kb_dir, \
+            mock.patch.object(server, "BASE_IMG_DIR", kb_dir), \
+            mock.patch.object(server, "INDEX_CACHE_DIR", os.path.join(kb_dir, "index_cache")), \
+            mock.patch.object(server, "PASSAGE_STORE_DIR", os.path.join(kb_dir, "passage_store")), \
+            mock.patch.object(server, "shared_retriever", None), \
+            mock.patch.object(server, "encoder", None), \
+            mock.patch.object(server, "embedding_caches", {}), \
+            mock.patch.object(server.query_cache, "max_entries", 0), \
+            mock.patch.object(server.subprocess, "run", standin_embedding_job), \
+            mock.patch.object(src.contriever, "load_retriever", load_standin_retriever):
+        write_app_kb(APP_NAME, args.n_passages)
+        server.load_app_kb(APP_NAME)
+
+        print(f"{'clients':>8} {'batch 1 QPS':>12} {'batch ' + str(args.batch_size) + ' QPS':>14}")
+        for concurrency in args.concurrency:
+            qps = []
+            for batch_size in (1, args.batch_size):
+                batcher = MicroBatcher(server.search_batch, batch_size, args.wait_ms, executor=server.kb_executor)
+                with mock.patch.object(server, "retrieve_batcher", batcher):
+                    qps.append(asyncio.run(run_clients(concurrency, args.n_queries, args.n_docs)))
+            print(f"{concurrency:>8} {qps[0]:>12.1f} {qps[1]:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_passages", type=int, default=2000, help="Number of passages in the synthetic app KB")
+    parser.add_argument("--n_queries", type=int, default=20, help="Queries sent by each client")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="Numbers of concurrent clients")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--wait_ms", type=float, default=5.0)
+    parser.add_argument("--n_docs", type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,70 @@
+"""CPU stand-ins for the Contriever model and tokenizer used by the benchmarks.
+
+The stand-ins follow the interface the retrieval code uses (tokenizer(texts) / batch_encode_plus,
+pad_token_id, model(**batch) on tensors moved with .to(device)), so the real retrieval code runs
+unchanged on machines without a GPU or model weights. Tokens are hashed words; the model is a
+signed bag of hashed tokens, so its cost grows with the padded batch like a real encoder's.
+"""
+
+import hashlib
+
+import torch
+
+_ID_BITS = 62
+
+
+def _token_id(token):
+    h = int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "little")
+    return 1 + h % ((1 << _ID_BITS) - 1)  # 0 is the padding id
+
+
+class StandInTokenizer:
+    pad_token_id = 0
+
+    def __call__(self, texts, max_length=None, truncation=False, **kwargs):
+        input_ids = []
+        for text in texts:
+            ids = [_token_id(t) for t in text.lower().split()]
+            input_ids.append(ids[:max_length] if truncation and max_length else ids)
+        return {"input_ids": input_ids, "attention_mask": [[1] * len(ids) for ids in input_ids]}
+
+    def batch_encode_plus(self, texts, return_tensors=None, max_length=None, truncation=False, **kwargs):
+        features = self(texts, max_length=max_length, truncation=truncation)
+        longest = max(len(ids) for ids in features["input_ids"])
+        return {
+            k: torch.tensor([v + [0] * (longest - len(v)) for v in values])
+            for k, values in features.items()
+        }
+
+
+class StandInModel:
+    """Hashed bag-of-words encoder returning unit-norm vectors of size `dim`."""
+
+    def __init__(self, dim=768):
+        self.dim = dim
+
+    def eval(self):
+        return self
+
+    def cuda(self):
+        return self
+
+    def half(self):
+        return self
+
+    def float(self):
+        return self
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def __call__(self, input_ids, attention_mask, **kwargs):
+        sign = ((input_ids >> 32) & 1).float() * 2 - 1
+        out = torch.zeros((input_ids.shape[0], self.dim))
+        out.scatter_add_(1, input_ids % self.dim, sign * attention_mask.float())
+        return torch.nn.functional.normalize(out, dim=-1)
+
+
+def load_standin_retriever(model_path=None, pooling="average", random_init=False):
+    # same signature and return value as src.contriever.load_retriever
+    return StandInModel(), StandInTokenizer(), "standin"
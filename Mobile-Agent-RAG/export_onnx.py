@@ -0,0 +1,94 @@
+import os
+import sys
+import argparse
+
+import numpy as np
+import torch
+
+import src.contriever
+import src.data
+from src.onnx_encoder import ONNX_FILE, OUTPUT_NAME, load_onnx_encoder
+
+INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+DEFAULT_CHECK_QUERIES = [
+    "subtask: open the search bar App: Chrome",
+    "Research the latest green energy innovations from 2025 and summarize top 3 technologies in Notes.",
+    "tap",
+]
+
+
+class PooledEncoder(torch.nn.Module):
+    # fixes the keyword arguments of Contriever.forward so the exported graph takes only the token tensors
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+
+
+def export(model, tokenizer, onnx_path, opset):
+    sample = tokenizer.batch_encode_plus(DEFAULT_CHECK_QUERIES[:2], return_tensors="pt", padding=True)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in INPUT_NAMES}
+    dynamic_axes[OUTPUT_NAME] = {0: "batch"}
+    torch.onnx.export(
+        PooledEncoder(model),
+        tuple(sample[name] for name in INPUT_NAMES),
+        onnx_path,
+        input_names=INPUT_NAMES,
+        output_names=[OUTPUT_NAME],
+        dynamic_axes=dynamic_axes,
+        opset_version=opset,
+    )
+
+
+def check_parity(model, args, queries):
+    # the ONNX encoder must reproduce the PyTorch embeddings, for single queries and padded batches
+    onnx_model, tokenizer = load_onnx_encoder(args.output_dir)
+    max_diff = 0.0
+    for batch in [[q] for q in queries] + [queries]:
+        encoded = tokenizer.batch_encode_plus(
+            batch, return_tensors="pt", max_length=args.question_maxlength, padding=True, truncation=True
+        )
+        with torch.no_grad():
+            expected = model(**encoded).numpy()
+        actual = onnx_model(**encoded).numpy()
+        max_diff = max(max_diff, float(np.abs(expected - actual).max()))
+    print(f"Max abs difference between PyTorch and ONNX embeddings: {max_diff:.2e} (tolerance {args.atol:.0e})")
+    return max_diff <= args.atol
+
+
+def main(args):
+    model, tokenizer, _ = src.contriever.load_retriever(args.model_name_or_path)
+    model.eval()
+    model = model.float()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    onnx_path = os.path.join(args.output_dir, ONNX_FILE)
+    export(model, tokenizer, onnx_path, args.opset)
+    tokenizer.save_pretrained(args.output_dir)
+    print(f"Exported {args.model_name_or_path} to {onnx_path}")
+
+    if args.skip_check:
+        return
+    queries = DEFAULT_CHECK_QUERIES
+    if args.check_passages:
+        queries = [p["title"] for p in src.data.load_passages(args.check_passages)][: args.n_check]
+    if not check_parity(model, args, queries):
+        sys.exit("ONNX embeddings differ from the PyTorch embeddings beyond tolerance")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_name_or_path", type=str, default="contriever-msmarco", help="path to directory containing model weights and config file"
+    )
+    parser.add_argument("--output_dir", type=str, default="contriever-msmarco-onnx", help="dir to write model.onnx and the tokenizer to")
+    parser.add_argument("--opset", type=int, default=14)
+    parser.add_argument("--question_maxlength", type=int, default=512, help="Maximum number of tokens in a question")
+    parser.add_argument("--atol", type=float, default=1e-4, help="Largest accepted difference to the PyTorch embeddings")
+    parser.add_argument("--check_passages", type=str, default=None, help="Check parity on the titles of this .tsv file")
+    parser.add_argument("--n_check", type=int, default=64, help="Number of titles used by the parity check")
+    parser.add_argument("--skip_check", action="store_true", help="Skip the parity check after export")
+    args = parser.parse_args()
+    main(args)
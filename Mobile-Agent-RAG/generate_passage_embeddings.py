@@ -7,12 +7,13 @@
 import os
 
 import argparse
-import csv
+import concurrent.futures
+import glob
+import multiprocessing
 import logging
 import pickle
 
 import numpy as np
-import torch
 
 import transformers
 
@@ -21,59 +22,88 @@ import src.contriever
 import src.utils
 import src.data
 import src.normalize_text
-
-
-def embed_passages(args, passages, model, tokenizer):
+import src.embedding_shards
+import src.device
+import src.bucketing
+import src.embedding_cache
+
+
+def passage_text(args, p):
+    if args.no_title or not "title" in p:
+        text = p["text"]
+    else:
+        text = p["title"] + " " + p["text"]
+    if args.lowercase:
+        text = text.lower()
+    if args.normalize_text:
+        text = src.normalize_text.normalize(text)
+    return text
+
+
+def iter_passage_embeddings(args, passages, model, tokenizer, embedding_cache=None):
+    """Yield (positions, embeddings) blocks covering all passages, so callers can write them out as they come.
+
+    With an embedding_cache, the cached passages come first in one block and only the others are encoded.
+    """
+    device = src.device.resolve_device(getattr(args, "device", "auto"))
+    texts = [passage_text(args, p) for p in passages]
+
+    todo = list(range(len(passages)))
+    if embedding_cache is not None:
+        cached = embedding_cache.get(texts)
+        todo = [i for i, e in enumerate(cached) if e is None]
+        hits = [i for i, e in enumerate(cached) if e is not None]
+        print(f"Reusing {len(hits)} cached passage embeddings, encoding {len(todo)}")
+        if hits:
+            yield hits, np.stack([cached[i] for i in hits])
+
+    # passages are sorted by length within windows of this many, which bounds the pre-tokenized text held at once
+    window_size = args.per_gpu_batch_size * 64
     total = 0
-    allids, allembeddings = [], []
-    batch_ids, batch_text = [], []
-    with torch.no_grad():
-        for k, p in enumerate(passages):
-            batch_ids.append(p["id"])
-            if args.no_title or not "title" in p:
-                text = p["text"]
-            else:
-                text = p["title"] + " " + p["text"]
-            if args.lowercase:
-                text = text.lower()
-            if args.normalize_text:
-                text = src.normalize_text.normalize(text)
-            batch_text.append(text)
-
-            if len(batch_text) == args.per_gpu_batch_size or k == len(passages) - 1:
-
-                encoded_batch = tokenizer.batch_encode_plus(
-                    batch_text,
-                    return_tensors="pt",
-                    max_length=args.passage_maxlength,
-                    padding=True,
-                    truncation=True,
-                )
-
-                encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-                embeddings = model(**encoded_batch)
-
-                embeddings = embeddings.cpu()
-                total += len(batch_ids)
-                allids.extend(batch_ids)
-                allembeddings.append(embeddings)
-
-                batch_text = []
-                batch_ids = []
-                if k % 100000 == 0 and k > 0:
-                    print(f"Encoded passages {total}")
-
-    allembeddings = torch.cat(allembeddings, dim=0).numpy()
+    for start in range(0, len(todo), window_size):
+        window = todo[start:start + window_size]
+        window_texts = [texts[i] for i in window]
+        embeddings = src.bucketing.encode_length_bucketed(
+            model, tokenizer, window_texts, args.per_gpu_batch_size, args.passage_maxlength, device
+        ).numpy()
+        if embedding_cache is not None:
+            embedding_cache.put(window_texts, embeddings)
+        total += len(window)
+        print(f"Encoded passages {total}")
+        yield window, embeddings
+
+
+def embed_passages(args, passages, model, tokenizer, embedding_cache=None):
+    allids = [p["id"] for p in passages]
+    allembeddings = None
+    for positions, embeddings in iter_passage_embeddings(args, passages, model, tokenizer, embedding_cache):
+        if allembeddings is None:
+            allembeddings = np.empty((len(passages), embeddings.shape[1]), dtype=embeddings.dtype)
+        allembeddings[positions] = embeddings
+    if allembeddings is None:  # no passages
+        allembeddings = np.empty((0, src.bucketing.embedding_dim(model)), dtype=np.float32)
     return allids, allembeddings
 
 
-def main(args):
+def load_model(args):
     model, tokenizer, _ = src.contriever.load_retriever(args.model_name_or_path)
     print(f"Model loaded from {args.model_name_or_path}.", flush=True)
-    model.eval()
-    model = model.cuda()
-    if not args.no_fp16:
-        model = model.half()
+    model, _ = src.device.setup_encoder(args, model)
+    return model, tokenizer
+
+
+def save_embeddings(args, save_file, allids, allembeddings):
+    os.makedirs(os.path.dirname(save_file), exist_ok=True)
+    print(f"Saving {len(allids)} passage embeddings to {save_file}.")
+    if args.embedding_format == "pickle":
+        with open(save_file, mode="wb") as f:
+            pickle.dump((allids, allembeddings), f)
+    else:
+        src.embedding_shards.write_shard(save_file, allids, allembeddings, args.model_name_or_path, dtype=args.embedding_dtype)
+
+
+def main(args):
+    model, tokenizer = load_model(args)
 
     passages = src.data.load_passages(args.passages)
 
@@ -86,17 +116,81 @@ def main(args):
     passages = passages[start_idx:end_idx]
     print(f"Embedding generation for {len(passages)} passages from idx {start_idx} to {end_idx}.")
 
-    allids, allembeddings = embed_passages(args, passages, model, tokenizer)
+    embedding_cache = None
+    if args.embedding_cache_dir:
+        embedding_cache = src.embedding_cache.EmbeddingCache(
+            args.embedding_cache_dir, src.device.passage_encoder_id(args), args.passage_maxlength
+        )
+    allids, allembeddings = embed_passages(args, passages, model, tokenizer, embedding_cache)
 
     save_file = os.path.join(args.output_dir, args.prefix + f"_{args.shard_id:02d}")
-    os.makedirs(args.output_dir, exist_ok=True)
-    print(f"Saving {len(allids)} passage embeddings to {save_file}.")
-    with open(save_file, mode="wb") as f:
-        pickle.dump((allids, allembeddings), f)
+    save_embeddings(args, save_file, allids, allembeddings)
 
     print(f"Total passages processed {len(allids)}. Written to {save_file}.")
 
 
+# Batch mode over app KB directories (<app_dir>/passage.tsv -> <app_dir>/embedding/passages_00)
+
+def app_embedding_file(args, app_dir):
+    return os.path.join(app_dir, "embedding", args.prefix + "_00")
+
+
+def app_is_stale(args, app_dir):
+    tsv_file = os.path.join(app_dir, "passage.tsv")
+    embedding_file = app_embedding_file(args, app_dir)
+    return not os.path.exists(embedding_file) or os.path.getmtime(tsv_file) > os.path.getmtime(embedding_file)
+
+
+def embed_app(args, app_dir, model, tokenizer):
+    passages = src.data.load_passages(os.path.join(app_dir, "passage.tsv"))
+    print(f"Embedding {len(passages)} passages of {app_dir}.")
+    embedding_cache = src.embedding_cache.EmbeddingCache(
+        os.path.join(app_dir, "embedding", "cache"), src.device.passage_encoder_id(args), args.passage_maxlength
+    )
+    allids, allembeddings = embed_passages(args, passages, model, tokenizer, embedding_cache)
+    save_embeddings(args, app_embedding_file(args, app_dir), allids, allembeddings)
+    return len(allids)
+
+
+_worker_model = None
+
+
+def _init_app_worker(args):
+    global _worker_model
+    _worker_model = load_model(args)
+
+
+def _embed_app_in_worker(args, app_dir):
+    return embed_app(args, app_dir, *_worker_model)
+
+
+def main_apps(args):
+    app_dirs = sorted({
+        d for pattern in args.app_dirs for d in glob.glob(pattern)
+        if os.path.isfile(os.path.join(d, "passage.tsv"))
+    })
+    stale = [d for d in app_dirs if args.force or app_is_stale(args, d)]
+    print(f"{len(stale)} of {len(app_dirs)} app KBs need new embeddings.")
+    if not stale:
+        return
+    # largest KBs first, so the pool does not end waiting on one big app
+    stale.sort(key=lambda d: os.path.getsize(os.path.join(d, "passage.tsv")), reverse=True)
+
+    num_workers = min(args.num_workers, len(stale))
+    if num_workers <= 1:
+        model, tokenizer = load_model(args)
+        total = sum(embed_app(args, d, model, tokenizer) for d in stale)
+    else:
+        if args.num_threads <= 0:
+            args.num_threads = max(1, (os.cpu_count() or 1) // num_workers)  # split the cores between workers
+        # every worker loads the model once and then embeds its share of the apps
+        with concurrent.futures.ProcessPoolExecutor(
+            num_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_app_worker, initargs=(args,)
+        ) as pool:
+            total = sum(pool.map(_embed_app_in_worker, [args] * len(stale), stale))
+    print(f"Total passages processed {total} in {len(stale)} app KBs.")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
@@ -113,12 +207,46 @@ if __name__ == "__main__":
         "--model_name_or_path", type=str, help="path to directory containing model weights and config file"
     )
     parser.add_argument("--no_fp16", action="store_true", help="inference in fp32")
+    parser.add_argument("--device", type=str, default="auto", help="cuda, cpu or auto (cuda when available)")
+    parser.add_argument("--num_threads", type=int, default=0, help="Intra-op threads for CPU inference, 0 keeps the torch default")
     parser.add_argument("--no_title", action="store_true", help="title not added to the passage body")
     parser.add_argument("--lowercase", action="store_true", help="lowercase text before encoding")
     parser.add_argument("--normalize_text", action="store_true", help="lowercase text before encoding")
+    parser.add_argument(
+        "--embedding_format",
+        type=str,
+        default="npy",
+        choices=["npy", "pickle"],
+        help="npy: JSON header with memory-mappable .npy sidecars; pickle: legacy (ids, embeddings) pickle",
+    )
+    parser.add_argument(
+        "--embedding_dtype",
+        type=str,
+        default=None,
+        choices=["float16", "float32"],
+        help="dtype of the stored embeddings (npy format), defaults to the model output dtype",
+    )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--app_dirs",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Batch mode: globs of app KB directories; embeds <app_dir>/passage.tsv of every stale app with one model load",
+    )
+    parser.add_argument("--force", action="store_true", help="Batch mode: re-embed apps even if they are up to date")
+    parser.add_argument("--num_workers", type=int, default=1, help="Batch mode: processes to spread the apps over")
+    parser.add_argument(
+        "--embedding_cache_dir",
+        type=str,
+        default=None,
+        help="Cache of passage embeddings keyed by their text; only passages missing from it are encoded",
+    )
 
-    src.slurm.init_distributed_mode(args)
+    args = parser.parse_args()
 
-    main(args)
+    if args.app_dirs:
+        main_apps(args)
+    else:
+        src.slurm.init_distributed_mode(args)
+        main(args)
@@ -27,7 +27,7 @@ import concurrent
 import json
 from dataclasses import dataclass, field, asdict
 
-from passage_retrieval_operator_client import upload_action_to_server
+from passage_retrieval_operator_client import upload_action_in_background, flushes_action_uploads
 
 import re
 import os
@@ -394,6 +394,7 @@ def get_reasoning_model_api_response(chat, model_type=BACKBONE_TYPE, model=None,
     
 
 
+@flushes_action_uploads  # queued Operator KB updates are sent before the next task starts
 def run_single_task(
     instruction,
     future_tasks=[],
@@ -837,10 +838,10 @@ def run_single_task(
         info_pool.last_action = action_object
         info_pool.last_summary = action_description
 
-        # update Operator-RAG knowledge base
+        # update Operator-RAG knowledge base (queued, sent by a background thread)
         subtask = info_pool.current_subtask
         subtask = re.sub(r'^\s*\d+\.\s*', '', subtask)
-        upload_action_to_server(info_pool.last_action, subtask, screenshot_file)
+        upload_action_in_background(info_pool.last_action, subtask, screenshot_file)
         
         ## log ##
         steps.append({
@@ -0,0 +1,169 @@
+"""Embed a large passage file with N local worker processes, without SLURM.
+
+The passage file is split into N ranges of whole lines; worker i loads the model once, embeds its
+range and streams the embeddings into the shard `<output_dir>/<prefix>_<i>` (the format of
+src.embedding_shards, loadable with --passages_embeddings "<output_dir>/<prefix>_*"). On CPU every
+worker is pinned to its own group of cores and runs that many torch threads, so the workers do not
+compete for cores; on GPU the workers are spread over the visible devices. The shard headers are
+merged into `<output_dir>/manifest.json`.
+
+    python launch_passage_embeddings.py --model_name_or_path contriever-msmarco \
+        --passages mobile_eval_rag_retrieve/manager/passage.tsv --output_dir manager_embeddings --num_workers 4
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import time
+
+import torch
+
+import src.data
+import src.device
+import src.embedding_cache
+import src.embedding_shards
+from generate_passage_embeddings import iter_passage_embeddings, load_model
+
+MANIFEST_FILE = "manifest.json"
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_groups(num_workers, threads_per_worker=0):
+    # contiguous groups, so a worker's threads share caches (and usually a socket)
+    cpus = available_cpus()
+    size = threads_per_worker or max(1, len(cpus) // num_workers)
+    return [[cpus[(i * size + j) % len(cpus)] for j in range(size)] for i in range(num_workers)]
+
+
+def embed_range(args, shard_id, start, end, cpus):
+    device = src.device.resolve_device(args.device)
+    if device.type == "cuda":
+        args.device = f"cuda:{shard_id % torch.cuda.device_count()}"
+    else:
+        if not args.no_pin and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        args.num_threads = len(cpus)
+
+    model, tokenizer = load_model(args)
+    passages = src.data.load_passage_range(args.passages, start, end)
+    print(f"Worker {shard_id}: embedding {len(passages)} passages from bytes {start} to {end}.", flush=True)
+    if not passages:
+        return {"shard_id": shard_id, "count": 0}
+
+    embedding_cache = None
+    if args.embedding_cache_dir:
+        embedding_cache = src.embedding_cache.EmbeddingCache(
+            args.embedding_cache_dir, src.device.passage_encoder_id(args), args.passage_maxlength
+        )
+    save_file = os.path.join(args.output_dir, f"{args.prefix}_{shard_id:02d}")
+    shard = None
+    for positions, embeddings in iter_passage_embeddings(args, passages, model, tokenizer, embedding_cache):
+        if shard is None:
+            dtype = args.embedding_dtype or embeddings.dtype
+            shard = src.embedding_shards.create_shard(save_file, len(passages), embeddings.shape[1], dtype)
+        shard[positions] = embeddings
+    header = src.embedding_shards.finish_shard(save_file, [p["id"] for p in passages], shard, args.model_name_or_path)
+    return {"shard_id": shard_id, "file": os.path.basename(save_file), "bytes": [start, end], **header}
+
+
+def remove_old_shards(args, shard_files):
+    # shards of a previous run with more workers would otherwise be picked up by "<prefix>_*" globs
+    manifest_path = os.path.join(args.output_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return
+    with open(manifest_path) as f:
+        old = json.load(f)
+    for shard in old.get("shards", []):
+        if shard["file"] in shard_files:
+            continue
+        path = os.path.join(args.output_dir, shard["file"])
+        for file_path in [path] + [path + suffix for suffix in src.embedding_shards.SIDECAR_SUFFIXES]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+
+def write_manifest(args, shards):
+    manifest = {
+        "passages": args.passages,
+        "model_id": args.model_name_or_path,
+        "count": sum(s["count"] for s in shards),
+        "dim": shards[0]["dim"] if shards else None,
+        "dtype": shards[0]["dtype"] if shards else None,
+        "shards": shards,
+    }
+    tmp_path = os.path.join(args.output_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(args.output_dir, MANIFEST_FILE))
+    return manifest
+
+
+def main(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    ranges = src.data.passage_byte_ranges(args.passages, args.num_workers)
+    groups = cpu_groups(args.num_workers, args.threads_per_worker)
+    print(f"Embedding {args.passages} with {args.num_workers} workers, CPU groups {groups}.")
+
+    start_time = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(args.num_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [
+            pool.submit(embed_range, args, shard_id, start, end, groups[shard_id])
+            for shard_id, (start, end) in enumerate(ranges)
+        ]
+        results = [f.result() for f in futures]
+    elapsed = time.perf_counter() - start_time
+
+    shards = [r for r in results if r["count"] > 0]
+    remove_old_shards(args, {s["file"] for s in shards})
+    manifest = write_manifest(args, shards)
+    print(
+        f"Total passages processed {manifest['count']} in {len(shards)} shards in {elapsed:.1f}s "
+        f"({manifest['count'] / elapsed:.1f} passages/s). Written to {args.output_dir}."
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--passages", type=str, required=True, help="Path to passages (.tsv or .jsonl file)")
+    parser.add_argument("--output_dir", type=str, default="wikipedia_embeddings", help="dir path to save embeddings")
+    parser.add_argument("--prefix", type=str, default="passages", help="prefix path to save embeddings")
+    parser.add_argument("--num_workers", type=int, default=2, help="Worker processes, one shard each")
+    parser.add_argument(
+        "--threads_per_worker", type=int, default=0, help="CPU cores pinned to each worker, 0 splits the cores evenly"
+    )
+    parser.add_argument("--no_pin", action="store_true", help="do not pin the workers to their cores")
+    parser.add_argument(
+        "--per_gpu_batch_size", type=int, default=512, help="Batch size for the passage encoder forward pass"
+    )
+    parser.add_argument("--passage_maxlength", type=int, default=512, help="Maximum number of tokens in a passage")
+    parser.add_argument(
+        "--model_name_or_path", type=str, help="path to directory containing model weights and config file"
+    )
+    parser.add_argument("--no_fp16", action="store_true", help="inference in fp32")
+    parser.add_argument("--device", type=str, default="auto", help="cuda, cpu or auto (cuda when available)")
+    parser.add_argument("--no_title", action="store_true", help="title not added to the passage body")
+    parser.add_argument("--lowercase", action="store_true", help="lowercase text before encoding")
+    parser.add_argument("--normalize_text", action="store_true", help="lowercase text before encoding")
+    parser.add_argument(
+        "--embedding_dtype",
+        type=str,
+        default=None,
+        choices=["float16", "float32"],
+        help="dtype of the stored embeddings, defaults to the model output dtype",
+    )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        type=str,
+        default=None,
+        help="Cache of passage embeddings keyed by their text; only passages missing from it are encoded",
+    )
+
+    main(parser.parse_args())
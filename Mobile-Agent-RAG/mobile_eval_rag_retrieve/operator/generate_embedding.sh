@@ -1,24 +1,19 @@
-for app_dir in mobile_eval_e_retrieve/operator/app/*; do
-    # Check if the directory exists and contains passage.tsv
-    tsv_file="$app_dir/passage.tsv"
-    embedding_dir="$app_dir/embedding"
-    embedding_file="$embedding_dir/passages_00"
+# Re-embed the passage.tsv of every app (or only the apps given as arguments) whose embedding file
+# is missing or older than passage.tsv, in one job that loads the model once.
+# Usage: bash mobile_eval_rag_retrieve/operator/generate_embedding.sh [App ...]
+# Set NUM_WORKERS to spread the apps over several processes and FORCE=1 to re-embed up-to-date apps too.
+app_root=mobile_eval_rag_retrieve/operator/app
 
-    if [ -f "$tsv_file" ]; then
-        echo "Checking $app_dir..."
-
-        # Check if embedding file exists and compare modification times
-        if [ ! -f "$embedding_file" ] || [ "$tsv_file" -nt "$embedding_file" ]; then
-            echo "Updating embeddings for $app_dir: passage.tsv is new or embedding file is missing."
-            python generate_passage_embeddings.py \
-                --model_name_or_path contriever-msmarco \
-                --passages "$tsv_file" \
-                --output_dir "$embedding_dir"
-        else
-            echo "Skipped $app_dir: passage.tsv has not changed since last embedding."
-        fi
-    else
-        echo "Skipped $app_dir: passage.tsv not found."
-    fi
-done
+app_dirs=("$app_root/*")
+if [ "$#" -gt 0 ]; then
+    app_dirs=()
+    for app in "$@"; do
+        app_dirs+=("$app_root/$app")
+    done
+fi
 
+python generate_passage_embeddings.py \
+    --model_name_or_path contriever-msmarco \
+    --app_dirs "${app_dirs[@]}" \
+    --num_workers "${NUM_WORKERS:-1}" \
+    ${FORCE:+--force}
@@ -7,9 +7,7 @@
 import os
 import argparse
 import json
-import pickle
 import time
-import glob
 from pathlib import Path
 
 import numpy as np
@@ -21,44 +19,60 @@ import src.contriever
 import src.utils
 import src.slurm
 import src.data
+import src.passage_store
+import src.embedding_shards
+import src.index_cache
+import src.query_cache
+import src.device
+import src.bucketing
+import src.bm25
+import src.fusion
 from src.evaluation import calculate_matches
 import src.normalize_text
+from generate_passage_embeddings import passage_text
 
 os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
 
 class Retriever:
-    def __init__(self, args, model=None, tokenizer=None) :
+    def __init__(self, args, model=None, tokenizer=None, query_cache=None, query_model=None) :
         self.args = args
-        self.model = model
+        self.model = model  # encodes passages
+        self.query_model = query_model if query_model is not None else model  # encodes queries, int8 with quantize_int8
         self.tokenizer = tokenizer
+        self.device = src.device.resolve_device(getattr(args, "device", "auto"))
+        # a cache passed in is shared with other retrievers (e.g. all Operator apps)
+        if query_cache is None and getattr(args, "query_cache_size", 0) > 0:
+            query_cache = src.query_cache.QueryEmbeddingCache(args.query_cache_size, getattr(args, "query_cache_path", None))
+        self.query_cache = query_cache
+        self.sparse_index = None  # BM25Index built next to the dense index when args.fusion is not "none"
 
     def embed_queries(self, args, queries):
-        embeddings, batch_question = [], []
-        with torch.no_grad():
-            for k, q in enumerate(queries):
-                if args.lowercase:
-                    q = q.lower()
-                if args.normalize_text:
-                    q = src.normalize_text.normalize(q)
-                batch_question.append(q)
-
-                if len(batch_question) == args.per_gpu_batch_size or k == len(queries) - 1:
-
-                    encoded_batch = self.tokenizer.batch_encode_plus(
-                        batch_question,
-                        return_tensors="pt",
-                        max_length=args.question_maxlength,
-                        padding=True,
-                        truncation=True,
-                    )
-                    encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-                    output = self.model(**encoded_batch)
-                    embeddings.append(output.cpu())
-
-                    batch_question = []
-
-        embeddings = torch.cat(embeddings, dim=0)
+        normalized = []
+        for q in queries:
+            if args.lowercase:
+                q = q.lower()
+            if args.normalize_text:
+                q = src.normalize_text.normalize(q)
+            normalized.append(q)
+        if self.query_cache is None:
+            return self.encode_queries(args, normalized)
+
+        keys = [src.query_cache.query_key(src.device.encoder_id(args), args.question_maxlength, q) for q in normalized]
+        embeddings = [self.query_cache.get(key) for key in keys]
+        # encode each distinct missing query once
+        missing = {key: q for key, q, e in zip(keys, normalized, embeddings) if e is None}
+        if missing:
+            encoded = dict(zip(missing, self.encode_queries(args, list(missing.values()))))
+            for key, e in encoded.items():
+                self.query_cache.put(key, e)
+            embeddings = [e if e is not None else encoded[key] for key, e in zip(keys, embeddings)]
+        return np.stack(embeddings)
+
+    def encode_queries(self, args, queries):
+        embeddings = src.bucketing.encode_length_bucketed(
+            self.query_model, self.tokenizer, queries, args.per_gpu_batch_size, args.question_maxlength, self.device
+        )
         print(f"Questions embeddings shape: {embeddings.size()}")
 
         return embeddings.numpy()
@@ -79,7 +93,7 @@ class Retriever:
                         padding=True,
                         truncation=True,
                     )
-                    encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
+                    encoded_batch = src.device.to_device(encoded_batch, self.device)
                     output = self.model(**encoded_batch)
                     embeddings.append(output.cpu())
 
@@ -91,80 +105,121 @@ class Retriever:
         return embeddings.numpy()
 
     def index_encoded_data(self, index, embedding_files, indexing_batch_size):
-        allids = []
-        allembeddings = np.array([])
-        for i, file_path in enumerate(embedding_files):
+        # stream each shard into the index in slices, so peak memory is bounded by one slice
+        for file_path in embedding_files:
             print(f"Loading file {file_path}")
-            with open(file_path, "rb") as fin:
-                ids, embeddings = pickle.load(fin)
-
-            allembeddings = np.vstack((allembeddings, embeddings)) if allembeddings.size else embeddings
-            allids.extend(ids)
-            while allembeddings.shape[0] > indexing_batch_size:
-                allembeddings, allids = self.add_embeddings(index, allembeddings, allids, indexing_batch_size)
-
-        while allembeddings.shape[0] > 0:
-            allembeddings, allids = self.add_embeddings(index, allembeddings, allids, indexing_batch_size)
+            for ids, embeddings in src.embedding_shards.iter_shard_slices(file_path, indexing_batch_size):
+                index.index_data(ids, embeddings)
+        index.flush()
 
         print("Data indexing completed.")
 
 
-    def add_embeddings(self, index, embeddings, ids, indexing_batch_size):
-        end_idx = min(indexing_batch_size, embeddings.shape[0])
-        ids_toadd = ids[:end_idx]
-        embeddings_toadd = embeddings[:end_idx]
-        ids = ids[end_idx:]
-        embeddings = embeddings[end_idx:]
-        index.index_data(ids_toadd, embeddings_toadd)
-        return embeddings, ids
-
-
     def add_passages(self, passages, top_passages_and_scores):
         # add passages to original data
         docs = [passages[doc_id] for doc_id in top_passages_and_scores[0][0]]
         return docs
 
-    def setup_retriever(self):
+    def index_fingerprint(self, input_paths):
+        return src.index_cache.fingerprint(input_paths, self.args.model_name_or_path, src.index_cache.index_config(self.args))
+
+    def load_model(self):
+        if getattr(self.args, "onnx_model", None):
+            from src.onnx_encoder import load_onnx_encoder  # onnxruntime is only needed for this backend
+
+            print(f"Loading ONNX model from: {self.args.onnx_model}")
+            self.model, self.tokenizer = load_onnx_encoder(
+                self.args.onnx_model, num_threads=self.args.num_threads, use_cuda=self.device.type == "cuda"
+            )
+            self.query_model = self.model
+            return self.model, self.tokenizer
         print(f"Loading model from: {self.args.model_name_or_path}")
         self.model, self.tokenizer, _ = src.contriever.load_retriever(self.args.model_name_or_path)
-        self.model.eval()
-        self.model = self.model.cuda()
-        if not self.args.no_fp16:
-            self.model = self.model.half()
+        self.model, self.device = src.device.setup_encoder(self.args, self.model)
+        self.query_model = src.device.query_encoder(self.args, self.model, self.device)
+        return self.model, self.tokenizer
+
+    def setup_retriever(self):
+        self.load_model()
 
-        self.index = src.index.Indexer(self.args.projection_size, self.args.n_subquantizers, self.args.n_bits)
+        self.index = src.index.Indexer(
+            self.args.projection_size,
+            self.args.n_subquantizers,
+            self.args.n_bits,
+            index_spec=self.args.index_spec,
+            nprobe=self.args.nprobe,
+            ef_search=self.args.ef_search,
+        )
 
         # index all passages
-        input_paths = glob.glob(self.args.passages_embeddings)
-        input_paths = sorted(input_paths)
+        input_paths = src.embedding_shards.list_shards(self.args.passages_embeddings)
         embeddings_dir = os.path.dirname(input_paths[0])
-        index_path = os.path.join(embeddings_dir, "index.faiss")
-        if self.args.save_or_load_index and os.path.exists(index_path):
-            self.index.deserialize_from(embeddings_dir)
+        # a serialized index is reused only if it was built from the same shards, model and index config
+        index_fingerprint = self.index_fingerprint(input_paths)
+        if self.args.save_or_load_index and src.index_cache.load_index(self.index, embeddings_dir, index_fingerprint):
+            print(f"Loaded cached index from {embeddings_dir}")
         else:
             print(f"Indexing passages from files {input_paths}")
             start_time_indexing = time.time()
             self.index_encoded_data(self.index, input_paths, self.args.indexing_batch_size)
             print(f"Indexing time: {time.time()-start_time_indexing:.1f} s.")
             if self.args.save_or_load_index:
-                self.index.serialize(embeddings_dir)
+                src.index_cache.save_index(self.index, embeddings_dir, index_fingerprint)
 
         # load passages
         print("loading passages")
-        self.passages = src.data.load_passages(self.args.passages)
-        self.passage_id_map = {x["id"]: x for x in self.passages}
+        self.passages = src.passage_store.PassageStore(self.args.passages)
+        self.passage_id_map = self.passages
         print("passages have been loaded")
+        if getattr(self.args, "fusion", "none") != "none":
+            self.sparse_index = src.bm25.BM25Index()
+            self.index_sparse(self.passages.values())
+
+    def index_sparse(self, passages, chunk_size=10000):
+        # BM25 side of hybrid retrieval, over the same text the passages are embedded from
+        chunk = []
+        for p in passages:
+            chunk.append(p)
+            if len(chunk) == chunk_size:
+                self._index_sparse_chunk(chunk)
+                chunk = []
+        self._index_sparse_chunk(chunk)
+
+    def _index_sparse_chunk(self, passages):
+        self.sparse_index.index_data([p["id"] for p in passages], [passage_text(self.args, p) for p in passages])
+
+    def search_index(self, queries, query_embeddings, n_docs):
+        # dense search, fused with the BM25 ranking when hybrid retrieval is enabled
+        if self.sparse_index is None:
+            return self.index.search_knn(query_embeddings, n_docs)
+        n_candidates = max(n_docs, self.args.fusion_candidates)
+        dense = self.index.search_knn(query_embeddings, n_candidates)
+        sparse = self.sparse_index.search(queries, n_candidates)
+        return src.fusion.fuse(dense, sparse, self.args.fusion, n_docs, self.args.fusion_alpha, self.args.rrf_k)
 
     def search_document(self, query, top_n=10):
         questions_embedding = self.embed_queries(self.args, [query])
 
         # get top k results
         start_time_retrieval = time.time()
-        top_ids_and_scores = self.index.search_knn(questions_embedding, self.args.n_docs)
+        top_ids_and_scores = self.search_index([query], questions_embedding, self.args.n_docs)
         print(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
 
         return self.add_passages(self.passage_id_map, top_ids_and_scores)[:top_n]
     
+    def search_documents(self, queries, top_n, query_embeddings=None):
+        # batched search_document: one encoder pass and one search_knn call for all queries,
+        # with a per-query top_n (searched to the largest of them, at least args.n_docs)
+        if query_embeddings is None:
+            query_embeddings = self.embed_queries(self.args, queries)
+        start_time_retrieval = time.time()
+        top_ids_and_scores = self.search_index(queries, query_embeddings, max([self.args.n_docs, *top_n]))
+        print(f"Search time: {time.time()-start_time_retrieval:.1f} s for {len(queries)} queries.")
+        return [
+            [self.passage_id_map[doc_id] for doc_id in ids][:n]
+            for (ids, _), n in zip(top_ids_and_scores, top_n)
+        ]
+
     def search_document_demo(self, query, n_docs=10):
         questions_embedding = self.embed_queries_demo([query])
 
@@ -178,14 +233,12 @@ class Retriever:
     def setup_retriever_demo(self, model_name_or_path, passages, passages_embeddings, n_docs=5, save_or_load_index=False):
         print(f"Loading model from: {model_name_or_path}")
         self.model, self.tokenizer, _ = src.contriever.load_retriever(model_name_or_path)
-        self.model.eval()
-        self.model = self.model.cuda()
+        self.model = self.query_model = src.device.prepare_encoder(self.model, self.device, fp16=False)
 
         self.index = src.index.Indexer(768, 0, 8)
 
         # index all passages
-        input_paths = glob.glob(passages_embeddings)
-        input_paths = sorted(input_paths)
+        input_paths = src.embedding_shards.list_shards(passages_embeddings)
         embeddings_dir = os.path.dirname(input_paths[0])
         index_path = os.path.join(embeddings_dir, "index.faiss")
         if save_or_load_index and os.path.exists(index_path):
@@ -198,8 +251,8 @@ class Retriever:
 
         # load passages
         print("loading passages")
-        self.passages = src.data.load_passages(passages)
-        self.passage_id_map = {x["id"]: x for x in self.passages}
+        self.passages = src.passage_store.PassageStore(passages)
+        self.passage_id_map = self.passages
         print("passages have been loaded")
 
 def add_hasanswer(data, hasanswer):
@@ -228,6 +281,8 @@ def main(args,query):
 
     question_text = query
     retrieved_docs = retriever.search_document(question_text, args.n_docs)
+    if retriever.query_cache is not None and args.query_cache_path:
+        retriever.query_cache.save()
 
     output = {
         "question": question_text,
@@ -272,6 +327,30 @@ if __name__ == "__main__":
         help="Number of subquantizer used for vector quantization, if 0 flat index is used",
     )
     parser.add_argument("--n_bits", type=int, default=8, help="Number of bits per subquantizer")
+    parser.add_argument(
+        "--index_spec",
+        type=str,
+        default=None,
+        help="faiss index_factory string for an approximate index, e.g. 'IVF1024,Flat', 'IVF1024,PQ64' or 'HNSW32,Flat'",
+    )
+    parser.add_argument("--nprobe", type=int, default=16, help="Number of IVF lists visited per query")
+    parser.add_argument("--ef_search", type=int, default=64, help="Size of the HNSW candidate list at search time")
+    parser.add_argument("--query_cache_size", type=int, default=0, help="Number of query embeddings to cache, 0 disables the cache")
+    parser.add_argument("--query_cache_path", type=str, default=None, help="Optional .npz file the query cache is loaded from and saved to")
+    parser.add_argument("--device", type=str, default="auto", help="cuda, cpu or auto (cuda when available)")
+    parser.add_argument("--num_threads", type=int, default=0, help="Intra-op threads for CPU inference, 0 keeps the torch default")
+    parser.add_argument("--quantize_int8", action="store_true", help="Quantize the query encoder to int8 (CPU only)")
+    parser.add_argument("--onnx_model", type=str, default=None, help="Dir written by export_onnx.py; encode with onnxruntime instead of PyTorch")
+    parser.add_argument(
+        "--fusion",
+        type=str,
+        default="none",
+        choices=src.fusion.FUSION_METHODS,
+        help="Fuse the dense ranking with a BM25 ranking: reciprocal rank (rrf) or min-max normalized scores (weighted)",
+    )
+    parser.add_argument("--fusion_alpha", type=float, default=0.5, help="Weight of the dense ranking in the fusion")
+    parser.add_argument("--rrf_k", type=int, default=60, help="Rank offset of reciprocal rank fusion")
+    parser.add_argument("--fusion_candidates", type=int, default=20, help="Candidates taken from each ranking before fusion")
     parser.add_argument("--lang", nargs="+")
     parser.add_argument("--dataset", type=str, default="none")
     parser.add_argument("--lowercase", action="store_true", help="lowercase text before encoding")
@@ -1,4 +1,5 @@
 import requests
+from src.http_client import get_client
 
 def query_manager_server(query: str, server_url: str = "http://localhost:8000", n_docs: int = 3):
     payload = {
@@ -7,8 +8,9 @@ def query_manager_server(query: str, server_url: str = "http://localhost:8000",
     }
     
     try:
-        response = requests.post(
-            f"{server_url}/retrieve",
+        # pooled keep-alive connection, shared by all calls to this server
+        response = get_client(server_url).post(
+            "/retrieve",
             json=payload,
             timeout=30  
         )
@@ -17,6 +19,38 @@ def query_manager_server(query: str, server_url: str = "http://localhost:8000",
     except requests.exceptions.RequestException as e:
         return {"error": str(e)}
 
+async def aquery_manager_server(query: str, client, n_docs: int = 3):
+    # async query_manager_server over a src.http_client_async.AsyncRAGClient
+    try:
+        response = await client.post("/retrieve", json={"query": query, "n_docs": n_docs}, timeout=30)
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        return {"error": str(e)}
+
+def query_manager_server_batch(queries, server_url: str = "http://localhost:8000", n_docs: int = 3, batch_size: int = 1024):
+    # Many queries per request; a query is a string or a (query, n_docs) pair. Returns one
+    # query_manager_server-style result per query, in order.
+    payloads = [
+        {"query": q, "n_docs": n_docs} if isinstance(q, str) else {"query": q[0], "n_docs": q[1]}
+        for q in queries
+    ]
+    client = get_client(server_url)
+    results = []
+    for start in range(0, len(payloads), batch_size):
+        chunk = payloads[start:start + batch_size]
+        try:
+            response = client.post(
+                "/retrieve_batch",
+                json={"queries": chunk},
+                timeout=30 + len(chunk)
+            )
+            response.raise_for_status()
+            results.extend(response.json()["responses"])
+        except requests.exceptions.RequestException as e:
+            results.extend({"error": str(e)} for _ in chunk)
+    return results
+
 if __name__ == "__main__":
     test_query = "Search for learn spanish for beginners on YouTube, filter by this month, and add the first video to the Watch Later playlist"
     result = query_manager_server(test_query)
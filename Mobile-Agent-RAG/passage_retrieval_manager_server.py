@@ -1,8 +1,13 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from typing import List
 import argparse
+import asyncio
+import os
 import uvicorn
+from concurrent.futures import ThreadPoolExecutor
 from passage_retrieval_manager import Retriever, main  
+from src.microbatch import MicroBatcher
 
 app = FastAPI()
 
@@ -15,13 +20,24 @@ args = argparse.Namespace(
     per_gpu_batch_size=64,
     question_maxlength=512,
     no_fp16=False,
+    device=os.environ.get("RETRIEVAL_DEVICE", "auto"),  # "cpu" on GPU-less serving nodes
+    num_threads=int(os.environ.get("RETRIEVAL_NUM_THREADS", 0)),
+    quantize_int8=os.environ.get("RETRIEVAL_QUANTIZE_INT8", "0") == "1",  # int8 query encoder, CPU only
+    onnx_model=os.environ.get("RETRIEVAL_ONNX_MODEL"),  # dir written by export_onnx.py, encodes with onnxruntime
+    fusion=os.environ.get("RETRIEVAL_FUSION", "none"),  # "rrf" or "weighted": hybrid BM25 + dense ranking
+    fusion_alpha=0.5,  # weight of the dense ranking
+    rrf_k=60,
+    fusion_candidates=20,  # taken from each ranking before fusion
     lowercase=False,
     normalize_text=False,
     projection_size=768,
     n_subquantizers=0,
     n_bits=8,
+    index_spec=None,
+    nprobe=16,
+    ef_search=64,
     indexing_batch_size=1000000,
-    save_or_load_index=False,
+    save_or_load_index=True,
     output_dir=None,
     validation_workers=32,
     lang=None,
@@ -46,33 +62,79 @@ args = argparse.Namespace(
     use_gpu=True,
     save_index_path=None,
     load_index_path=None,
-
+    query_cache_size=10000,
+    query_cache_path="mobile_eval_rag_retrieve/manager/query_cache.npz",
+    retrieve_batch_size=32,  # most /retrieve queries encoded and searched together
+    retrieve_batch_wait_ms=5.0,  # how long the first query of a batch waits for others
+    retrieve_batch_max_queries=1024,  # most queries accepted by one /retrieve_batch request
 )
 
 # Initialize retriever instance
 retriever = Retriever(args)
 retriever.setup_retriever()
 
+def search_batch(requests):
+    # Answer a micro-batch of (query, n_docs) with one encoder pass and one index search
+    return retriever.search_documents([query for query, _ in requests], [n_docs for _, n_docs in requests])
+
+# Searches run on one worker thread, off the event loop
+search_executor = ThreadPoolExecutor(max_workers=1)
+retrieve_batcher = MicroBatcher(
+    search_batch, args.retrieve_batch_size, args.retrieve_batch_wait_ms, executor=search_executor
+)
+
 class QueryRequest(BaseModel):
     query: str
     n_docs: int = 3  # Allow client to customize the number of results returned
 
+class BatchQueryRequest(BaseModel):
+    queries: List[QueryRequest]
+
+def format_results(docs):
+    return {
+        "results": [
+            {
+                "id": doc["id"],
+                "title": doc["title"],
+                "text": doc["text"]
+            } for doc in docs
+        ]
+    }
+
 @app.post("/retrieve")
 async def retrieve_documents(request: QueryRequest):
     try:
-        # Call the original main function logic
-        result = retriever.search_document(request.query, request.n_docs)
-        return {
-            "results": [
-                {
-                    "id": doc["id"],
-                    "title": doc["title"],
-                    "text": doc["text"]  
-                } for doc in result
-            ]
-        }
+        # Queued with concurrent requests and answered from one batched search
+        result = await retrieve_batcher.submit((request.query, request.n_docs))
+        return format_results(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/retrieve_batch")
+async def retrieve_documents_batch(request: BatchQueryRequest):
+    # Many queries in one request: one encoder pass and one index search for all of them; the
+    # responses are in query order, each shaped like a /retrieve response
+    if len(request.queries) > args.retrieve_batch_max_queries:
+        raise HTTPException(
+            status_code=400, detail=f"At most {args.retrieve_batch_max_queries} queries per request"
+        )
+    try:
+        requests = [(q.query, q.n_docs) for q in request.queries]
+        if not requests:
+            return {"responses": []}
+        results = await asyncio.get_running_loop().run_in_executor(search_executor, search_batch, requests)
+        return {"responses": [format_results(docs) for docs in results]}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/query_cache_stats")
+async def query_cache_stats():
+    return retriever.query_cache.stats()
+
+@app.on_event("shutdown")
+def save_query_cache():
+    # Persist the query embeddings so repeated task sets skip the encoder after a restart
+    retriever.query_cache.save()
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -1,9 +1,9 @@
 import os
 import argparse
 import json
-import pickle
 import time
-import glob
+from collections import defaultdict
+from collections.abc import Mapping
 from pathlib import Path
 
 import numpy as np
@@ -15,44 +15,65 @@ import src.contriever
 import src.utils
 import src.slurm
 import src.data
+import src.passage_store
+import src.embedding_shards
+import src.index_cache
+import src.query_cache
+import src.device
+import src.bucketing
+import src.bm25
+import src.fusion
 from src.evaluation import calculate_matches
 import src.normalize_text
+from generate_passage_embeddings import embed_passages, passage_text
 
 os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
 
 class Retriever:
-    def __init__(self, args, model=None, tokenizer=None) :
+    def __init__(self, args, model=None, tokenizer=None, query_cache=None, query_model=None) :
         self.args = args
-        self.model = model
+        self.model = model  # encodes passages
+        self.query_model = query_model if query_model is not None else model  # encodes queries, int8 with quantize_int8
         self.tokenizer = tokenizer
+        self.device = src.device.resolve_device(getattr(args, "device", "auto"))
+        # a cache passed in is shared with other retrievers (e.g. all Operator apps)
+        if query_cache is None and getattr(args, "query_cache_size", 0) > 0:
+            query_cache = src.query_cache.QueryEmbeddingCache(args.query_cache_size, getattr(args, "query_cache_path", None))
+        self.query_cache = query_cache
+        self.sparse_index = None  # BM25Index built next to the dense index when args.fusion is not "none"
+        self.kb_version = None  # version of the passages file the index was built from
+        self.kb = None  # SqliteKB the index follows, when built with setup_retriever_from_kb
+        self.kb_app = None
+        self.kb_cache_dir = None
+        self.kb_position = 0  # id of the last KB row indexed
 
     def embed_queries(self, args, queries):
-        embeddings, batch_question = [], []
-        with torch.no_grad():
-            for k, q in enumerate(queries):
-                if args.lowercase:
-                    q = q.lower()
-                if args.normalize_text:
-                    q = src.normalize_text.normalize(q)
-                batch_question.append(q)
-
-                if len(batch_question) == args.per_gpu_batch_size or k == len(queries) - 1:
-
-                    encoded_batch = self.tokenizer.batch_encode_plus(
-                        batch_question,
-                        return_tensors="pt",
-                        max_length=args.question_maxlength,
-                        padding=True,
-                        truncation=True,
-                    )
-                    encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-                    output = self.model(**encoded_batch)
-                    embeddings.append(output.cpu())
-
-                    batch_question = []
-
-        embeddings = torch.cat(embeddings, dim=0)
+        normalized = []
+        for q in queries:
+            if args.lowercase:
+                q = q.lower()
+            if args.normalize_text:
+                q = src.normalize_text.normalize(q)
+            normalized.append(q)
+        if self.query_cache is None:
+            return self.encode_queries(args, normalized)
+
+        keys = [src.query_cache.query_key(src.device.encoder_id(args), args.question_maxlength, q) for q in normalized]
+        embeddings = [self.query_cache.get(key) for key in keys]
+        # encode each distinct missing query once
+        missing = {key: q for key, q, e in zip(keys, normalized, embeddings) if e is None}
+        if missing:
+            encoded = dict(zip(missing, self.encode_queries(args, list(missing.values()))))
+            for key, e in encoded.items():
+                self.query_cache.put(key, e)
+            embeddings = [e if e is not None else encoded[key] for key, e in zip(keys, embeddings)]
+        return np.stack(embeddings)
+
+    def encode_queries(self, args, queries):
+        embeddings = src.bucketing.encode_length_bucketed(
+            self.query_model, self.tokenizer, queries, args.per_gpu_batch_size, args.question_maxlength, self.device
+        )
         print(f"Questions embeddings shape: {embeddings.size()}")
 
         return embeddings.numpy()
@@ -73,7 +94,7 @@ class Retriever:
                         padding=True,
                         truncation=True,
                     )
-                    encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
+                    encoded_batch = src.device.to_device(encoded_batch, self.device)
                     output = self.model(**encoded_batch)
                     embeddings.append(output.cpu())
 
@@ -84,81 +105,239 @@ class Retriever:
 
         return embeddings.numpy()
 
-    def index_encoded_data(self, index, embedding_files, indexing_batch_size):
-        allids = []
-        allembeddings = np.array([])
-        for i, file_path in enumerate(embedding_files):
+    def index_encoded_data(self, index, embedding_files, indexing_batch_size, partition=None):
+        # stream each shard into the index in slices, so peak memory is bounded by one slice
+        for file_path in embedding_files:
             print(f"Loading file {file_path}")
-            with open(file_path, "rb") as fin:
-                ids, embeddings = pickle.load(fin)
-
-            allembeddings = np.vstack((allembeddings, embeddings)) if allembeddings.size else embeddings
-            allids.extend(ids)
-            while allembeddings.shape[0] > indexing_batch_size:
-                allembeddings, allids = self.add_embeddings(index, allembeddings, allids, indexing_batch_size)
-
-        while allembeddings.shape[0] > 0:
-            allembeddings, allids = self.add_embeddings(index, allembeddings, allids, indexing_batch_size)
+            for ids, embeddings in src.embedding_shards.iter_shard_slices(file_path, indexing_batch_size):
+                if partition is not None:
+                    ids = [partition_key(partition, x) for x in ids]
+                index.index_data(ids, embeddings, partition=partition)
+        if partition is None:
+            index.flush()  # a partition is one of several; add_partitions trains once all are in
 
         print("Data indexing completed.")
 
 
-    def add_embeddings(self, index, embeddings, ids, indexing_batch_size):
-        end_idx = min(indexing_batch_size, embeddings.shape[0])
-        ids_toadd = ids[:end_idx]
-        embeddings_toadd = embeddings[:end_idx]
-        ids = ids[end_idx:]
-        embeddings = embeddings[end_idx:]
-        index.index_data(ids_toadd, embeddings_toadd)
-        return embeddings, ids
-
+    def append_passages(self, passages, embedding_cache=None):
+        # encode only the new passages with the loaded model and add them to the live index
+        ids, embeddings = embed_passages(self.args, passages, self.model, self.tokenizer, embedding_cache)
+        self.index.index_data(ids, embeddings)
+        self.index_sparse(passages)
+        self.passages.add(passages)
 
     def add_passages(self, passages, top_passages_and_scores):
         # add passages to original data
         docs = [passages[doc_id] for doc_id in top_passages_and_scores[0][0]]
         return docs
 
-    def setup_retriever(self):
+    def load_model(self):
+        if getattr(self.args, "onnx_model", None):
+            from src.onnx_encoder import load_onnx_encoder  # onnxruntime is only needed for this backend
+
+            print(f"Loading ONNX model from: {self.args.onnx_model}")
+            self.model, self.tokenizer = load_onnx_encoder(
+                self.args.onnx_model, num_threads=self.args.num_threads, use_cuda=self.device.type == "cuda"
+            )
+            self.query_model = self.model
+            return self.model, self.tokenizer
         print(f"Loading model from: {self.args.model_name_or_path}")
         self.model, self.tokenizer, _ = src.contriever.load_retriever(self.args.model_name_or_path)
-        self.model.eval()
-        self.model = self.model.cuda()
-        if not self.args.no_fp16:
-            self.model = self.model.half()
+        self.model, self.device = src.device.setup_encoder(self.args, self.model)
+        self.query_model = src.device.query_encoder(self.args, self.model, self.device)
+        return self.model, self.tokenizer
+
+    def memory_footprint(self):
+        # approximate resident bytes of the index and passages, excluding the (possibly shared) model
+        return self.index.memory_footprint() + self.passages.memory_footprint() + self.sparse_footprint()
+
+    def sparse_footprint(self):
+        return self.sparse_index.memory_footprint() if self.sparse_index is not None else 0
+
+    def index_fingerprint(self, input_paths):
+        # kb_version distinguishes an index that also holds passages appended since the shards were written
+        return src.index_cache.fingerprint(
+            input_paths, self.args.model_name_or_path, src.index_cache.index_config(self.args), self.kb_version
+        )
+
+    def index_cache_dir(self, input_paths):
+        # args.index_cache_dir, or next to the embedding shards
+        return getattr(self.args, "index_cache_dir", None) or os.path.dirname(input_paths[0])
+
+    def has_cached_index(self):
+        input_paths = src.embedding_shards.list_shards(self.args.passages_embeddings)
+        if not input_paths:
+            return False
+        return src.index_cache.read_fingerprint(self.index_cache_dir(input_paths)) == self.index_fingerprint(input_paths)
+
+    def save_index(self):
+        if self.kb is not None:
+            src.index_cache.save_index(
+                self.index, self.kb_cache_dir, self.kb_fingerprint(self.kb_position), kb_position=self.kb_position
+            )
+            return
+        input_paths = src.embedding_shards.list_shards(self.args.passages_embeddings)
+        src.index_cache.save_index(self.index, self.index_cache_dir(input_paths), self.index_fingerprint(input_paths))
+
+    def create_index(self):
+        return src.index.Indexer(
+            self.args.projection_size,
+            self.args.n_subquantizers,
+            self.args.n_bits,
+            index_spec=self.args.index_spec,
+            nprobe=self.args.nprobe,
+            ef_search=self.args.ef_search,
+        )
+
+    def create_sparse_index(self):
+        return src.bm25.BM25Index() if getattr(self.args, "fusion", "none") != "none" else None
+
+    def setup_retriever(self):
+        # a model passed to the constructor is shared with other retrievers and not reloaded
+        if self.model is None:
+            self.load_model()
 
-        self.index = src.index.Indexer(self.args.projection_size, self.args.n_subquantizers, self.args.n_bits)
+        self.index = self.create_index()
 
         # index all passages
-        input_paths = glob.glob(self.args.passages_embeddings)
-        input_paths = sorted(input_paths)
-        embeddings_dir = os.path.dirname(input_paths[0])
-        index_path = os.path.join(embeddings_dir, "index.faiss")
-        if self.args.save_or_load_index and os.path.exists(index_path):
-            self.index.deserialize_from(embeddings_dir)
+        input_paths = src.embedding_shards.list_shards(self.args.passages_embeddings)
+        index_cache_dir = self.index_cache_dir(input_paths)
+        # a serialized index is reused only if it was built from the same shards, model and index config
+        index_fingerprint = self.index_fingerprint(input_paths)
+        if self.args.save_or_load_index and src.index_cache.load_index(self.index, index_cache_dir, index_fingerprint):
+            print(f"Loaded cached index from {index_cache_dir}")
         else:
             print(f"Indexing passages from files {input_paths}")
             start_time_indexing = time.time()
             self.index_encoded_data(self.index, input_paths, self.args.indexing_batch_size)
             print(f"Indexing time: {time.time()-start_time_indexing:.1f} s.")
             if self.args.save_or_load_index:
-                self.index.serialize(embeddings_dir)
+                src.index_cache.save_index(self.index, index_cache_dir, index_fingerprint)
 
         # load passages
         print("loading passages")
-        self.passages = src.data.load_passages(self.args.passages)
-        self.passage_id_map = {x["id"]: x for x in self.passages}
+        self.passages = src.passage_store.PassageStore(self.args.passages, getattr(self.args, "passage_store_dir", None))
+        self.passage_id_map = self.passages
         print("passages have been loaded")
+        self.sparse_index = self.create_sparse_index()
+        self.index_sparse(self.passages.values())
+
+    def kb_fingerprint(self, kb_position):
+        return src.index_cache.fingerprint(
+            [], self.args.model_name_or_path, src.index_cache.index_config(self.args), ["sqlite", self.kb_app, kb_position]
+        )
+
+    def setup_retriever_from_kb(self, kb, app_name=None, cache_dir=None, embedding_caches=None):
+        """Build the index from the rows of an SQLite KB (src.kb_sqlite) and follow its change feed.
+
+        With `cache_dir`, the index is loaded from there as of the KB row it was saved at, and only
+        the rows appended since are embedded. `embedding_caches` maps an app to its EmbeddingCache.
+        """
+        if self.model is None:
+            self.load_model()
+        self.index = self.create_index()
+        self.sparse_index = self.create_sparse_index()
+        self.kb, self.kb_app, self.kb_cache_dir, self.kb_position = kb, app_name, cache_dir, 0
+        if cache_dir is not None and self.args.save_or_load_index:
+            kb_position = src.index_cache.read_kb_position(cache_dir)
+            if kb_position is not None and src.index_cache.load_index(self.index, cache_dir, self.kb_fingerprint(kb_position)):
+                print(f"Loaded cached index from {cache_dir} as of KB row {kb_position}")
+                self.kb_position = kb_position
+                if self.sparse_index is not None:
+                    # only the dense index is cached; the BM25 index is rebuilt from the rows it covers
+                    for groups, _ in self.kb_pages(0, kb_position):
+                        for app_name, passages in groups:
+                            self.index_kb_sparse(app_name, passages)
+        self.init_kb_passages()
+        if self.sync_from_kb(embedding_caches) and cache_dir is not None and self.args.save_or_load_index:
+            self.save_index()
+
+    def sync_from_kb(self, embedding_caches=None):
+        """Index the KB rows appended since the last sync; return how many there were."""
+        total = 0
+        for groups, last_id in self.kb_pages(self.kb_position):
+            for app_name, passages in groups:
+                embedding_cache = embedding_caches(app_name) if embedding_caches is not None else None
+                ids, embeddings = embed_passages(self.args, passages, self.model, self.tokenizer, embedding_cache)
+                self.index_kb_passages(app_name, ids, embeddings)
+                self.index_kb_sparse(app_name, passages)
+                total += len(passages)
+            self.kb_position = last_id
+        self.index.flush()
+        return total
+
+    def kb_pages(self, after_id, until_id=None):
+        # yield the KB rows in (after_id, until_id] a page at a time, as ([(app, passages)], last id of the page)
+        while True:
+            changes = self.kb.changes(after_id, self.kb_app, limit=self.args.indexing_batch_size)
+            if until_id is not None:
+                changes = [(app_name, p) for app_name, p in changes if int(p["id"]) <= until_id]
+            if not changes:
+                return
+            by_app = defaultdict(list)
+            for app_name, passage in changes:
+                by_app[app_name].append(passage)
+            after_id = int(changes[-1][1]["id"])
+            yield list(by_app.items()), after_id
+
+    def init_kb_passages(self):
+        self.passages = self.passage_id_map = self.kb.passages(self.kb_app)
+
+    def index_kb_passages(self, app_name, ids, embeddings):
+        self.index.index_data(ids, embeddings)
+
+    def index_kb_sparse(self, app_name, passages):
+        self.index_sparse(passages)
+
+    def index_sparse(self, passages, partition=None, chunk_size=10000):
+        # BM25 side of hybrid retrieval, over the same text the passages are embedded from
+        if self.sparse_index is None:
+            return
+        chunk = []
+        for p in passages:
+            chunk.append(p)
+            if len(chunk) == chunk_size:
+                self._index_sparse_chunk(chunk, partition)
+                chunk = []
+        self._index_sparse_chunk(chunk, partition)
+
+    def _index_sparse_chunk(self, passages, partition):
+        ids = [p["id"] if partition is None else partition_key(partition, p["id"]) for p in passages]
+        self.sparse_index.index_data(ids, [passage_text(self.args, p) for p in passages], partition=partition)
+
+    def search_index(self, queries, query_embeddings, n_docs, partition=None):
+        # dense search, fused with the BM25 ranking when hybrid retrieval is enabled
+        kwargs = {} if partition is None else {"partition": partition}
+        if self.sparse_index is None:
+            return self.index.search_knn(query_embeddings, n_docs, **kwargs)
+        n_candidates = max(n_docs, self.args.fusion_candidates)
+        dense = self.index.search_knn(query_embeddings, n_candidates, **kwargs)
+        sparse = self.sparse_index.search(queries, n_candidates, **kwargs)
+        return src.fusion.fuse(dense, sparse, self.args.fusion, n_docs, self.args.fusion_alpha, self.args.rrf_k)
 
     def search_document(self, query, top_n=10):
         questions_embedding = self.embed_queries(self.args, [query])
 
         # get top k results
         start_time_retrieval = time.time()
-        top_ids_and_scores = self.index.search_knn(questions_embedding, self.args.n_docs)
+        top_ids_and_scores = self.search_index([query], questions_embedding, self.args.n_docs)
         print(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
 
         return self.add_passages(self.passage_id_map, top_ids_and_scores)[:top_n]
     
+    def search_documents(self, queries, top_n, query_embeddings=None):
+        # batched search_document: one encoder pass and one search_knn call for all queries,
+        # with a per-query top_n (searched to the largest of them, at least args.n_docs)
+        if query_embeddings is None:
+            query_embeddings = self.embed_queries(self.args, queries)
+        start_time_retrieval = time.time()
+        top_ids_and_scores = self.search_index(queries, query_embeddings, max([self.args.n_docs, *top_n]))
+        print(f"Search time: {time.time()-start_time_retrieval:.1f} s for {len(queries)} queries.")
+        return [
+            [self.passage_id_map[doc_id] for doc_id in ids][:n]
+            for (ids, _), n in zip(top_ids_and_scores, top_n)
+        ]
+
     def search_document_demo(self, query, n_docs=10):
         questions_embedding = self.embed_queries_demo([query])
 
@@ -172,14 +351,12 @@ class Retriever:
     def setup_retriever_demo(self, model_name_or_path, passages, passages_embeddings, n_docs=5, save_or_load_index=False):
         print(f"Loading model from: {model_name_or_path}")
         self.model, self.tokenizer, _ = src.contriever.load_retriever(model_name_or_path)
-        self.model.eval()
-        self.model = self.model.cuda()
+        self.model = self.query_model = src.device.prepare_encoder(self.model, self.device, fp16=False)
 
         self.index = src.index.Indexer(768, 0, 8)
 
         # index all passages
-        input_paths = glob.glob(passages_embeddings)
-        input_paths = sorted(input_paths)
+        input_paths = src.embedding_shards.list_shards(passages_embeddings)
         embeddings_dir = os.path.dirname(input_paths[0])
         index_path = os.path.join(embeddings_dir, "index.faiss")
         if save_or_load_index and os.path.exists(index_path):
@@ -192,10 +369,139 @@ class Retriever:
 
         # load passages
         print("loading passages")
-        self.passages = src.data.load_passages(passages)
-        self.passage_id_map = {x["id"]: x for x in self.passages}
+        self.passages = src.passage_store.PassageStore(passages)
+        self.passage_id_map = self.passages
         print("passages have been loaded")
 
+class PartitionedRetriever(Retriever):
+    """Retriever over one index shared by several KBs (one per app for the Operator).
+
+    Every vector is tagged with the partition it was added to and searches are restricted to a single
+    partition, so the model and index are not duplicated per KB. Passage ids only need to be unique
+    within their partition.
+    """
+
+    def setup_retriever(self):
+        # start from an empty index; KBs are added with add_partition
+        if self.model is None:
+            self.load_model()
+        self.index = self.create_index()
+        self.sparse_index = self.create_sparse_index()
+        self.passages = {}  # partition -> PassageStore
+        self.passage_id_map = PartitionedPassages(self.passages)
+        self.kb_versions = {}  # partition -> version of the passages file it was indexed from
+
+    def add_partition(self, partition, passages_path, passages_embeddings, store_dir=None):
+        input_paths = src.embedding_shards.list_shards(passages_embeddings)
+        print(f"Indexing passages of {partition} from files {input_paths}")
+        start_time_indexing = time.time()
+        self.index_encoded_data(self.index, input_paths, self.args.indexing_batch_size, partition=partition)
+        print(f"Indexing time: {time.time()-start_time_indexing:.1f} s.")
+        self.passages[partition] = src.passage_store.PassageStore(passages_path, store_dir)
+        self.index_sparse(self.passages[partition].values(), partition)
+
+    def add_partitions(self, partitions, cache_dir=None, store_dirs=None):
+        """Index several partitions at once, given as {partition: (passages_path, passages_embeddings, kb_version)}.
+
+        With `cache_dir`, the combined index is reused from there when every partition still has the
+        same shards and passages version, and saved there after a rebuild. `store_dirs` maps a
+        partition to the directory of its passage store (default: next to its passages file).
+        """
+        store_dirs = store_dirs or {}
+        shards = {p: src.embedding_shards.list_shards(embeddings) for p, (_, embeddings, _) in partitions.items()}
+        index_fingerprint = src.index_cache.fingerprint(
+            [path for p in sorted(partitions) for path in shards[p]],
+            self.args.model_name_or_path,
+            src.index_cache.index_config(self.args),
+            [[p, partitions[p][2]] for p in sorted(partitions)],
+        )
+        if cache_dir is not None and src.index_cache.load_index(self.index, cache_dir, index_fingerprint):
+            print(f"Loaded cached index from {cache_dir}")
+            for partition, (passages_path, _, _) in partitions.items():
+                self.passages[partition] = src.passage_store.PassageStore(passages_path, store_dirs.get(partition))
+                self.index_sparse(self.passages[partition].values(), partition)
+        else:
+            for partition, (passages_path, embeddings, _) in partitions.items():
+                self.add_partition(partition, passages_path, embeddings, store_dirs.get(partition))
+            self.index.flush()
+            if cache_dir is not None:
+                src.index_cache.save_index(self.index, cache_dir, index_fingerprint)
+        for partition, (_, _, kb_version) in partitions.items():
+            self.kb_versions[partition] = kb_version
+
+    def append_passages(self, passages, partition, embedding_cache=None):
+        ids, embeddings = embed_passages(self.args, passages, self.model, self.tokenizer, embedding_cache)
+        self.index.index_data([partition_key(partition, x) for x in ids], embeddings, partition=partition)
+        self.index_sparse(passages, partition)
+        self.passages[partition].add(passages)
+
+    def memory_footprint(self):
+        passages = sum(store.memory_footprint() for store in self.passages.values())
+        return self.index.memory_footprint() + passages + self.sparse_footprint()
+
+    def init_kb_passages(self):
+        # the apps of a cached index, more are added as their rows are indexed
+        self.passages = {app_name: self.kb.passages(app_name) for app_name in self.index.partition_codes}
+        self.passage_id_map = PartitionedPassages(self.passages)
+
+    def index_kb_passages(self, app_name, ids, embeddings):
+        # one partition per app, as with the TSV KBs
+        if app_name not in self.passages:
+            self.passages[app_name] = self.kb.passages(app_name)
+        self.index.index_data([partition_key(app_name, x) for x in ids], embeddings, partition=app_name)
+
+    def index_kb_sparse(self, app_name, passages):
+        self.index_sparse(passages, app_name)
+
+    def search_document(self, query, top_n=10, partition=None):
+        questions_embedding = self.embed_queries(self.args, [query])
+
+        # get top k results within the partition
+        start_time_retrieval = time.time()
+        top_ids_and_scores = self.search_index([query], questions_embedding, self.args.n_docs, partition=partition)
+        print(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
+
+        return self.add_passages(self.passage_id_map, top_ids_and_scores)[:top_n]
+
+    def search_documents(self, queries, top_n, query_embeddings=None, partition=None):
+        if query_embeddings is None:
+            query_embeddings = self.embed_queries(self.args, queries)
+        start_time_retrieval = time.time()
+        top_ids_and_scores = self.search_index(
+            queries, query_embeddings, max([self.args.n_docs, *top_n]), partition=partition
+        )
+        print(f"Search time: {time.time()-start_time_retrieval:.1f} s for {len(queries)} queries.")
+        return [
+            [self.passage_id_map[doc_id] for doc_id in ids][:n]
+            for (ids, _), n in zip(top_ids_and_scores, top_n)
+        ]
+
+
+def partition_key(partition, passage_id):
+    return f"{partition}/{passage_id}"
+
+
+class PartitionedPassages(Mapping):
+    """Read-only view of the passage stores of all partitions, keyed by partition_key."""
+
+    def __init__(self, stores):
+        self.stores = stores
+
+    def __getitem__(self, key):
+        partition, _, passage_id = key.partition("/")
+        if partition not in self.stores:
+            raise KeyError(key)
+        return self.stores[partition][passage_id]
+
+    def __iter__(self):
+        for partition, store in self.stores.items():
+            for passage_id in store:
+                yield partition_key(partition, passage_id)
+
+    def __len__(self):
+        return sum(len(store) for store in self.stores.values())
+
+
 def add_hasanswer(data, hasanswer):
     # add hasanswer to data
     for i, ex in enumerate(data):
@@ -223,6 +529,8 @@ def main(args,query):
 
     question_text = query
     retrieved_docs = retriever.search_document(question_text, args.n_docs)
+    if retriever.query_cache is not None and args.query_cache_path:
+        retriever.query_cache.save()
 
     output = {
         "question": question_text,
@@ -257,6 +565,8 @@ if __name__ == "__main__":
     )
     parser.add_argument("--no_fp16", action="store_true", help="inference in fp32")
     parser.add_argument("--question_maxlength", type=int, default=512, help="Maximum number of tokens in a question")
+    parser.add_argument("--passage_maxlength", type=int, default=512, help="Maximum number of tokens in an appended passage")
+    parser.add_argument("--no_title", action="store_true", help="title not added to the appended passage body")
     parser.add_argument(
         "--indexing_batch_size", type=int, default=1000000, help="Batch size of the number of passages indexed"
     )
@@ -268,6 +578,30 @@ if __name__ == "__main__":
         help="Number of subquantizer used for vector quantization, if 0 flat index is used",
     )
     parser.add_argument("--n_bits", type=int, default=8, help="Number of bits per subquantizer")
+    parser.add_argument(
+        "--index_spec",
+        type=str,
+        default=None,
+        help="faiss index_factory string for an approximate index, e.g. 'IVF1024,Flat', 'IVF1024,PQ64' or 'HNSW32,Flat'",
+    )
+    parser.add_argument("--nprobe", type=int, default=16, help="Number of IVF lists visited per query")
+    parser.add_argument("--ef_search", type=int, default=64, help="Size of the HNSW candidate list at search time")
+    parser.add_argument("--query_cache_size", type=int, default=0, help="Number of query embeddings to cache, 0 disables the cache")
+    parser.add_argument("--query_cache_path", type=str, default=None, help="Optional .npz file the query cache is loaded from and saved to")
+    parser.add_argument("--device", type=str, default="auto", help="cuda, cpu or auto (cuda when available)")
+    parser.add_argument("--num_threads", type=int, default=0, help="Intra-op threads for CPU inference, 0 keeps the torch default")
+    parser.add_argument("--quantize_int8", action="store_true", help="Quantize the query encoder to int8 (CPU only)")
+    parser.add_argument("--onnx_model", type=str, default=None, help="Dir written by export_onnx.py; encode with onnxruntime instead of PyTorch")
+    parser.add_argument(
+        "--fusion",
+        type=str,
+        default="none",
+        choices=src.fusion.FUSION_METHODS,
+        help="Fuse the dense ranking with a BM25 ranking: reciprocal rank (rrf) or min-max normalized scores (weighted)",
+    )
+    parser.add_argument("--fusion_alpha", type=float, default=0.5, help="Weight of the dense ranking in the fusion")
+    parser.add_argument("--rrf_k", type=int, default=60, help="Rank offset of reciprocal rank fusion")
+    parser.add_argument("--fusion_candidates", type=int, default=20, help="Candidates taken from each ranking before fusion")
     parser.add_argument("--lang", nargs="+")
     parser.add_argument("--dataset", type=str, default="none")
     parser.add_argument("--lowercase", action="store_true", help="lowercase text before encoding")
@@ -1,7 +1,18 @@
-import requests
 import os
+import base64
+import asyncio
+import atexit
+import functools
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
 from datetime import datetime
 import json
+import requests
+from urllib3.exceptions import ConnectTimeoutError
+from src.http_client import get_client
 
 def download_images(
     docs,
@@ -13,12 +24,13 @@ def download_images(
     save_dir = os.path.join(base_save_dir, timestamp_folder)
     os.makedirs(save_dir, exist_ok=True)
 
+    client = get_client(server_url)
     for i, doc in enumerate(docs, 1):
         url = server_url + doc["image_url"]  # e.g. http://.../images/xxx.png
         filename = os.path.basename(doc["image_url"])
         local_path = os.path.join(save_dir, filename)
         try:
-            r = requests.get(url, timeout=30)
+            r = client.get(url, timeout=30)
             r.raise_for_status()
             with open(local_path, "wb") as f:
                 f.write(r.content)
@@ -29,35 +41,476 @@ def download_images(
     
     return save_dir  # Return save path for higher-level use
 
-def query_operator_server(query: str, server_url: str = "http://localhost:8002", n_docs: int = 1, save_images=True, base_save_dir="downloaded_images"):
-    # Step 1: Query the server
-    resp = requests.post(f"{server_url}/retrieve", json={"query": query, "n_docs": n_docs}, timeout=60)
+class ImageCache:
+    """Content-addressed cache of retrieved screenshots, stored as <cache_dir>/<App>/<id>-<hash>.jpg.
+
+    The screenshot of a KB entry never changes, so an image already in the cache costs no download and
+    no write: queries ask the server for the hash of each hit's image only, and the images missing
+    here are fetched afterwards in one /images_inline request. The oldest images are removed once the
+    cache holds more than `max_bytes`.
+    """
+
+    def __init__(self, cache_dir="downloaded_images/cache", max_bytes=512 * 2**20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()  # path -> size, oldest first
+        self.by_hash = {}  # (app, image hash) -> path; entries with identical screenshots share one
+        self.nbytes = 0
+        if os.path.isdir(cache_dir):
+            found = []
+            for app_name in os.listdir(cache_dir):
+                app_dir = os.path.join(cache_dir, app_name)
+                for name in os.listdir(app_dir) if os.path.isdir(app_dir) else []:
+                    if name.endswith(".jpg"):
+                        st = os.stat(os.path.join(app_dir, name))
+                        found.append((st.st_mtime, os.path.join(app_dir, name), st.st_size))
+            for _, path, size in sorted(found):
+                self._add(path, size)
+
+    def path(self, app_name, passage_id, image_hash):
+        return os.path.join(self.cache_dir, app_name, f"{passage_id}-{image_hash}.jpg")
+
+    def get(self, app_name, passage_id, image_hash):
+        path = self.path(app_name, passage_id, image_hash)
+        if path not in self.files:
+            path = self.by_hash.get((app_name, image_hash))
+        return path if path is not None and os.path.exists(path) else None
+
+    def _key(self, path):
+        return os.path.basename(os.path.dirname(path)), os.path.basename(path)[:-4].rsplit("-", 1)[-1]
+
+    def _add(self, path, size):
+        self.nbytes += size - self.files.pop(path, 0)
+        self.files[path] = size
+        self.by_hash[self._key(path)] = path
+
+    def put(self, app_name, passage_id, image_hash, data):
+        path = self.path(app_name, passage_id, image_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._add(path, len(data))
+        while self.nbytes > self.max_bytes and len(self.files) > 1:
+            old_path, size = self.files.popitem(last=False)
+            self.nbytes -= size
+            if self.by_hash.get(self._key(old_path)) == old_path:
+                del self.by_hash[self._key(old_path)]
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+        return path
+
+image_caches = {}  # base_save_dir -> ImageCache
+
+def get_image_cache(base_save_dir="downloaded_images"):
+    if base_save_dir not in image_caches:
+        image_caches[base_save_dir] = ImageCache(os.path.join(base_save_dir, "cache"))
+    return image_caches[base_save_dir]
+
+def store_inline_images(docs, image_cache):
+    # Point image_url of each hit at its cached file, writing the inline images not cached yet.
+    # Returns the hits that came without a usable image.
+    missing = []
+    for doc in docs:
+        app_name = doc["image_url"].split("/")[2]
+        image_hash = doc.get("image_hash")
+        image_b64 = doc.pop("image_b64", None)
+        doc.pop("image_mime", None)
+        path = image_cache.get(app_name, doc["id"], image_hash) if image_hash else None
+        if path is None and image_b64 is not None:
+            path = image_cache.put(app_name, doc["id"], image_hash, base64.b64decode(image_b64))
+        if path is None:
+            missing.append(doc)
+        else:
+            doc.pop("image_hash", None)
+            doc["image_url"] = os.path.abspath(path)
+    return missing
+
+def inline_images_payload(docs):
+    # /images_inline request for the hits whose image is not cached; hits without an image_hash come
+    # from a server without image_hashes_only and are left to download_images
+    docs = [doc for doc in docs if doc.get("image_hash")]
+    return docs, {"image_urls": [doc["image_url"] for doc in docs]}
+
+def store_fetched_images(docs, images, image_cache):
+    # Cache the /images_inline payloads of `docs`; returns the hits still without an image
+    for doc, image in zip(docs, images):
+        if image is not None:
+            doc.update(image)
+    return store_inline_images(docs, image_cache)
+
+def fetch_missing_images(missing, image_cache, client):
+    fetch, payload = inline_images_payload(missing)
+    rest = [doc for doc in missing if not doc.get("image_hash")]
+    if fetch:
+        resp = client.post("/images_inline", json=payload, timeout=60)
+        if resp.status_code in (404, 405):  # server without /images_inline
+            return missing
+        resp.raise_for_status()
+        rest += store_fetched_images(fetch, resp.json()["images"], image_cache)
+    return rest
+
+def retrieve_payload(query, n_docs, image_cache):
+    payload = {"query": query, "n_docs": n_docs}
+    if image_cache is not None:
+        payload["inline_images"] = True
+        payload["image_hashes_only"] = True
+    return payload
+
+def query_operator_server(query: str, server_url: str = "http://localhost:8002", n_docs: int = 1, save_images=True, base_save_dir="downloaded_images", inline_images=True):
+    # Step 1: Query the server; with inline_images the hits carry image hashes and only the screenshots
+    # missing from the local cache are fetched, inline, in one more request
+    image_cache = get_image_cache(base_save_dir) if save_images and inline_images else None
+    client = get_client(server_url)
+    resp = client.post("/retrieve", json=retrieve_payload(query, n_docs, image_cache), timeout=60)
     resp.raise_for_status()
     results = resp.json()["results"]
 
     # Step 2: Whether to save images
     if save_images:
-        save_path = download_images(results, server_url=server_url, base_save_dir=base_save_dir)
-        # print(f"Images saved to: {save_path}")
+        # hits still without an image (a server without inline_images) are downloaded as before
+        missing = store_inline_images(results, image_cache) if image_cache is not None else results
+        if missing and image_cache is not None:
+            missing = fetch_missing_images(missing, image_cache, client)
+        if missing:
+            download_images(missing, server_url=server_url, base_save_dir=base_save_dir)
 
     return results
 
-def upload_action_to_server(last_action, instruction, screenshot_path, server_url="http://localhost:8002"):
+async def aquery_operator_server(query: str, client, n_docs: int = 1, save_images=True, base_save_dir="downloaded_images", inline_images=True):
+    # async query_operator_server over a src.http_client_async.AsyncRAGClient
+    image_cache = get_image_cache(base_save_dir) if save_images and inline_images else None
+    resp = await client.post("/retrieve", json=retrieve_payload(query, n_docs, image_cache))
+    resp.raise_for_status()
+    results = resp.json()["results"]
+
+    if save_images:
+        missing = store_inline_images(results, image_cache) if image_cache is not None else results
+        if missing and image_cache is not None:
+            fetch, payload = inline_images_payload(missing)
+            if fetch:
+                fetched = await client.post("/images_inline", json=payload)
+                if fetched.status_code not in (404, 405):
+                    fetched.raise_for_status()
+                    rest = [doc for doc in missing if not doc.get("image_hash")]
+                    missing = rest + store_fetched_images(fetch, fetched.json()["images"], image_cache)
+        if missing:
+            await asyncio.get_running_loop().run_in_executor(
+                None, download_images, missing, client.base_url, base_save_dir
+            )
+
+    return results
+
+def query_operator_server_batch(queries, server_url: str = "http://localhost:8002", n_docs: int = 1, save_images=True, base_save_dir="downloaded_images", batch_size: int = 1024, inline_images=True):
+    # Many queries per request, possibly for different apps; a query is a string or a (query, n_docs)
+    # pair. Returns the results of each query in order, None for a query the server could not answer.
+    payloads = [
+        {"query": q, "n_docs": n_docs} if isinstance(q, str) else {"query": q[0], "n_docs": q[1]}
+        for q in queries
+    ]
+    image_cache = get_image_cache(base_save_dir) if save_images and inline_images else None
+    if image_cache is not None:
+        for payload in payloads:
+            payload["inline_images"] = True
+            payload["image_hashes_only"] = True
+    client = get_client(server_url)
+    results = []
+    for start in range(0, len(payloads), batch_size):
+        chunk = payloads[start:start + batch_size]
+        resp = client.post("/retrieve_batch", json={"queries": chunk}, timeout=60 + len(chunk))
+        resp.raise_for_status()
+        for payload, response in zip(chunk, resp.json()["responses"]):
+            if "error" in response:
+                print(f"Retrieval failed for {payload['query']!r}: {response['error']}")
+                results.append(None)
+            else:
+                results.append(response["results"])
+
+    if save_images:
+        docs = [doc for docs in results if docs for doc in docs]
+        missing = store_inline_images(docs, image_cache) if image_cache is not None else docs
+        if missing and image_cache is not None:
+            missing = [
+                doc for start in range(0, len(missing), batch_size)
+                for doc in fetch_missing_images(missing[start:start + batch_size], image_cache, client)
+            ]
+        if missing:
+            download_images(missing, server_url=server_url, base_save_dir=base_save_dir)
+
+    return results
+
+def format_action_text(last_action):
     action_name = last_action.get("name", "")
     action_args = last_action.get("arguments", {})
-    action_text = f"{action_name} at {json.dumps(action_args)}"
+    return f"{action_name} at {json.dumps(action_args)}"
+
+def upload_action_to_server(last_action, instruction, screenshot_path, server_url="http://localhost:8002"):
+    action_text = format_action_text(last_action)
 
     data = {
         "instruction": instruction,
         "action_text": action_text
     }
-    files = {
-        "screenshot": (os.path.basename(screenshot_path), open(screenshot_path, "rb"), "image/png")
-    }
-    resp = requests.post(f"{server_url}/append_tsv", data=data, files=files, timeout=60)
+    with open(screenshot_path, "rb") as f_img:
+        files = {
+            "screenshot": (os.path.basename(screenshot_path), f_img, "image/png")
+        }
+        resp = get_client(server_url).post("/append_tsv", data=data, files=files, timeout=60)
     resp.raise_for_status()
     print("Uploaded, new id:", resp.json().get("id"))
 
+class BackgroundUploader:
+    """Sends Operator KB updates from a background thread, off the agent's step loop.
+
+    submit() only snapshots the record (the screenshot file is overwritten on the next step) and
+    queues it, under a random key. The worker sends queued records in batches of up to `batch_size`,
+    one /append_batch request each, retrying failed sends with exponential backoff; the server does
+    not store a record whose key it has stored before, so a batch that did reach it can be resent.
+    Records it still cannot deliver, and records submitted while more than `max_pending_bytes` are
+    queued, are appended to a JSONL spool file; the spool is resent when the queue is idle and on
+    flush(), including spools left by an earlier process.
+    A resend moves the spool aside and streams it back in batches, so new records can be spooled
+    while it runs and only one batch of the spool is held in memory.
+    """
+
+    def __init__(self, server_url="http://localhost:8002", batch_size=8, max_pending_bytes=64 * 2**20,
+                 spool_path="upload_spool.jsonl", max_retries=3, backoff=1.0, spool_retry_interval=30.0):
+        self.server_url = server_url
+        self.batch_size = batch_size
+        self.max_pending_bytes = max_pending_bytes
+        self.spool_path = spool_path
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.spool_retry_interval = spool_retry_interval
+        self.queue = deque()
+        self.pending_bytes = 0
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.spool_lock = threading.Lock()  # held only while the spool file is appended to or moved
+        self.resend_lock = threading.Lock()  # one resend_spool at a time
+        self.last_spool_attempt = 0.0
+        self.batch_endpoint = True  # cleared if the server has no /append_batch
+        self.worker = None
+
+    def submit(self, instruction, action_text, screenshot_path):
+        with open(screenshot_path, "rb") as f_img:
+            record = {
+                "record_key": uuid.uuid4().hex,
+                "instruction": instruction,
+                "action_text": action_text,
+                "filename": os.path.basename(screenshot_path),
+                "screenshot": f_img.read(),
+            }
+        with self.cond:
+            full = self.pending_bytes + len(record["screenshot"]) > self.max_pending_bytes
+            if not full:
+                self.queue.append(record)
+                self.pending_bytes += len(record["screenshot"])
+                if self.worker is None or not self.worker.is_alive():
+                    self.worker = threading.Thread(target=self._run, name="kb-uploader", daemon=True)
+                    self.worker.start()
+                self.cond.notify_all()
+        if full:
+            self.spool([record])  # queue full: keep memory bounded without blocking the caller
+
+    def flush(self, timeout=None):
+        """Wait until every submitted record is sent or spooled, then try to send the spool once.
+        Returns the number of records left in the spool."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.queue or self.in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+        return self.resend_spool()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    idle = self.spool_retry_interval if self.has_spool() else None
+                    if not self.cond.wait(idle) and idle is not None:
+                        break  # idle with a spool pending: resend it below
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                self.in_flight = len(batch)
+            try:
+                if batch:
+                    failed = self.send_with_retries(batch)
+                    if failed:
+                        self.spool(failed)
+                elif time.monotonic() - self.last_spool_attempt >= self.spool_retry_interval:
+                    self.resend_spool()
+            finally:
+                with self.cond:
+                    self.pending_bytes -= sum(len(r["screenshot"]) for r in batch)
+                    self.in_flight = 0
+                    self.cond.notify_all()
+
+    def send_with_retries(self, records):
+        # returns the records that could not be delivered
+        for attempt in range(self.max_retries + 1):
+            records = self.send_batch(records)
+            if not records:
+                return []
+            if attempt < self.max_retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        return records
+
+    def send_batch(self, records):
+        # one /append_batch request for all records; servers without it get one /append_tsv per record
+        if self.batch_endpoint:
+            try:
+                resp = get_client(self.server_url).post(
+                    "/append_batch",
+                    # records spooled by a client without record keys send an empty one
+                    data=[(key, r.get(key, "")) for r in records for key in ("instruction", "action_text", "record_key")],
+                    files=[("screenshot", (r["filename"], r["screenshot"], "image/png")) for r in records],
+                    timeout=60 + 5 * len(records),
+                )
+                if resp.status_code in (404, 405):
+                    self.batch_endpoint = False
+                elif 400 <= resp.status_code < 500:
+                    # the server rejects the request itself (e.g. too many records); resending will not help
+                    print(f"Upload of {len(records)} records rejected ({resp.status_code}): {resp.text}")
+                    return []
+                else:
+                    resp.raise_for_status()
+                    result = resp.json()
+                    for i, error in result.get("errors", {}).items():
+                        # the server rejects the record itself (e.g. no App field); resending will not help
+                        print(f"Upload rejected: {records[int(i)]['instruction']!r}: {error}")
+                    print("Uploaded, new ids:", [x for x in result["ids"] if x is not None])
+                    return []
+            except Exception as e:
+                print(f"Upload failed: {e}")
+                return records
+        return self.send_each(records)
+
+    def send_each(self, records):
+        # /append_tsv has no record keys: only a request that never reached the server is sent again
+        client = get_client(self.server_url)
+        failed = []
+        for record in records:
+            try:
+                resp = client.post(
+                    "/append_tsv",
+                    data={"instruction": record["instruction"], "action_text": record["action_text"]},
+                    files={"screenshot": (record["filename"], record["screenshot"], "image/png")},
+                    timeout=60,
+                )
+                if 400 <= resp.status_code < 500:
+                    # the server rejects the record itself (e.g. no App field); resending will not help
+                    print(f"Upload rejected ({resp.status_code}): {resp.text}")
+                    continue
+                resp.raise_for_status()
+                print("Uploaded, new id:", resp.json().get("id"))
+            except Exception as e:
+                print(f"Upload failed: {e}")
+                if not_sent(e):
+                    failed.append(record)
+        return failed
+
+    def has_spool(self):
+        return any(os.path.exists(p) and os.path.getsize(p) > 0 for p in (self.spool_path, self.sending_path))
+
+    @property
+    def sending_path(self):
+        return self.spool_path + ".sending"
+
+    def spool(self, records):
+        with self.spool_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.spool_path)), exist_ok=True)
+            with open(self.spool_path, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(dict(record, screenshot=base64.b64encode(record["screenshot"]).decode("ascii"))) + "\n")
+
+    def read_spool(self, path):
+        # the records of a spool file, batch_size at a time; a line that cannot be read (e.g. cut short
+        # when the process was killed while spooling) is skipped, or it would stop every later resend
+        batch = []
+        with open(path, encoding="utf-8") as f:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    record["screenshot"] = base64.b64decode(record["screenshot"])
+                except (ValueError, KeyError, TypeError) as e:
+                    print(f"Skipping unreadable line {n} of {path}: {e!r}")
+                    continue
+                batch.append(record)
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def resend_spool(self):
+        # send the spooled records once; the ones that fail again go back to the spool
+        with self.resend_lock:
+            self.last_spool_attempt = time.monotonic()
+            with self.spool_lock:
+                # a .sending file left by a process that stopped mid-resend is sent first
+                if not os.path.exists(self.sending_path):
+                    if not self.has_spool():
+                        return 0
+                    os.replace(self.spool_path, self.sending_path)
+            failed = 0
+            for records in self.read_spool(self.sending_path):
+                # once a batch fails the server is likely down: keep the rest without trying them
+                records = self.send_batch(records) if not failed else records
+                if records:
+                    self.spool(records)
+                    failed += len(records)
+            os.remove(self.sending_path)
+            return failed
+
+def not_sent(error):
+    # whether a request failed before reaching the server (connection refused or timed out)
+    reason = getattr(error.args[0], "reason", None) if isinstance(error, requests.ConnectionError) and error.args else None
+    return isinstance(reason, ConnectTimeoutError)  # NewConnectionError is a subclass
+
+uploaders = {}  # server_url -> BackgroundUploader
+uploaders_lock = threading.Lock()
+
+def get_uploader(server_url="http://localhost:8002"):
+    with uploaders_lock:
+        if server_url not in uploaders:
+            uploaders[server_url] = BackgroundUploader(server_url)
+        return uploaders[server_url]
+
+def upload_action_in_background(last_action, instruction, screenshot_path, server_url="http://localhost:8002"):
+    # upload_action_to_server without waiting for the server: returns once the record is queued
+    get_uploader(server_url).submit(instruction, format_action_text(last_action), screenshot_path)
+
+def flush_action_uploads(timeout=None):
+    # task-finish hook: wait for the queued KB updates of all servers
+    for uploader in list(uploaders.values()):
+        left = uploader.flush(timeout)
+        if left:
+            print(f"{left} KB updates kept in {uploader.spool_path}, to be resent later")
+
+def flushes_action_uploads(func):
+    # decorator: flush_action_uploads whenever func returns or raises. The flush waits at most
+    # FLUSH_TIMEOUT for a down server, and its errors are logged without replacing func's result
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            try:
+                flush_action_uploads(FLUSH_TIMEOUT)
+            except Exception as e:
+                print(f"Flushing KB updates failed: {e!r}")
+    return wrapper
+
+FLUSH_TIMEOUT = 60  # seconds a task end or the process exit waits for queued KB updates
+atexit.register(flush_action_uploads, FLUSH_TIMEOUT)
+
 if __name__ == "__main__":
     # 示例：上传 last_action
 
@@ -1,20 +1,46 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-import argparse, os, json
+from typing import List
+import argparse, os
 import uvicorn
 import re
 import traceback
+import shutil
 import subprocess
 import random
+import asyncio
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from passage_retrieval_operator import Retriever
+from passage_retrieval_operator import Retriever, PartitionedRetriever
+from src.query_cache import QueryEmbeddingCache
+from src.microbatch import MicroBatcher
+from src.embedding_cache import EmbeddingCache
+from src.device import passage_encoder_id
+from src.kb_sqlite import SqliteKB
+from src.image_payload import ImagePayloadCache
+from src.passage_store import default_store_dir
+import src.data
+import src.index_cache
 
 app = FastAPI()
 
 # Image directory settings
 BASE_IMG_DIR = "mobile_eval_rag_retrieve/operator/app"
+os.makedirs(BASE_IMG_DIR, exist_ok=True)
 app.mount("/images", StaticFiles(directory=BASE_IMG_DIR), name="images")
+EMBEDDING_SCRIPT = "mobile_eval_rag_retrieve/operator/generate_embedding.sh"
+# Serialized indexes (of the partitioned layout, and of each app under app/<App>), kept outside the
+# statically served directory
+INDEX_CACHE_DIR = "mobile_eval_rag_retrieve/operator/index_cache"
+# Memory-mapped passage stores of the apps, likewise not served
+PASSAGE_STORE_DIR = "mobile_eval_rag_retrieve/operator/passage_store"
+# Passages of all apps with the sqlite KB backend
+KB_DB_PATH = "mobile_eval_rag_retrieve/operator/kb.sqlite3"
+# Keys of the records stored by /append_batch, see AppendKeyLog
+APPEND_KEYS_PATH = "mobile_eval_rag_retrieve/operator/append_keys.tsv"
 
 # Default parameter initialization
 args = argparse.Namespace(
@@ -24,14 +50,27 @@ args = argparse.Namespace(
     model_name_or_path="contriever-msmarco",
     per_gpu_batch_size=64,
     question_maxlength=512,
+    passage_maxlength=512,
+    no_title=False,
     no_fp16=False,
+    device=os.environ.get("RETRIEVAL_DEVICE", "auto"),  # "cpu" on GPU-less serving nodes
+    num_threads=int(os.environ.get("RETRIEVAL_NUM_THREADS", 0)),
+    quantize_int8=os.environ.get("RETRIEVAL_QUANTIZE_INT8", "0") == "1",  # int8 query encoder, CPU only
+    onnx_model=os.environ.get("RETRIEVAL_ONNX_MODEL"),  # dir written by export_onnx.py, encodes with onnxruntime
+    fusion=os.environ.get("RETRIEVAL_FUSION", "none"),  # "rrf" or "weighted": hybrid BM25 + dense ranking
+    fusion_alpha=0.5,  # weight of the dense ranking
+    rrf_k=60,
+    fusion_candidates=20,  # taken from each ranking before fusion
     lowercase=False,
     normalize_text=False,
     projection_size=768,
     n_subquantizers=0,
     n_bits=8,
+    index_spec=None,
+    nprobe=16,
+    ef_search=64,
     indexing_batch_size=1000000,
-    save_or_load_index=False,
+    save_or_load_index=True,
     output_dir=None,
     validation_workers=32,
     lang=None,
@@ -56,16 +95,153 @@ args = argparse.Namespace(
     use_gpu=True,
     save_index_path=None,
     load_index_path=None,
+    retriever_cache_max_bytes=int(os.environ.get("OPERATOR_RETRIEVER_CACHE_MB", 4096)) * 2**20,
+    kb_layout=os.environ.get("OPERATOR_KB_LAYOUT", "partitioned"),  # "partitioned": one index for all apps, "per_app": one retriever per app
+    kb_backend=os.environ.get("OPERATOR_KB_BACKEND", "tsv"),  # "tsv": app/<App>/passage.tsv, "sqlite": KB_DB_PATH
+    query_cache_size=10000,
+    query_cache_path="mobile_eval_rag_retrieve/operator/query_cache.npz",
+    retrieve_batch_size=32,  # most /retrieve queries encoded and searched together
+    retrieve_batch_wait_ms=5.0,  # how long the first query of a batch waits for others
+    retrieve_batch_max_queries=1024,  # most queries accepted by one /retrieve_batch request
+    inline_image_max_side=1024,  # inline_images: screenshots downscaled to fit this box, as JPEG
+    inline_image_quality=85,
+    inline_image_cache_mb=256,  # encoded inline images kept in memory
+    append_batch_max_records=10000,  # most records accepted by one /append_batch request
+    append_key_log_size=100000,  # /append_batch record keys remembered, so resent records are not stored twice
 )
 
-retriever_cache = {}  # Manage a separate retriever instance for each app
+
+class RetrieverCache:
+    """Per-app retrievers kept within a memory budget, least recently used evicted first.
+
+    The budget covers indexes and passages; the encoder is shared by all apps and not counted.
+    Evicted indexes are serialized to the index directory of the app and reloaded on the next query
+    without re-embedding, as long as passage.tsv has not changed in the meantime.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.retrievers = OrderedDict()
+        self.pinned = set()  # apps that must stay resident, see pin
+
+    def __contains__(self, app_name):
+        return app_name in self.retrievers
+
+    def get(self, app_name):
+        retriever = self.retrievers.get(app_name)
+        if retriever is not None:
+            self.retrievers.move_to_end(app_name)
+        return retriever
+
+    def put(self, app_name, retriever):
+        self.retrievers[app_name] = retriever
+        self.retrievers.move_to_end(app_name)
+        self.evict()
+
+    def memory_usage(self):
+        return sum(r.memory_footprint() for r in self.retrievers.values())
+
+    @contextmanager
+    def pin(self, app_names):
+        # keep the retrievers of `app_names` resident until the block ends, e.g. between indexing the
+        # apps of an append batch and adding the passages written in between; evicts the excess after
+        self.pinned.update(app_names)
+        try:
+            yield
+        finally:
+            self.pinned.difference_update(app_names)
+            self.evict()
+
+    def evict(self):
+        # always keep the most recently used retriever, even if it alone exceeds the budget
+        while len(self.retrievers) > 1 and self.memory_usage() > self.max_bytes:
+            app_name = next((name for name in list(self.retrievers)[:-1] if name not in self.pinned), None)
+            if app_name is None:
+                break
+            retriever = self.retrievers.pop(app_name)
+            # serialize the live index (including incrementally appended passages) for a lazy reload
+            retriever.save_index()
+            print(f"[INFO] Evicted retriever for App={app_name}")
+
+
+class AppendKeyLog:
+    """Client-generated keys of the records stored by /append_batch, with the id each was stored as.
+
+    A client resends a batch when it gets no answer (a read timeout while the KB thread builds an
+    index) or a 5xx, although the records may have been written already; records whose key is known
+    are not stored again. The `max_keys` most recent keys are kept in memory and in an append-only
+    file of key and id lines, which is rewritten with only those once it holds twice as many.
+    """
+
+    def __init__(self, path, max_keys):
+        self.path = path
+        self.max_keys = max_keys
+        self.ids = OrderedDict()
+        self.nlines = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    key, _, passage_id = line.rstrip("\n").partition("\t")
+                    if passage_id.isdigit():  # skips a line cut short by a crash
+                        self._remember(key, int(passage_id))
+                    self.nlines += 1
+
+    def get(self, key):
+        return self.ids.get(key)
+
+    def add(self, keys, ids):
+        pairs = [(key, passage_id) for key, passage_id in zip(keys, ids) if key and passage_id is not None]
+        if not pairs:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(f"{key}\t{passage_id}\n" for key, passage_id in pairs))
+        for key, passage_id in pairs:
+            self._remember(key, passage_id)
+        self.nlines += len(pairs)
+        if self.nlines > 2 * self.max_keys:
+            self._compact()
+
+    def _remember(self, key, passage_id):
+        self.ids[key] = passage_id
+        self.ids.move_to_end(key)
+        if len(self.ids) > self.max_keys:
+            self.ids.popitem(last=False)
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("".join(f"{key}\t{passage_id}\n" for key, passage_id in self.ids.items()))
+        os.replace(tmp_path, self.path)
+        self.nlines = len(self.ids)
+
+
+retriever_cache = RetrieverCache(args.retriever_cache_max_bytes)  # Manage a separate retriever instance for each app (per_app layout)
+shared_retriever = None  # One retriever with an app-partitioned index (partitioned layout)
+encoder = None  # {"model", "tokenizer", "query_model"} shared by all app retrievers
+query_cache = QueryEmbeddingCache(args.query_cache_size, args.query_cache_path)  # shared by all app retrievers
+embedding_caches = {}  # app name -> EmbeddingCache of its passages, shared with generate_embedding.sh
+kb = SqliteKB(KB_DB_PATH) if args.kb_backend == "sqlite" else None
+seeded_apps = set()  # apps known to have rows in the sqlite KB
+append_keys = AppendKeyLog(APPEND_KEYS_PATH, args.append_key_log_size)  # only used on the KB thread
+image_payloads = ImagePayloadCache(
+    args.inline_image_cache_mb * 2**20, args.inline_image_max_side, args.inline_image_quality
+)
 
 class QueryRequest(BaseModel):
     query: str
     n_docs: int = 3
+    inline_images: bool = False  # return each hit's screenshot in the response instead of only its /images URL
+    image_hashes_only: bool = False  # inline_images: only each hit's image_hash; the client fetches the images it has not cached with /images_inline
+
+class BatchQueryRequest(BaseModel):
+    queries: List[QueryRequest]
+
+class InlineImagesRequest(BaseModel):
+    image_urls: List[str]  # image_url of hits, e.g. /images/<App>/images/<id>.png
 
 def extract_app_name(query):
-    match = re.search(r"App:/s*([/w/-]+)", query, re.IGNORECASE)
+    match = re.search(r"App:\s*([\w\-]+)", query, re.IGNORECASE)
     return match.group(1) if match else None
 
 def get_app_paths(app_name):
@@ -75,18 +251,38 @@ def get_app_paths(app_name):
         "app_dir": app_dir,
         "tsv": os.path.join(app_dir, "passage.tsv"),
         "img_dir": os.path.join(app_dir, "images"),
-        "embedding_dir": os.path.join(app_dir, "embedding")
+        "embedding_dir": os.path.join(app_dir, "embedding"),
+        "store_dir": os.path.join(PASSAGE_STORE_DIR, app_name),
+        "index_dir": os.path.join(INDEX_CACHE_DIR, "app", app_name)
     }
 
-def get_or_create_retriever(app_name, update_embedding=True):
-    # If there is already a cache and no update is needed, directly return the cached retriever
-    if app_name in retriever_cache and not update_embedding:
-        return retriever_cache[app_name]
+def get_kb_version(tsv_path):
+    # Version of an app KB: changes whenever passage.tsv is appended to or rewritten
+    if not os.path.exists(tsv_path):
+        return None
+    stat = os.stat(tsv_path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def get_encoder():
+    global encoder
+    if encoder is None:
+        # passages are embedded by the full-precision model, queries by its int8 copy with RETRIEVAL_QUANTIZE_INT8
+        retriever = Retriever(args, query_cache=query_cache)
+        retriever.load_model()
+        encoder = {"model": retriever.model, "tokenizer": retriever.tokenizer, "query_model": retriever.query_model}
+    return encoder
+
+def get_embedding_cache(app_name):
+    # Appended passages are cached so that the next full re-embedding of the app does not encode them again
+    if app_name not in embedding_caches:
+        cache_dir = os.path.join(get_app_paths(app_name)["embedding_dir"], "cache")
+        embedding_caches[app_name] = EmbeddingCache(cache_dir, passage_encoder_id(args), args.passage_maxlength)
+    return embedding_caches[app_name]
 
+def init_app_kb(app_name):
+    # Create the image directory, placeholder image and passage.tsv of an app seen for the first time
     paths = get_app_paths(app_name)
     tsv_path = paths["tsv"]
-    embedding_dir = paths["embedding_dir"]
-    embedding_file = os.path.join(embedding_dir, "passages_00")
     img_dir = paths["img_dir"]
 
     if not os.path.exists(img_dir):
@@ -114,44 +310,404 @@ def get_or_create_retriever(app_name, update_embedding=True):
             print(f"[ERROR] Failed to generate or save '1.png': {e}")
             raise
     
+    os.makedirs(paths["embedding_dir"], exist_ok=True)
+    remove_legacy_caches(paths)
+    if kb is not None:
+        seed_kb_app(app_name, tsv_path)
+        return paths
+
     # If passage.tsv does not exist, create it and write an initial entry
     if not os.path.exists(tsv_path):
         os.makedirs(os.path.dirname(tsv_path), exist_ok=True)
         try:
             with open(tsv_path, "w", encoding="utf-8") as f:
-                f.write("1/tImage: 1.png/ttest/n")  # Initial entry: 1 <tab> Image: 1.png <tab> test
+                f.write("1\tImage: 1.png\ttest\n")  # Initial entry: 1 <tab> Image: 1.png <tab> test
             print(f"[INFO] Created new passage.tsv for App={app_name} and wrote initial entry.")
         except IOError as e:
             print(f"[ERROR] Failed to create passage.tsv: {e}")
             raise RuntimeError(f"Unable to create passage.tsv for App={app_name}")
 
-    # Ensure the embedding directory exists
-    os.makedirs(embedding_dir, exist_ok=True)
+    return paths
 
-    # If the embedding file does not exist or needs to be updated, call the embedding generation script
-    if not os.path.exists(embedding_file) or update_embedding:
-        print(f"[INFO] {'Generating new embedding' if update_embedding else 'Embedding file not found'}, running generate_embedding.sh for App={app_name}")
-        try:
-            subprocess.run([
-                "bash",
-                "mobile_eval_rag_retrieve/operator/app/generate_embedding.sh",
-                app_name
-            ], check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"[ERROR] Failed to generate embedding: {e}")
-            raise RuntimeError(f"Embedding initialization failed for App={app_name}")
+def remove_legacy_caches(paths):
+    # The passage store and index caches that earlier versions kept in the app directory would be
+    # served under /images; they are rebuilt in store_dir and index_dir
+    for legacy_dir in (default_store_dir(paths["tsv"]), os.path.join(paths["embedding_dir"], "sqlite_index")):
+        if os.path.isdir(legacy_dir):
+            shutil.rmtree(legacy_dir, ignore_errors=True)
+    for name in src.index_cache.INDEX_FILES + (src.index_cache.FINGERPRINT_FILE,):
+        legacy_path = os.path.join(paths["embedding_dir"], name)
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+
+def seed_kb_app(app_name, tsv_path):
+    # sqlite backend: start the KB of an app with its existing passage.tsv, or with the same initial entry
+    with kb.transaction() as txn:
+        if kb.has_app(app_name):
+            return
+        if os.path.exists(tsv_path):
+            passages = src.data.load_passages(tsv_path)
+            print(f"[INFO] Importing {len(passages)} passages of App={app_name} from {tsv_path}")
+            # rows get new ids, but their screenshots keep the file names of the TSV ids: new rows must
+            # not get one of those ids, or their screenshot would overwrite an imported one
+            txn.reserve_ids(max((int(p["id"]) for p in passages if str(p["id"]).isdigit()), default=0))
+        else:
+            passages = [{"title": "test", "text": "Image: 1.png"}]
+        txn.insert(app_name, passages)
+
+def get_embedding_file(app_name):
+    return os.path.join(get_app_paths(app_name)["embedding_dir"], "passages_00")
+
+def update_app_embeddings(app_names, update_embedding=False):
+    # Re-embed the apps whose embedding file does not exist, is older than passage.tsv or needs to be
+    # updated, all in one run of the embedding generation script so the model is loaded only once
+    stale = []
+    for app_name in app_names:
+        tsv_path = get_app_paths(app_name)["tsv"]
+        embedding_file = get_embedding_file(app_name)
+        if update_embedding or not os.path.exists(embedding_file) or os.path.getmtime(tsv_path) > os.path.getmtime(embedding_file):
+            stale.append(app_name)
+    if not stale:
+        return
+    print(f"[INFO] Running generate_embedding.sh for App={', '.join(stale)}")
+    env = dict(os.environ, FORCE="1") if update_embedding else None
+    try:
+        subprocess.run(["bash", EMBEDDING_SCRIPT] + stale, check=True, env=env)
+    except subprocess.CalledProcessError as e:
+        print(f"[ERROR] Failed to generate embedding: {e}")
+        raise RuntimeError(f"Embedding initialization failed for App={', '.join(stale)}")
+
+def update_app_embedding(app_name, update_embedding=False):
+    update_app_embeddings([app_name], update_embedding)
+    return get_embedding_file(app_name)
+
+def get_or_create_retriever(app_name, update_embedding=False):
+    paths = get_app_paths(app_name)
+
+    # If there is already a cache for the current KB version and no update is needed, directly return the cached retriever
+    cached = retriever_cache.get(app_name)
+    if cached is not None and not update_embedding and cached.kb_version == get_kb_version(paths["tsv"]):
+        return cached
+
+    init_app_kb(app_name)
+    tsv_path = paths["tsv"]
+    embedding_dir = paths["embedding_dir"]
+    embedding_file = os.path.join(embedding_dir, "passages_00")
 
     # Set retriever parameters
     local_args = argparse.Namespace(**vars(args))
     local_args.passages = tsv_path
     local_args.passages_embeddings = embedding_file
+    local_args.passage_store_dir = paths["store_dir"]
+    local_args.index_cache_dir = paths["index_dir"]
 
-    retriever = Retriever(local_args)
+    retriever = Retriever(local_args, query_cache=query_cache, **get_encoder())
+    retriever.kb_version = get_kb_version(tsv_path)
+    # An index cached for the current passage.tsv (e.g. serialized on eviction) makes re-embedding unnecessary
+    if update_embedding or not (args.save_or_load_index and retriever.has_cached_index()):
+        update_app_embedding(app_name, update_embedding)
     retriever.setup_retriever()
 
-    retriever_cache[app_name] = retriever
+    retriever_cache.put(app_name, retriever)
     return retriever
 
+def list_apps():
+    return sorted(
+        name for name in os.listdir(BASE_IMG_DIR)
+        if os.path.exists(os.path.join(BASE_IMG_DIR, name, "passage.tsv"))
+    )
+
+def add_app_partition(app_name):
+    paths = init_app_kb(app_name)
+    embedding_file = update_app_embedding(app_name)
+    shared_retriever.add_partition(app_name, paths["tsv"], embedding_file, paths["store_dir"])
+    shared_retriever.kb_versions[app_name] = get_kb_version(paths["tsv"])
+
+def build_shared_index():
+    # Index every app KB on disk, or load the cached index if none of them changed since it was saved
+    app_names = list_apps()
+    for name in app_names:
+        init_app_kb(name)
+    update_app_embeddings(app_names)
+    partitions = {}
+    for name in app_names:
+        tsv_path = get_app_paths(name)["tsv"]
+        partitions[name] = (tsv_path, get_embedding_file(name), get_kb_version(tsv_path))
+    shared_retriever.setup_retriever()
+    shared_retriever.add_partitions(
+        partitions,
+        cache_dir=INDEX_CACHE_DIR if args.save_or_load_index else None,
+        store_dirs={name: get_app_paths(name)["store_dir"] for name in app_names},
+    )
+
+def get_shared_retriever(app_name):
+    global shared_retriever
+    if shared_retriever is None:
+        shared_retriever = PartitionedRetriever(args, query_cache=query_cache, **get_encoder())
+        build_shared_index()
+
+    if app_name not in shared_retriever.kb_versions:
+        # A new app only adds its own partition; the rest of the index is untouched
+        add_app_partition(app_name)
+    elif shared_retriever.kb_versions[app_name] != get_kb_version(get_app_paths(app_name)["tsv"]):
+        # passage.tsv was changed outside this server: rebuild the shared index from the embedding files
+        print(f"[INFO] KB of App={app_name} changed on disk, rebuilding the shared index")
+        build_shared_index()
+    return shared_retriever
+
+def get_kb_retriever(app_name):
+    # sqlite backend: the retrievers follow the change feed of the KB, so rows appended by this server
+    # or by another writer since the last call are indexed incrementally
+    global shared_retriever
+    if app_name not in seeded_apps:
+        init_app_kb(app_name)
+        seeded_apps.add(app_name)
+    if args.kb_layout == "partitioned":
+        if shared_retriever is None:
+            retriever = PartitionedRetriever(args, query_cache=query_cache, **get_encoder())
+            retriever.setup_retriever_from_kb(
+                kb, cache_dir=os.path.join(INDEX_CACHE_DIR, "sqlite"), embedding_caches=get_embedding_cache
+            )
+            shared_retriever = retriever
+        shared_retriever.sync_from_kb(get_embedding_cache)
+        return shared_retriever
+
+    retriever = retriever_cache.get(app_name)
+    if retriever is None:
+        retriever = Retriever(args, query_cache=query_cache, **get_encoder())
+        retriever.setup_retriever_from_kb(
+            kb,
+            app_name,
+            cache_dir=os.path.join(get_app_paths(app_name)["index_dir"], "sqlite"),
+            embedding_caches=get_embedding_cache,
+        )
+        retriever_cache.put(app_name, retriever)
+    elif retriever.sync_from_kb(get_embedding_cache):
+        retriever_cache.evict()
+    return retriever
+
+def load_app_kb(app_name):
+    # Make sure the app KB is indexed and up to date before it is searched or appended to
+    if kb is not None:
+        return get_kb_retriever(app_name)
+    if args.kb_layout == "partitioned":
+        return get_shared_retriever(app_name)
+    return get_or_create_retriever(app_name)
+
+def append_app_kb(app_name, passages):
+    # Encode only the new passages with the resident model and add them to the live index.
+    # load_app_kb must have been called before the passages were written to passage.tsv.
+    tsv_path = get_app_paths(app_name)["tsv"]
+    if args.kb_layout == "partitioned":
+        shared_retriever.append_passages(passages, partition=app_name, embedding_cache=get_embedding_cache(app_name))
+        shared_retriever.kb_versions[app_name] = get_kb_version(tsv_path)
+    else:
+        retriever = retriever_cache.get(app_name)
+        retriever.append_passages(passages, embedding_cache=get_embedding_cache(app_name))
+        retriever.kb_version = get_kb_version(tsv_path)
+        retriever_cache.evict()
+
+def search_batch(requests):
+    # Answer a micro-batch of (app_name, query, n_docs): one encoder pass for all queries, then
+    # one search per app. A failure is returned in place of the results of that app's queries.
+    results = [None] * len(requests)
+    by_app = defaultdict(list)
+    for i, (app_name, _, _) in enumerate(requests):
+        by_app[app_name].append(i)
+
+    query_embeddings = None
+    for app_name, indices in by_app.items():
+        try:
+            retriever = load_app_kb(app_name)
+            if query_embeddings is None:
+                # all retrievers share the encoder, so any of them can embed the whole batch
+                query_embeddings = retriever.embed_queries(args, [query for _, query, _ in requests])
+            kwargs = {"partition": app_name} if args.kb_layout == "partitioned" else {}
+            docs = retriever.search_documents(
+                [requests[i][1] for i in indices],
+                [requests[i][2] for i in indices],
+                query_embeddings=query_embeddings[indices],
+                **kwargs,
+            )
+            for i, d in zip(indices, docs):
+                results[i] = d
+        except Exception as e:
+            traceback.print_exc()
+            for i in indices:
+                results[i] = e
+    return results
+
+# Every read and write of the retrievers runs on this one thread, off the event loop
+kb_executor = ThreadPoolExecutor(max_workers=1)
+retrieve_batcher = MicroBatcher(search_batch, args.retrieve_batch_size, args.retrieve_batch_wait_ms, executor=kb_executor)
+
+async def run_in_kb_thread(func, *func_args):
+    return await asyncio.get_running_loop().run_in_executor(kb_executor, func, *func_args)
+
+def read_last_id(tsv_path, chunk_size=4096):
+    # id of the last passage in passage.tsv, read from the end of the file instead of every line
+    if not os.path.exists(tsv_path):
+        return 0
+    with open(tsv_path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        tail = b""
+        while end > 0:
+            start = max(0, end - chunk_size)
+            f.seek(start)
+            tail = f.read(end - start) + tail
+            end = start
+            lines = [l for l in tail.split(b"\n") if l.strip()]
+            # the first line of the tail may be cut off unless the whole file has been read
+            if len(lines) > 1 or (lines and end == 0):
+                return int(lines[-1].split(b"\t")[0])
+    return 0
+
+def save_screenshot(img_dir, passage_id, image):
+    # image: the screenshot bytes, a file object (an uploaded file) copied over in chunks, or a path
+    image_path = os.path.join(img_dir, f"{passage_id}.png")
+    if isinstance(image, str):
+        shutil.copyfile(image, image_path)
+        return image_path
+    with open(image_path, "wb") as f_img:
+        if hasattr(image, "read"):
+            image.seek(0)
+            shutil.copyfileobj(image, f_img)
+        else:
+            f_img.write(image)
+    return image_path
+
+def make_passage(passage_id, instruction, action_text, image_path):
+    return {
+        "id": str(passage_id),
+        "title": f"subtask: {instruction}",
+        "text": f"Action: {action_text}. Image: {image_path}",
+        "image": image_path,
+    }
+
+def append_passage_record(app_name, instruction, action_text, image_bytes):
+    return append_passage_records([(app_name, instruction, action_text, image_bytes)])[0]
+
+def append_passage_records(records, keys=None):
+    # Save the screenshots, append the passages of [(app_name, instruction, action_text, image)] to
+    # the KB and index them; returns their ids in order. Each app's passages are written with one
+    # passage.tsv write (or all apps in one sqlite transaction), then encoded in one batched forward
+    # pass and added to the index once. Runs on the KB thread so no search sees the KB and the index
+    # out of step. `keys` (one per record, or None) are logged as stored as soon as the rows are written.
+    app_names = list(dict.fromkeys(app_name for app_name, _, _, _ in records))
+
+    # Make sure the app KBs are indexed (reloaded lazily if evicted) before they change. Loading a later
+    # app must not evict an earlier one: its index would then be rebuilt from passage.tsv, new rows included
+    with retriever_cache.pin(app_names):
+        for app_name in app_names:
+            load_app_kb(app_name)
+
+        ids, appended = write_passage_records(records)
+        if keys is not None:
+            append_keys.add(keys, ids)
+        for app_name, passages in appended.items():
+            if kb is not None:
+                load_app_kb(app_name)  # indexes the new rows from the change feed
+            else:
+                append_app_kb(app_name, passages)
+    return ids
+
+def append_keyed_records(records, keys):
+    # append_passage_records for /append_batch: a record whose key was stored before (its batch is
+    # being resent) gets its earlier id and is not written again
+    ids = [append_keys.get(key) if key else None for key in keys]
+    new = [i for i, passage_id in enumerate(ids) if passage_id is None]
+    if new:
+        new_ids = append_passage_records([records[i] for i in new], [keys[i] for i in new])
+        for i, new_id in zip(new, new_ids):
+            ids[i] = new_id
+    return ids
+
+def write_passage_records(records):
+    # The write half of append_passage_records, without indexing: returns the ids in order and the
+    # new passages of each app. The app KBs must exist (init_app_kb).
+    by_app = defaultdict(list)
+    for i, (app_name, _, _, _) in enumerate(records):
+        by_app[app_name].append(i)
+    ids = [None] * len(records)
+    appended = {}
+
+    def make_passages(app_name, indices, new_id):
+        img_dir = get_app_paths(app_name)["img_dir"]
+        os.makedirs(img_dir, exist_ok=True)
+        passages = []
+        for i in indices:
+            _, instruction, action_text, image = records[i]
+            passages.append(make_passage(new_id, instruction, action_text, save_screenshot(img_dir, new_id, image)))
+            ids[i] = new_id
+            new_id += 1
+        appended[app_name] = passages
+        return passages
+
+    if kb is not None:
+        # ids are allocated, screenshots saved and rows inserted in one transaction
+        with kb.transaction() as txn:
+            new_id = txn.next_id()
+            for app_name, indices in by_app.items():
+                txn.insert(app_name, make_passages(app_name, indices, new_id))
+                new_id += len(indices)
+        return ids, appended
+
+    for app_name, indices in by_app.items():
+        tsv_path = get_app_paths(app_name)["tsv"]
+        passages = make_passages(app_name, indices, read_last_id(tsv_path) + 1)
+        with open(tsv_path, "a", encoding="utf-8") as f_tsv:
+            f_tsv.write("".join(f"{p['id']}\t{p['text']}\t{p['title']}\n" for p in passages))
+    return ids, appended
+
+def save_kb_indexes():
+    # sqlite backend: after a restart only the rows appended from now on need to be embedded
+    if kb is None or not args.save_or_load_index:
+        return
+    for retriever in [shared_retriever] + list(retriever_cache.retrievers.values()):
+        if retriever is not None:
+            retriever.save_index()
+
+def image_url_path(image_url):
+    # file served at an /images URL, or None if the URL is outside BASE_IMG_DIR
+    if not image_url.startswith("/images/"):
+        return None
+    base_dir = os.path.realpath(BASE_IMG_DIR)
+    path = os.path.realpath(os.path.join(base_dir, image_url[len("/images/"):]))
+    return path if path.startswith(base_dir + os.sep) else None
+
+def format_results(app_name, raw, inline_images=False, image_hashes_only=False):
+    docs = []
+    for doc in raw:
+        full_path = doc["text"].split("Image:")[-1].strip()
+        filename = os.path.basename(full_path)
+        image_url = f"/images/{app_name}/images/{filename}"
+        result = {
+            "id": doc["id"],
+            "query": doc["title"],
+            "answer": doc["text"],
+            "image_url": image_url
+        }
+        if inline_images:
+            if not os.path.exists(full_path):
+                full_path = os.path.join(BASE_IMG_DIR, app_name, "images", filename)
+            # adds image_hash, image_b64 and image_mime; left out if the screenshot cannot be read
+            if image_hashes_only:
+                image_hash = image_payloads.image_hash(full_path)
+                payload = {"image_hash": image_hash} if image_hash is not None else None
+            else:
+                payload = image_payloads.get(full_path)
+            result.update(payload or {})
+        docs.append(result)
+    return {"results": docs}
+
+async def format_results_async(app_name, raw, request):
+    if not request.inline_images:
+        return format_results(app_name, raw)
+    # reading and encoding screenshots stays off the event loop
+    return await asyncio.get_running_loop().run_in_executor(
+        None, format_results, app_name, raw, True, request.image_hashes_only
+    )
+
 @app.post("/retrieve")
 async def retrieve_documents(request: QueryRequest):
     try:
@@ -159,26 +715,56 @@ async def retrieve_documents(request: QueryRequest):
         if not app_name:
             raise HTTPException(status_code=400, detail="Missing App field in Query")
 
-        retriever = get_or_create_retriever(app_name)
-        raw = retriever.search_document(request.query, request.n_docs)
-
-        paths = get_app_paths(app_name)
-        docs = []
-        for doc in raw:
-            full_path = doc["text"].split("Image:")[-1].strip()
-            filename = os.path.basename(full_path)
-            image_url = f"/images/{app_name}/images/{filename}"
-            docs.append({
-                "id": doc["id"],
-                "query": doc["title"],
-                "answer": doc["text"],
-                "image_url": image_url
-            })
-        return {"results": docs}
+        raw = await retrieve_batcher.submit((app_name, request.query, request.n_docs))
+        return await format_results_async(app_name, raw, request)
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/retrieve_batch")
+async def retrieve_documents_batch(request: BatchQueryRequest):
+    # Many queries in one request, possibly for different apps: one encoder pass for all of them and
+    # one search per app. The responses are in query order, each shaped like a /retrieve response;
+    # a query that fails (no App field, KB that cannot be loaded) gets {"error": ...} instead.
+    if len(request.queries) > args.retrieve_batch_max_queries:
+        raise HTTPException(
+            status_code=400, detail=f"At most {args.retrieve_batch_max_queries} queries per request"
+        )
+    try:
+        responses = [None] * len(request.queries)
+        requests, indices = [], []
+        for i, q in enumerate(request.queries):
+            app_name = extract_app_name(q.query)
+            if not app_name:
+                responses[i] = {"error": "Missing App field in Query"}
+                continue
+            requests.append((app_name, q.query, q.n_docs))
+            indices.append(i)
+
+        results = await run_in_kb_thread(search_batch, requests) if requests else []
+        for i, (app_name, _, _), raw in zip(indices, requests, results):
+            if isinstance(raw, BaseException):
+                responses[i] = {"error": str(raw)}
+            else:
+                responses[i] = await format_results_async(app_name, raw, request.queries[i])
+        return {"responses": responses}
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/images_inline")
+async def images_inline(request: InlineImagesRequest):
+    # Inline payloads of the screenshots behind /images URLs, in request order (None if unreadable):
+    # the images an image_hashes_only query returned that the client has not cached
+    if len(request.image_urls) > args.retrieve_batch_max_queries:
+        raise HTTPException(status_code=400, detail=f"At most {args.retrieve_batch_max_queries} images per request")
+
+    def load(image_urls):
+        paths = [image_url_path(url) for url in image_urls]
+        return [image_payloads.get(path) if path is not None else None for path in paths]
+
+    return {"images": await asyncio.get_running_loop().run_in_executor(None, load, request.image_urls)}
+
 @app.post("/append_tsv")
 async def append_tsv(
     instruction: str = Form(...),
@@ -190,42 +776,66 @@ async def append_tsv(
         if not app_name:
             raise HTTPException(status_code=400, detail="Missing App field in Instruction")
 
-        paths = get_app_paths(app_name)
-        tsv_path = paths["tsv"]
-        embedding_dir = paths["embedding_dir"]
-        embedding_file = os.path.join(embedding_dir, "passages_00")
-        img_dir = paths["img_dir"]
-
-        if not os.path.exists(tsv_path):
-            last_id = 0
-        else:
-            with open(tsv_path, "r", encoding="utf-8") as f:
-                lines = [l for l in f.readlines() if l.strip()]
-                last_id = int(lines[-1].split("/t")[0]) if lines else 0
-
-        new_id = last_id + 1
-        image_filename = f"{new_id}.png"
-        image_path = os.path.join(img_dir, image_filename)
-
-        os.makedirs(img_dir, exist_ok=True)
-                
-        with open(image_path, "wb") as f_img:
-            f_img.write(await screenshot.read())
+        image_bytes = await screenshot.read()
+        new_id = await run_in_kb_thread(append_passage_record, app_name, instruction, action_text, image_bytes)
 
-        tsv_line = f"{new_id}/tAction: {action_text}. Image: {image_path}/tsubtask: {instruction}"
-        with open(tsv_path, "a", encoding="utf-8") as f_tsv:
-            f_tsv.write(tsv_line + "/n")
-
-        if app_name in retriever_cache:
-            retriever_cache[app_name].setup_retriever()
+        return {"status": "success", "id": new_id}
 
-        retriever = get_or_create_retriever(app_name, update_embedding=True)
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
 
-        return {"status": "success", "id": new_id}
+@app.post("/append_batch")
+async def append_batch(request: Request):
+    # Many records in one multipart request: repeated instruction, action_text and screenshot fields,
+    # record i made of the i-th of each. The body is parsed as it streams in, with the screenshots
+    # spooled to temporary files, and the records are appended by append_passage_records. A record
+    # without an App field gets an error entry and the others are still appended. Optional record_key
+    # fields, one per record, make resending a batch safe: records already stored are not stored again.
+    max_records = args.append_batch_max_records
+    form = await request.form(max_files=max_records, max_fields=3 * max_records)
+    try:
+        instructions = form.getlist("instruction")
+        action_texts = form.getlist("action_text")
+        screenshots = form.getlist("screenshot")
+        keys = form.getlist("record_key") or [""] * len(instructions)
+        if not len(instructions) == len(action_texts) == len(screenshots) == len(keys):
+            raise HTTPException(
+                status_code=400,
+                detail="instruction, action_text, screenshot and record_key (if given) must be given once per record",
+            )
+        records, indices, errors = [], [], {}
+        for i, (instruction, action_text, screenshot) in enumerate(zip(instructions, action_texts, screenshots)):
+            app_name = extract_app_name(instruction)
+            if not app_name:
+                errors[i] = "Missing App field in Instruction"
+                continue
+            records.append((app_name, instruction, action_text, screenshot.file))
+            indices.append(i)
 
+        ids = [None] * len(instructions)
+        if records:
+            new_ids = await run_in_kb_thread(append_keyed_records, records, [keys[i] for i in indices])
+            for i, new_id in zip(indices, new_ids):
+                ids[i] = new_id
+        return {"status": "success", "ids": ids, "errors": errors}
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        await form.close()
+
+@app.get("/query_cache_stats")
+async def query_cache_stats():
+    return query_cache.stats()
+
+@app.on_event("shutdown")
+def save_query_cache():
+    # Persist the query embeddings so subtasks seen before a restart skip the encoder
+    query_cache.save()
+    save_kb_indexes()
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8002)
\ No newline at end of file
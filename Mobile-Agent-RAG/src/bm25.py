@@ -0,0 +1,151 @@
+"""BM25 inverted index over passage texts, kept next to the dense src.index.Indexer of a retriever.
+
+The KB passages are short, keyword-heavy strings ("tap 'show more', swipe up"), where exact app and
+action tokens matter more than Contriever similarity gives them credit for. Passages are tokenized
+into lowercased word tokens and stored as a sparse doc x term count matrix; the BM25 weights are
+precomputed into a term x doc CSR matrix, so scoring a batch of queries is one sparse matrix product.
+Document frequencies are kept up to date as passages are added, so the idf is always exact.
+Passages added since the weights were last computed are scored exactly from their counts. The
+weights are recomputed (vectorized, O(nnz)) only once those passages outnumber
+max(rebuild_min_docs, ntotal / rebuild_ratio). Until then the older passages keep the average
+document length of the last rebuild, so an append-then-search loop does not pay O(nnz) per step.
+
+The interface mirrors Indexer: index_data(ids, texts, partition=None) and search(queries, top_docs,
+partition=None), which returns one (db_ids, scores) pair per query.
+"""
+
+import re
+from typing import List, Tuple
+
+import numpy as np
+import scipy.sparse
+
+from src.index import _append
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    def __init__(self, k1=1.2, b=0.75, rebuild_min_docs=1024, rebuild_ratio=32):
+        self.k1 = k1
+        self.b = b
+        self.rebuild_min_docs = rebuild_min_docs
+        self.rebuild_ratio = rebuild_ratio
+        self.vocab = {}  # token -> term id
+        # CSR arrays of the doc x term counts, grown by doubling like the Indexer id mapping
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._term_ids = np.empty(0, dtype=np.int32)
+        self._counts = np.empty(0, dtype=np.float32)
+        self._doc_lengths = np.empty(0, dtype=np.float32)
+        self._db_ids = np.empty(0, dtype=object)
+        self._partitions = np.empty(0, dtype=np.int32)
+        self._ntotal = 0
+        self._nnz = 0
+        self.partition_codes = {}
+        self._doc_freq = np.zeros(0, dtype=np.int64)  # term id -> number of passages containing it
+        self._total_length = 0.0
+        self._weights = None  # term x doc BM25 weights of the first _built_n passages
+        self._built_n = 0
+
+    def __len__(self):
+        return self._ntotal
+
+    def index_data(self, ids, texts, partition=None):
+        code = -1 if partition is None else self.partition_codes.setdefault(partition, len(self.partition_codes))
+        term_ids, counts, ends, lengths = [], [], [], []
+        nnz = self._nnz
+        for text in texts:
+            tokens = tokenize(text)
+            doc_terms, doc_counts = np.unique(
+                np.array([self.vocab.setdefault(t, len(self.vocab)) for t in tokens], dtype=np.int32),
+                return_counts=True,
+            )
+            term_ids.append(doc_terms)
+            counts.append(doc_counts)
+            nnz += len(doc_terms)
+            ends.append(nnz)
+            lengths.append(len(tokens))
+        if not ends:
+            return
+        n = len(ends)
+        new_term_ids = np.concatenate(term_ids)
+        self._term_ids = _append(self._term_ids, self._nnz, new_term_ids, len(new_term_ids))
+        self._counts = _append(self._counts, self._nnz, np.concatenate(counts), len(new_term_ids))
+        self._indptr = _append(self._indptr, self._ntotal + 1, ends, n)
+        self._doc_lengths = _append(self._doc_lengths, self._ntotal, lengths, n)
+        self._db_ids = _append(self._db_ids, self._ntotal, np.array([str(x) for x in ids], dtype=object), n)
+        self._partitions = _append(self._partitions, self._ntotal, code, n)
+        self._ntotal += n
+        self._nnz = nnz
+        if len(self._doc_freq) < len(self.vocab):
+            grown = np.zeros(max(2 * len(self._doc_freq), len(self.vocab)), dtype=np.int64)
+            grown[:len(self._doc_freq)] = self._doc_freq
+            self._doc_freq = grown
+        self._doc_freq[:len(self.vocab)] += np.bincount(new_term_ids, minlength=len(self.vocab))
+        self._total_length += float(sum(lengths))
+
+    def search(self, queries: List[str], top_docs: int, partition=None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        if self._ntotal - self._built_n > max(self.rebuild_min_docs, self._ntotal // self.rebuild_ratio):
+            self._build()
+        query_matrix = self._query_matrix(queries)
+        scores = self._tail_weights().dot(query_matrix.T).T  # passages added since the last rebuild
+        if self._built_n:
+            built = query_matrix[:, :self._weights.shape[0]].dot(self._weights)
+            scores = scipy.sparse.hstack([built, scores])
+        scores = scores.tocsr()  # queries x docs
+        scores.sort_indices()  # ties rank in insertion order
+        code = None if partition is None else self.partition_codes.get(partition, -2)
+        partitions = self._partitions[:self._ntotal]
+        result = []
+        for i in range(len(queries)):
+            docs = scores.indices[scores.indptr[i]:scores.indptr[i + 1]]
+            doc_scores = scores.data[scores.indptr[i]:scores.indptr[i + 1]]
+            if code is not None:
+                keep = partitions[docs] == code
+                docs, doc_scores = docs[keep], doc_scores[keep]
+            if len(docs) > top_docs:
+                top = np.argpartition(-doc_scores, top_docs - 1)[:top_docs]
+                docs, doc_scores = docs[top], doc_scores[top]
+            order = np.argsort(-doc_scores, kind="stable")
+            result.append((self._db_ids[docs[order]], doc_scores[order]))
+        return result
+
+    def memory_footprint(self):
+        weights = 0 if self._weights is None else self._weights.data.nbytes + self._weights.indices.nbytes
+        return (
+            self._term_ids.nbytes + self._counts.nbytes + self._indptr.nbytes + self._db_ids.nbytes
+            + self._partitions.nbytes + self._doc_freq.nbytes + weights
+        )
+
+    def _doc_term_weights(self, start, end):
+        # doc x term BM25 weights (without idf) of passages [start, end), at the current average length
+        indptr = self._indptr[start:end + 1]
+        term_ids, counts = self._term_ids[indptr[0]:indptr[-1]], self._counts[indptr[0]:indptr[-1]]
+        avg_length = max(self._total_length / self._ntotal, 1.0) if self._ntotal else 1.0
+        lengths = np.repeat(self._doc_lengths[start:end], np.diff(indptr))
+        norm = self.k1 * (1 - self.b + self.b * lengths / avg_length)
+        weights = (counts * (self.k1 + 1) / (counts + norm)).astype(np.float32)
+        return scipy.sparse.csr_matrix((weights, term_ids, indptr - indptr[0]), shape=(end - start, len(self.vocab)))
+
+    def _tail_weights(self):
+        return self._doc_term_weights(self._built_n, self._ntotal)
+
+    def _build(self):
+        self._weights = self._doc_term_weights(0, self._ntotal).T.tocsr()
+        self._built_n = self._ntotal
+
+    def _query_matrix(self, queries):
+        rows, cols = [], []
+        for i, query in enumerate(queries):
+            terms = [self.vocab[t] for t in tokenize(query) if t in self.vocab]
+            rows.extend([i] * len(terms))
+            cols.extend(terms)
+        cols = np.array(cols, dtype=np.int64)
+        doc_freq = self._doc_freq[cols]
+        data = np.log1p((self._ntotal - doc_freq + 0.5) / (doc_freq + 0.5)).astype(np.float32)
+        # repeated query terms are summed, i.e. weighted by their count in the query
+        return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(len(queries), len(self.vocab)))
@@ -0,0 +1,47 @@
+"""Length-bucketed batching for the Contriever encoder.
+
+Padding every batch to its longest text wastes most of the compute when lengths vary widely, as in
+the Operator KBs (single actions next to long subtask strings). The texts are tokenized once
+without padding, sorted by token length and cut into batches of similar length, each padded only
+to its own longest text; the embeddings are returned in the original order.
+"""
+
+import torch
+
+import src.device
+
+
+def pad_batch(features, indices, pad_token_id):
+    longest = max(len(features["input_ids"][i]) for i in indices)
+    batch = {}
+    for key, values in features.items():
+        pad_value = pad_token_id if key == "input_ids" else 0
+        batch[key] = torch.tensor([values[i] + [pad_value] * (longest - len(values[i])) for i in indices])
+    return batch
+
+
+def embedding_dim(model):
+    # size of the embeddings the encoder returns, without running it
+    config = getattr(model, "config", None)
+    return config.hidden_size if config is not None else model.dim
+
+
+def encode_length_bucketed(model, tokenizer, texts, batch_size, max_length, device):
+    """Return the embeddings of `texts` (a CPU tensor, in input order)."""
+    if not texts:
+        return torch.empty((0, embedding_dim(model)))
+    features = tokenizer(list(texts), max_length=max_length, truncation=True)
+    features = {k: v for k, v in features.items() if k in ("input_ids", "attention_mask", "token_type_ids")}
+    order = sorted(range(len(texts)), key=lambda i: len(features["input_ids"][i]))
+
+    embeddings = []
+    with torch.no_grad():
+        for start in range(0, len(order), batch_size):
+            batch = pad_batch(features, order[start:start + batch_size], tokenizer.pad_token_id)
+            embeddings.append(model(**src.device.to_device(batch, device)).cpu())
+    embeddings = torch.cat(embeddings, dim=0)
+
+    # undo the sort
+    restored = torch.empty_like(embeddings)
+    restored[torch.tensor(order)] = embeddings
+    return restored
@@ -1,6 +1,7 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 
 import os
+import io
 import glob
 import torch
 import random
@@ -242,3 +243,32 @@ def load_passages(path):
                     ex = {"id": row[0], "title": row[2], "text": row[1]}
                     passages.append(ex)
     return passages
+
+
+def passage_byte_ranges(path, num_ranges):
+    """Split a passage file into `num_ranges` contiguous byte ranges that start and end on line boundaries."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as fin:
+        for i in range(1, num_ranges):
+            fin.seek(max(bounds[-1], size * i // num_ranges))
+            if fin.tell() > 0:
+                fin.seek(fin.tell() - 1)
+                fin.readline()  # move to the start of the next line
+            bounds.append(fin.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def load_passage_range(path, start, end):
+    """Load the passages whose lines lie in bytes [start, end) of a passage file, as load_passages does."""
+    with open(path, "rb") as fin:
+        fin.seek(start)
+        lines = io.StringIO(fin.read(end - start).decode(), newline=None)
+    if path.endswith(".jsonl"):
+        return [json.loads(line) for line in lines]
+    return [
+        {"id": row[0], "title": row[2], "text": row[1]}
+        for row in csv.reader(lines, delimiter="\t")
+        if not row[0] == "id"
+    ]
@@ -0,0 +1,74 @@
+"""Device placement of the Contriever encoder for the retrievers and embedding generation.
+
+`device` is "cuda", "cpu" or "auto" (cuda when available). On CPU the model runs in fp32, since
+fp16 matmuls are slow or unsupported there, and torch uses `num_threads` intra-op threads (0 keeps
+the torch default). With `quantize_int8`, queries are encoded by an int8 copy of the model whose
+Linear layers are dynamically quantized; passages are always encoded in full precision, so that the
+vectors appended at runtime match the ones written by generate_passage_embeddings.py.
+"""
+
+import torch
+
+
+def resolve_device(device="auto"):
+    if device in (None, "auto"):
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return torch.device(device)
+
+
+def configure_threads(num_threads=0):
+    if num_threads and num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+
+def prepare_encoder(model, device, fp16=True):
+    model.eval()
+    if device.type == "cpu":
+        return model.float()
+    model = model.to(device)
+    if fp16:
+        model = model.half()
+    return model
+
+
+def quantize_dynamic_int8(model):
+    # weights of the Linear layers (attention and feed-forward, almost all of BERT's compute) are
+    # stored in int8; activations are quantized on the fly per batch
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def to_device(batch, device):
+    return {k: v.to(device) for k, v in batch.items()}
+
+
+def setup_encoder(args, model):
+    # apply the device, thread and precision options shared by the retrievers and generate_passage_embeddings;
+    # the returned model encodes passages, see query_encoder for queries
+    device = resolve_device(getattr(args, "device", "auto"))
+    if device.type == "cpu":
+        configure_threads(getattr(args, "num_threads", 0))
+    model = prepare_encoder(model, device, fp16=not args.no_fp16)
+    return model, device
+
+
+def query_encoder(args, model, device):
+    # the model that encodes queries: an int8 copy of the passage model with quantize_int8, else the model itself
+    if not getattr(args, "quantize_int8", False):
+        return model
+    if device.type != "cpu":
+        raise ValueError("int8 dynamic quantization is only supported for CPU inference")
+    return quantize_dynamic_int8(model)  # quantize_dynamic copies the model, the fp32 one is left as is
+
+
+def passage_encoder_id(args):
+    # identifies the passage encoder and its numerics, e.g. for caching passage embeddings it produced
+    if getattr(args, "onnx_model", None):
+        return f"{args.model_name_or_path}:onnx"
+    return args.model_name_or_path
+
+
+def encoder_id(args):
+    # same for the query encoder, e.g. for caching query embeddings
+    if getattr(args, "quantize_int8", False) and not getattr(args, "onnx_model", None):
+        return f"{args.model_name_or_path}:int8"
+    return passage_encoder_id(args)
@@ -0,0 +1,100 @@
+"""Content-addressed cache of passage embeddings.
+
+A passage is keyed by the sha256 of (model id, max length, the exact text fed to the encoder), so
+an embedding is reused whenever the same text is encoded again with the same model, whatever its
+passage id or position in the file. Rebuilding a KB after appending or editing a few passages then
+only encodes those passages.
+
+The cache is a directory of append-only segments, one per `put`:
+
+    <name>.keys.npy  16-byte keys, uint8 of shape (count, 16)
+    <name>.emb.npy   embeddings, shape (count, dim), memory-mapped when read
+
+Segment names are unique per writer (time and pid), so the servers and embedding jobs can add to
+the same cache. The keys file of a segment is written last and atomically, so readers ignore
+half-written segments. Once a cache holds more than MAX_SEGMENTS segments (e.g. after many single
+passage appends) they are merged into one.
+"""
+
+import glob
+import hashlib
+import os
+import time
+
+import numpy as np
+
+KEYS_SUFFIX = ".keys.npy"
+EMBEDDINGS_SUFFIX = ".emb.npy"
+MAX_SEGMENTS = 64
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir, model_id, max_length):
+        self.cache_dir = cache_dir
+        self.prefix = f"{model_id}\x00{max_length}\x00".encode()
+        self.segments = []  # memory-mapped embeddings of each segment
+        self.segment_paths = []
+        self.locations = {}  # key -> (segment, row)
+        os.makedirs(cache_dir, exist_ok=True)
+        for keys_path in sorted(glob.glob(os.path.join(cache_dir, "*" + KEYS_SUFFIX))):
+            path = keys_path[: -len(KEYS_SUFFIX)]
+            try:
+                self._add_segment(path, np.load(keys_path), np.load(path + EMBEDDINGS_SUFFIX, mmap_mode="r"))
+            except FileNotFoundError:  # removed by a concurrent compaction
+                continue
+
+    def __len__(self):
+        return len(self.locations)
+
+    def key(self, text):
+        return hashlib.sha256(self.prefix + text.encode()).digest()[:16]
+
+    def get(self, texts):
+        """Return the cached embedding of each text, or None where there is none."""
+        result = []
+        for text in texts:
+            location = self.locations.get(self.key(text))
+            result.append(None if location is None else self.segments[location[0]][location[1]])
+        return result
+
+    def put(self, texts, embeddings):
+        keys = [self.key(t) for t in texts]
+        new = [i for i, k in enumerate(keys) if k not in self.locations]
+        if not new:
+            return
+        keys = np.frombuffer(b"".join(keys[i] for i in new), dtype=np.uint8).reshape(-1, 16)
+        path = self._write_segment(keys, np.asarray(embeddings)[new])
+        self._add_segment(path, keys, np.load(path + EMBEDDINGS_SUFFIX, mmap_mode="r"))
+        if len(self.segments) > MAX_SEGMENTS:
+            self.compact()
+
+    def compact(self):
+        # merge the segments this instance knows of; segments other writers added since are left alone
+        keys = np.frombuffer(b"".join(self.locations), dtype=np.uint8).reshape(-1, 16)
+        embeddings = np.stack([self.segments[segment][row] for segment, row in self.locations.values()])
+        path = self._write_segment(keys, embeddings)
+        for old_path in self.segment_paths:
+            # the keys file first, so readers never see keys without embeddings; another writer
+            # compacting the same segments may have removed them already
+            for suffix in (KEYS_SUFFIX, EMBEDDINGS_SUFFIX):
+                try:
+                    os.remove(old_path + suffix)
+                except FileNotFoundError:
+                    pass
+        self.segments, self.segment_paths, self.locations = [], [], {}
+        self._add_segment(path, keys, np.load(path + EMBEDDINGS_SUFFIX, mmap_mode="r"))
+
+    def _write_segment(self, keys, embeddings):
+        path = os.path.join(self.cache_dir, f"{time.time_ns():020d}-{os.getpid()}")
+        np.save(path + EMBEDDINGS_SUFFIX, embeddings)
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, keys)
+        os.replace(tmp_path, path + KEYS_SUFFIX)
+        return path
+
+    def _add_segment(self, path, keys, embeddings):
+        segment = len(self.segments)
+        self.segments.append(embeddings)
+        self.segment_paths.append(path)
+        for row, key in enumerate(keys):
+            self.locations[key.tobytes()] = (segment, row)
@@ -0,0 +1,159 @@
+"""On-disk format of the passage embedding shards written by generate_passage_embeddings.py.
+
+A shard is a small JSON header at `<output_dir>/<prefix>_<shard_id>` with two sidecars next to it:
+
+    <shard>.npy      embeddings, float32 or float16, shape (count, dim), memory-mappable
+    <shard>.ids.npy  passage ids as int64 when they are all integers, shape (count,); otherwise the
+                     end offset of each id in <shard>.ids.utf8, which holds the UTF-8 ids back to back
+
+The header records the format, the ids encoding, dim, count, dtype, model id and a sha256 digest of
+the ids and embeddings. Shards of the previous npy format (ids as fixed-width unicode) and pickles
+of (ids, embeddings) written by earlier versions are still readable.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import pickle
+import re
+
+import numpy as np
+
+FORMAT = "npy-v2"
+READABLE_FORMATS = ("npy-v1", FORMAT)
+EMBEDDINGS_SUFFIX = ".npy"
+IDS_SUFFIX = ".ids.npy"
+IDS_TEXT_SUFFIX = ".ids.utf8"
+SIDECAR_SUFFIXES = (EMBEDDINGS_SUFFIX, IDS_SUFFIX, IDS_TEXT_SUFFIX)
+INT_ID_RE = re.compile(r"-?(0|[1-9][0-9]{0,17})")  # ids that round-trip through int64 unchanged
+
+
+def write_shard(path, ids, embeddings, model_id, dtype=None):
+    embeddings = np.ascontiguousarray(embeddings, dtype=dtype)
+    np.save(path + EMBEDDINGS_SUFFIX, embeddings)
+    finish_shard(path, ids, embeddings, model_id)
+
+
+def create_shard(path, count, dim, dtype):
+    """Return a writable memory-mapped embeddings array for a shard filled incrementally.
+
+    The shard becomes readable once finish_shard is called with its ids.
+    """
+    return np.lib.format.open_memmap(path + EMBEDDINGS_SUFFIX, mode="w+", dtype=dtype, shape=(count, dim))
+
+
+def finish_shard(path, ids, embeddings, model_id, chunk_size=65536):
+    if isinstance(embeddings, np.memmap):
+        embeddings.flush()
+    ids = [str(x) for x in ids]
+    if all(INT_ID_RE.fullmatch(x) for x in ids):
+        ids_encoding = "int64"
+        id_array = np.array([int(x) for x in ids], dtype=np.int64)
+        digest = hashlib.sha256(id_array.tobytes())
+    else:
+        ids_encoding = "utf8"
+        encoded = [x.encode("utf-8") for x in ids]
+        id_array = np.cumsum([len(x) for x in encoded], dtype=np.int64)
+        with open(path + IDS_TEXT_SUFFIX, "wb") as f:
+            for x in encoded:
+                f.write(x)
+        digest = hashlib.sha256(id_array.tobytes())
+        for x in encoded:
+            digest.update(x)
+    np.save(path + IDS_SUFFIX, id_array)
+    for start in range(0, len(embeddings), chunk_size):
+        digest.update(np.ascontiguousarray(embeddings[start:start + chunk_size]).data)
+    header = {
+        "format": FORMAT,
+        "ids": ids_encoding,
+        "dim": int(embeddings.shape[1]),
+        "count": int(embeddings.shape[0]),
+        "dtype": embeddings.dtype.name,
+        "model_id": model_id,
+        "digest": digest.hexdigest(),
+    }
+    # the header is written last and atomically, so readers never see a shard with missing sidecars
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(header, f)
+    os.replace(tmp_path, path)
+    return header
+
+
+def is_legacy_shard(path):
+    with open(path, "rb") as f:
+        return f.read(1) == b"\x80"  # pickle protocol 2+ opcode
+
+
+def read_shard_header(path):
+    with open(path, "r") as f:
+        header = json.load(f)
+    if header.get("format") not in READABLE_FORMATS:
+        raise ValueError(f"Unsupported embedding shard format in {path}: {header.get('format')}")
+    return header
+
+
+def shard_digest(path):
+    """Content digest of a shard: recorded in the header, or hashed from the file(s) for older shards."""
+    if is_legacy_shard(path):
+        files = [path]
+    else:
+        header = read_shard_header(path)
+        if "digest" in header:
+            return header["digest"]
+        files = [path + IDS_SUFFIX, path + EMBEDDINGS_SUFFIX]  # only npy-v1 shards lack a digest
+    digest = hashlib.sha256()
+    for file_path in files:
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 24), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_shards(pattern):
+    # the sidecars share the shard prefix, so exclude them from globs such as "passages_*"
+    return sorted(p for p in glob.glob(pattern) if not p.endswith(SIDECAR_SUFFIXES + (".tmp",)))
+
+
+def load_shard(path):
+    """Return (ids, embeddings); embeddings of the npy format are memory-mapped, not read."""
+    if is_legacy_shard(path):
+        with open(path, "rb") as fin:
+            return pickle.load(fin)
+    header = read_shard_header(path)
+    ids = np.load(path + IDS_SUFFIX, mmap_mode="r")
+    if header.get("ids") == "utf8":
+        size = int(ids[-1]) if len(ids) else 0
+        ids = TextIds(ids, np.memmap(path + IDS_TEXT_SUFFIX, dtype=np.uint8, mode="r") if size else b"")  # empty files cannot be mapped
+    embeddings = np.load(path + EMBEDDINGS_SUFFIX, mmap_mode="r")
+    return ids, embeddings
+
+
+class TextIds:
+    """Ids of a utf8 shard, sliced without decoding the others."""
+
+    def __init__(self, ends, data):
+        self.ends = ends
+        self.data = data
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(len(self.ends))
+        if start >= stop:
+            return []
+        ends = self.ends[start:stop]
+        offset = int(self.ends[start - 1]) if start else 0
+        data = bytes(self.data[offset:int(ends[-1])])
+        starts = np.concatenate(([0], ends[:-1] - offset))
+        return [data[a:b].decode("utf-8") for a, b in zip(starts, ends - offset)]
+
+
+def iter_shard_slices(path, slice_size):
+    """Yield (ids, embeddings) slices of at most `slice_size` rows; only one slice is resident at a time."""
+    ids, embeddings = load_shard(path)
+    for start in range(0, len(ids), slice_size):
+        end = min(start + slice_size, len(ids))
+        yield [str(x) for x in ids[start:end]], np.asarray(embeddings[start:end])
@@ -0,0 +1,51 @@
+"""Fusion of dense (Contriever) and sparse (BM25) rankings for hybrid retrieval.
+
+Both functions take, per query, a list of rankings in the (db_ids, scores) form returned by
+Indexer.search_knn and BM25Index.search, and return one fused (db_ids, scores) ranking.
+
+    rrf:       sum of weight / (rrf_k + rank) over the rankings a passage appears in
+    weighted:  sum of weight * score, with the scores of each ranking min-max normalized to [0, 1]
+"""
+
+import numpy as np
+
+FUSION_METHODS = ("none", "rrf", "weighted")
+
+
+def reciprocal_rank_fusion(rankings, weights, rrf_k=60):
+    fused = {}
+    for (ids, _), weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ids):
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight / (rrf_k + rank + 1)
+    return fused
+
+
+def weighted_fusion(rankings, weights):
+    fused = {}
+    for (ids, scores), weight in zip(rankings, weights):
+        if len(ids) == 0:
+            continue
+        scores = np.asarray(scores, dtype=np.float32)
+        low, high = scores.min(), scores.max()
+        normalized = (scores - low) / (high - low) if high > low else np.ones_like(scores)
+        for doc_id, score in zip(ids, normalized.tolist()):
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight * score
+    return fused
+
+
+def fuse(dense, sparse, method, top_docs, alpha=0.5, rrf_k=60):
+    """Fuse per-query dense and sparse rankings; `alpha` is the weight of the dense side."""
+    result = []
+    for rankings in zip(dense, sparse):
+        if method == "rrf":
+            fused = reciprocal_rank_fusion(rankings, (alpha, 1 - alpha), rrf_k)
+        elif method == "weighted":
+            fused = weighted_fusion(rankings, (alpha, 1 - alpha))
+        else:
+            raise ValueError(f"Unknown fusion method {method}, expected one of {FUSION_METHODS}")
+        top = sorted(fused.items(), key=lambda item: -item[1])[:top_docs]
+        result.append((
+            np.array([doc_id for doc_id, _ in top], dtype=object),
+            np.array([score for _, score in top], dtype=np.float32),
+        ))
+    return result
@@ -0,0 +1,89 @@
+"""Pooled keep-alive HTTP client for the RAG servers.
+
+The agent talks to the Manager and Operator servers several times per step. A bare requests.post
+opens a new TCP connection each time; a RAGClient keeps one requests.Session per server, so calls
+reuse pooled keep-alive connections. Failed calls are retried with exponential backoff: connection
+errors on every endpoint, and read errors or 502/503/504 only on idempotent ones. /append* requests
+add to the KB, so once they reached the server they are not resent.
+
+get_client(server_url) returns the client shared by all callers in the process; the session is safe
+to use from several threads. src.http_client_async has the httpx-based async counterpart.
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = (3.05, 60)  # (connect, read) seconds
+NON_IDEMPOTENT_PREFIXES = ("/append",)
+
+
+def make_retry(retries, backoff_factor, idempotent):
+    kwargs = dict(
+        total=retries,
+        connect=retries,
+        read=retries if idempotent else 0,
+        status=retries if idempotent else 0,
+        backoff_factor=backoff_factor,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    methods = frozenset(["GET", "POST"]) if idempotent else frozenset(["GET"])
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:  # urllib3 < 1.26
+        return Retry(method_whitelist=methods, **kwargs)
+
+
+class RAGClient:
+    def __init__(self, base_url, timeout=DEFAULT_TIMEOUT, retries=3, backoff_factor=0.3, pool_maxsize=8):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_maxsize, max_retries=make_retry(retries, backoff_factor, True)
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # the longest matching prefix wins, so KB writes get the connect-only retries
+        for prefix in NON_IDEMPOTENT_PREFIXES:
+            self.session.mount(self.base_url + prefix, HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_maxsize, max_retries=make_retry(retries, backoff_factor, False)
+            ))
+
+    def url(self, path):
+        return path if path.startswith(("http://", "https://")) else self.base_url + path
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, self.url(path), **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+clients = {}  # server_url -> RAGClient
+clients_lock = threading.Lock()
+
+
+def get_client(server_url, **kwargs):
+    """The RAGClient shared by all callers of `server_url`; kwargs apply when it is first created."""
+    key = server_url.rstrip("/")
+    with clients_lock:
+        if key not in clients:
+            clients[key] = RAGClient(key, **kwargs)
+        return clients[key]
@@ -0,0 +1,63 @@
+"""httpx-based async counterpart of src.http_client.RAGClient.
+
+One AsyncRAGClient holds a pooled keep-alive httpx.AsyncClient for a server. Connection errors are
+retried by the transport; read errors and 502/503/504 are retried with exponential backoff, except on
+the non-idempotent /append* endpoints, which are sent at most once after the connection is made.
+
+    async with AsyncRAGClient("http://localhost:8002") as client:
+        resp = await client.post("/retrieve", json={"query": query, "n_docs": 1})
+"""
+
+import asyncio
+
+import httpx
+
+from src.http_client import DEFAULT_TIMEOUT, NON_IDEMPOTENT_PREFIXES
+
+RETRY_STATUS = (502, 503, 504)
+
+
+class AsyncRAGClient:
+    def __init__(self, base_url, timeout=DEFAULT_TIMEOUT, retries=3, backoff_factor=0.3, max_connections=8):
+        self.base_url = base_url.rstrip("/")
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=httpx.Timeout(read, connect=connect),
+            # the client ignores its own limits when given a transport, so they are set on the transport
+            transport=httpx.AsyncHTTPTransport(
+                retries=retries,  # connect errors only
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            ),
+        )
+
+    async def request(self, method, path, **kwargs):
+        idempotent = not path.startswith(NON_IDEMPOTENT_PREFIXES)
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries or not idempotent
+            try:
+                resp = await self.client.request(method, path, **kwargs)
+            except (httpx.ReadError, httpx.ReadTimeout, httpx.RemoteProtocolError):
+                if last:
+                    raise
+            else:
+                if resp.status_code not in RETRY_STATUS or last:
+                    return resp
+            await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
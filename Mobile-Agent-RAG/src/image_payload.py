@@ -0,0 +1,101 @@
+"""Inline image payloads for Operator /retrieve responses.
+
+With `inline_images`, every hit carries its screenshot as a downscaled JPEG (base64) and an image
+hash, so the client needs no /images download per hit and can cache the image by KB id and hash.
+The hash is taken over the screenshot file and the encoding settings, so it can be sent on its own
+(image_hashes_only) without encoding the image. Screenshots of a KB entry never change, so hashes
+and encoded payloads are kept in LRUs keyed by the file's path, size and mtime; a popular entry is
+read and re-encoded once.
+"""
+
+import base64
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+
+def encode_jpeg(path, max_side=1024, quality=85):
+    with Image.open(path) as img:
+        img = img.convert("RGB")
+        img.thumbnail((max_side, max_side))
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+    return out.getvalue()
+
+
+class ImagePayloadCache:
+    def __init__(self, max_bytes=256 * 2**20, max_side=1024, quality=85, max_hashes=2**20):
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.quality = quality
+        self.max_hashes = max_hashes
+        self.entries = OrderedDict()  # (path, size, mtime_ns) -> {"image_hash", "image_b64", "image_mime"}
+        self.hashes = OrderedDict()  # (path, size, mtime_ns) -> image hash
+        self.nbytes = 0
+        self._lock = threading.Lock()
+
+    def image_hash(self, path):
+        """Hash of the payload of the image at `path`, without encoding it; None if it cannot be read."""
+        try:
+            key = self._key(path)
+        except OSError:
+            return None
+        with self._lock:
+            image_hash = self.hashes.get(key)
+            if image_hash is not None:
+                self.hashes.move_to_end(key)
+                return image_hash
+        h = hashlib.sha256(f"{self.max_side}:{self.quality}:".encode("ascii"))
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(2**20), b""):
+                    h.update(chunk)
+        except OSError:
+            return None
+        image_hash = h.hexdigest()[:32]
+        with self._lock:
+            self.hashes[key] = image_hash
+            while len(self.hashes) > self.max_hashes:
+                self.hashes.popitem(last=False)
+        return image_hash
+
+    def get(self, path):
+        """Inline payload of the image at `path`, or None if it cannot be read."""
+        try:
+            key = self._key(path)
+        except OSError:
+            return None
+        with self._lock:
+            payload = self.entries.get(key)
+            if payload is not None:
+                self.entries.move_to_end(key)
+                return payload
+        image_hash = self.image_hash(path)
+        if image_hash is None:
+            return None
+        try:
+            data = encode_jpeg(path, self.max_side, self.quality)
+        except (OSError, ValueError):
+            return None
+        payload = {
+            "image_hash": image_hash,
+            "image_b64": base64.b64encode(data).decode("ascii"),
+            "image_mime": "image/jpeg",
+        }
+        with self._lock:
+            if key not in self.entries:
+                self.entries[key] = payload
+                self.nbytes += len(payload["image_b64"])
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= len(evicted["image_b64"])
+        return payload
+
+    @staticmethod
+    def _key(path):
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
@@ -13,46 +13,137 @@ import numpy as np
 from tqdm import tqdm
 
 class Indexer(object):
+    """Inner-product index over passage embeddings.
 
-    def __init__(self, vector_sz, n_subquantizers=0, n_bits=8):
-        if n_subquantizers > 0:
+    By default a flat index (or a plain PQ index when n_subquantizers > 0) is used. `index_spec` selects
+    an approximate index instead, as a faiss index_factory string such as "IVF1024,Flat",
+    "IVF1024,PQ64" or "HNSW32,Flat"; `nprobe` and `ef_search` set the IVF and HNSW search breadth.
+    Indexes that need training hold back the vectors passed to index_data until `max_train_size` of
+    them have arrived, across calls (shards, partitions), or until flush() is called at the end of a
+    bulk load or before a search; they are then trained on a random sample of at most `max_train_size`
+    of those vectors and all of them are added. With fewer vectors than the index has centroids, a
+    flat index is used instead.
+    """
+
+    def __init__(self, vector_sz, n_subquantizers=0, n_bits=8, index_spec=None, nprobe=16, ef_search=64, max_train_size=262144):
+        if index_spec:
+            self.index = faiss.index_factory(vector_sz, index_spec, faiss.METRIC_INNER_PRODUCT)
+        elif n_subquantizers > 0:
             self.index = faiss.IndexPQ(vector_sz, n_subquantizers, n_bits, faiss.METRIC_INNER_PRODUCT)
         else:
             self.index = faiss.IndexFlatIP(vector_sz)
-        #self.index_id_to_db_id = np.empty((0), dtype=np.int64)
-        self.index_id_to_db_id = []
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.max_train_size = max_train_size
+        self._pending = []  # batches held back until the index is trained
+        self._npending = 0
+        # row-aligned arrays grown by doubling, so single-passage appends stay amortized O(1);
+        # index_id_to_db_id and index_id_to_partition are views of their first `ntotal` entries
+        self._db_ids = np.empty(0, dtype=object)
+        # optional per-vector partition (e.g. the app a passage belongs to), stored as small integer codes
+        self._partitions = np.empty(0, dtype=np.int32)
+        self._ntotal = 0
+        self.partition_codes = {}
+        self._partition_selectors = {}
+
+    @property
+    def index_id_to_db_id(self):
+        return self._db_ids[:self._ntotal]
 
-    def index_data(self, ids, embeddings):
-        self._update_id_mapping(ids)
+    @property
+    def index_id_to_partition(self):
+        return self._partitions[:self._ntotal]
+
+    def index_data(self, ids, embeddings, partition=None):
+        self._update_id_mapping(ids, partition)
         embeddings = embeddings.astype('float32')
+        if self.index.is_trained and not self._pending:
+            self.index.add(embeddings)
+        else:
+            self._pending.append(embeddings)
+            self._npending += len(embeddings)
+            if self._npending >= self.max_train_size:
+                self.flush()
+
+        print(f'Total data indexed {self._ntotal}')
+
+    def flush(self):
+        # train on the vectors held back so far and add them
+        if not self._pending:
+            return
+        embeddings = np.concatenate(self._pending) if len(self._pending) > 1 else self._pending[0]
+        self._pending, self._npending = [], 0
         if not self.index.is_trained:
-            self.index.train(embeddings)
+            self.train(embeddings)
         self.index.add(embeddings)
 
-        print(f'Total data indexed {len(self.index_id_to_db_id)}')
+    def train(self, embeddings):
+        if len(embeddings) < self._min_train_size():
+            # fewer vectors than centroids: faiss cannot train, and an exact search is cheap at this size
+            print(f'Only {len(embeddings)} vectors to train the index on, using a flat index instead')
+            self.index = faiss.IndexFlatIP(self.index.d)
+            return
+        if len(embeddings) > self.max_train_size:
+            sample = np.random.default_rng(0).choice(len(embeddings), self.max_train_size, replace=False)
+            embeddings = embeddings[np.sort(sample)]
+        print(f'Training index on {len(embeddings)} vectors')
+        self.index.train(embeddings)
 
-    def search_knn(self, query_vectors: np.array, top_docs: int, index_batch_size: int = 2048) -> List[Tuple[List[object], List[float]]]:
+    def _min_train_size(self):
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            ivf = faiss.downcast_index(ivf)  # e.g. IndexIVFPQ, which also trains a product quantizer
+        pq = getattr(ivf if ivf is not None else self.index, 'pq', None)
+        return max(ivf.nlist if ivf is not None else 1, pq.ksub if pq is not None else 1)
+
+    def search_knn(self, query_vectors: np.array, top_docs: int, index_batch_size: int = 2048, partition=None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        self.flush()
         query_vectors = query_vectors.astype('float32')
+        selector = self._partition_selector(partition) if partition is not None else None
+        params = self._search_params(selector)
         result = []
         nbatch = (len(query_vectors)-1) // index_batch_size + 1
-        for k in tqdm(range(nbatch)):
+        batches = tqdm(range(nbatch)) if nbatch > 1 else range(nbatch)
+        for k in batches:
             start_idx = k*index_batch_size
             end_idx = min((k+1)*index_batch_size, len(query_vectors))
             q = query_vectors[start_idx: end_idx]
-            scores, indexes = self.index.search(q, top_docs)
-            # convert to external ids
-            db_ids = [[str(self.index_id_to_db_id[i]) for i in query_top_idxs] for query_top_idxs in indexes]
-            result.extend([(db_ids[i], scores[i]) for i in range(len(db_ids))])
+            scores, indexes = self.index.search(q, top_docs, params=params)
+            # convert to external ids in one fancy-indexing op
+            db_ids = self.index_id_to_db_id[indexes]
+            found = indexes >= 0
+            if found.all():
+                result.extend(zip(db_ids, scores))
+            else:
+                # drop the -1 padding faiss returns when fewer than top_docs vectors match
+                result.extend((ids[mask], s[mask]) for ids, s, mask in zip(db_ids, scores, found))
         return result
 
+    def memory_footprint(self):
+        # approximate bytes held by the faiss codes and the id mapping
+        if isinstance(self.index, faiss.IndexHNSW):
+            # stored vectors plus the level-0 neighbour links, which dominate the graph size
+            bytes_per_vector = self.index.storage.sa_code_size() + 4 * self.index.hnsw.nb_neighbors(0)
+        elif isinstance(self.index, faiss.IndexIVF):
+            bytes_per_vector = self.index.code_size + 8  # code and id stored in the inverted lists
+        else:
+            bytes_per_vector = self.index.sa_code_size()
+        pending = sum(x.nbytes for x in self._pending)
+        return self.index.ntotal * bytes_per_vector + pending + self._db_ids.nbytes + self._partitions.nbytes
+
     def serialize(self, dir_path):
+        self.flush()
         index_file = os.path.join(dir_path, 'index.faiss')
         meta_file = os.path.join(dir_path, 'index_meta.faiss')
         print(f'Serializing index to {index_file}, meta data to {meta_file}')
 
         faiss.write_index(self.index, index_file)
         with open(meta_file, mode='wb') as f:
-            pickle.dump(self.index_id_to_db_id, f)
+            pickle.dump({
+                'index_id_to_db_id': self.index_id_to_db_id,
+                'index_id_to_partition': self.index_id_to_partition,
+                'partition_codes': self.partition_codes,
+            }, f)
 
     def deserialize_from(self, dir_path):
         index_file = os.path.join(dir_path, 'index.faiss')
@@ -60,14 +151,59 @@ class Indexer(object):
         print(f'Loading index from {index_file}, meta data from {meta_file}')
 
         self.index = faiss.read_index(index_file)
+        self._pending, self._npending = [], 0
         print('Loaded index of type %s and size %d', type(self.index), self.index.ntotal)
 
         with open(meta_file, "rb") as reader:
-            self.index_id_to_db_id = pickle.load(reader)
-        assert len(
-            self.index_id_to_db_id) == self.index.ntotal, 'Deserialized index_id_to_db_id should match faiss index size'
-
-    def _update_id_mapping(self, db_ids: List):
-        #new_ids = np.array(db_ids, dtype=np.int64)
-        #self.index_id_to_db_id = np.concatenate((self.index_id_to_db_id, new_ids), axis=0)
-        self.index_id_to_db_id.extend(db_ids)
\ No newline at end of file
+            meta = pickle.load(reader)
+        if not isinstance(meta, dict):  # id list written before partitions were supported
+            meta = {'index_id_to_db_id': meta, 'partition_codes': {}}
+        self._db_ids = np.array([str(x) for x in meta['index_id_to_db_id']], dtype=object)
+        self._ntotal = len(self._db_ids)
+        self._partitions = np.asarray(meta.get('index_id_to_partition', np.full(self._ntotal, -1)), dtype=np.int32)
+        self.partition_codes = meta['partition_codes']
+        self._partition_selectors = {}
+        assert self._ntotal == self.index.ntotal, 'Deserialized index_id_to_db_id should match faiss index size'
+
+    def _update_id_mapping(self, db_ids: List, partition=None):
+        if partition is None:
+            if self.partition_codes:
+                raise ValueError('Data added to a partitioned index must specify its partition')
+            code = -1
+        else:
+            if self._ntotal > 0 and not self.partition_codes:
+                raise ValueError('Cannot add partitioned data to an index that already holds unpartitioned data')
+            code = self.partition_codes.setdefault(partition, len(self.partition_codes))
+            self._partition_selectors.pop(code, None)
+        # ids are converted to str once here rather than on every search hit
+        new_ids = np.array([str(x) for x in db_ids], dtype=object)
+        self._db_ids = _append(self._db_ids, self._ntotal, new_ids, len(new_ids))
+        self._partitions = _append(self._partitions, self._ntotal, code, len(new_ids))
+        self._ntotal += len(new_ids)
+
+    def _partition_selector(self, partition):
+        # restrict the search to the vectors of one partition; the selector is rebuilt only after the partition grows
+        code = self.partition_codes.get(partition)
+        if code not in self._partition_selectors:
+            rows = np.flatnonzero(self.index_id_to_partition == code) if code is not None else np.empty(0)
+            self._partition_selectors[code] = faiss.IDSelectorBatch(rows.astype('int64'))
+        return self._partition_selectors[code]
+
+    def _search_params(self, selector=None):
+        if isinstance(self.index, faiss.IndexIVF):
+            return faiss.SearchParametersIVF(sel=selector, nprobe=self.nprobe)
+        if isinstance(self.index, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=self.ef_search)
+        return faiss.SearchParameters(sel=selector) if selector is not None else None
+
+
+def _append(buffer, size, values, n):
+    # write `values` (n entries, or one scalar repeated n times) after the first `size` entries of
+    # `buffer`, doubling its capacity when full
+    end = size + n
+    if end > len(buffer):
+        grown = np.empty(max(2 * len(buffer), end, 1024), dtype=buffer.dtype)
+        grown[:size] = buffer[:size]
+        buffer = grown
+    buffer[size:end] = values
+    return buffer
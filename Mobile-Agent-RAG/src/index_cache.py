@@ -0,0 +1,79 @@
+"""Persistent cache of built indexes, keyed by a fingerprint of what they were built from.
+
+The fingerprint covers the content digests of the embedding shards, the model id, the index
+configuration and optionally the version of the passages the index reflects. A cached index is only
+reused when the fingerprint matches; otherwise the caller rebuilds and replaces it.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from src import embedding_shards
+
+FINGERPRINT_FILE = "index_fingerprint.json"
+INDEX_FILES = ("index.faiss", "index_meta.faiss")
+
+
+def index_config(args):
+    # index construction parameters; nprobe and ef_search only affect search and are left out
+    return [args.projection_size, args.n_subquantizers, args.n_bits, args.index_spec]
+
+
+def fingerprint(shard_paths, model_id, config, passages_version=None):
+    content = {
+        "shards": [[os.path.basename(p), embedding_shards.shard_digest(p)] for p in shard_paths],
+        "model_id": model_id,
+        "index_config": config,
+        "passages_version": passages_version,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def read_fingerprint(cache_dir):
+    path = os.path.join(cache_dir, FINGERPRINT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)["fingerprint"]
+
+
+def read_kb_position(cache_dir):
+    # last change-feed row of an SQLite KB the cached index covers (see src.kb_sqlite)
+    path = os.path.join(cache_dir, FINGERPRINT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f).get("kb_position")
+
+
+def load_index(indexer, cache_dir, expected_fingerprint):
+    """Deserialize the cached index into `indexer` if it matches; return whether it was loaded."""
+    if read_fingerprint(cache_dir) != expected_fingerprint:
+        return False
+    indexer.deserialize_from(cache_dir)
+    return True
+
+
+def save_index(indexer, cache_dir, index_fingerprint, kb_position=None):
+    """Serialize `indexer` into `cache_dir`, replacing any cached index.
+
+    The files are written to a temporary directory first and moved in with os.replace. The old
+    fingerprint is removed before the swap and the new one moved in last, so a reader never
+    accepts a partly replaced index.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".index-", dir=cache_dir)
+    try:
+        indexer.serialize(tmp_dir)
+        with open(os.path.join(tmp_dir, FINGERPRINT_FILE), "w") as f:
+            json.dump({"fingerprint": index_fingerprint, "kb_position": kb_position}, f)
+        fingerprint_path = os.path.join(cache_dir, FINGERPRINT_FILE)
+        if os.path.exists(fingerprint_path):
+            os.remove(fingerprint_path)
+        for name in INDEX_FILES + (FINGERPRINT_FILE,):
+            os.replace(os.path.join(tmp_dir, name), os.path.join(cache_dir, name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
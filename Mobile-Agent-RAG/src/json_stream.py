@@ -0,0 +1,69 @@
+"""Bounded-memory reader for files holding one large JSON array, such as the steps.json run logs.
+
+iter_json_array yields the elements of the top-level array one at a time. The file is read in chunks
+and each element is decoded with json.JSONDecoder.raw_decode as soon as it is complete, so memory
+holds one element (plus a chunk) instead of the whole array. A file cut off mid-array (a run killed
+while it was rewriting its log) yields the complete elements before the cut and then stops.
+"""
+
+import json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class TruncatedJSON(ValueError):
+    pass
+
+
+def iter_json_array(path, chunk_size=65536, strict=False):
+    """Yield the elements of the JSON array in `path`. With `strict`, a truncated or malformed file
+    raises TruncatedJSON after its complete elements; otherwise it just ends the iteration."""
+    with open(path, encoding="utf-8") as f:
+        buf, pos = "", 0
+
+        def fill(min_size):
+            # append at least min_size more characters; returns False at the end of the file
+            nonlocal buf, pos
+            buf = buf[pos:]
+            pos = 0
+            data = f.read(max(chunk_size, min_size))
+            buf += data
+            return bool(data)
+
+        def skip(chars):
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in chars:
+                    pos += 1
+                if pos < len(buf) or not fill(0):
+                    return
+
+        skip(_WHITESPACE)
+        if pos >= len(buf) or buf[pos] != "[":
+            if strict:
+                raise TruncatedJSON(f"{path}: not a JSON array")
+            return
+        pos += 1
+        while True:
+            skip(_WHITESPACE + ",")
+            if pos >= len(buf):
+                break  # no closing bracket
+            if buf[pos] == "]":
+                return
+            try:
+                value, end = _decoder.raw_decode(buf, pos)
+                # an element is followed by a separator, even the last one ("]"); without it the
+                # element may be cut off by the chunk boundary, like the number "-500." or "12"
+                if end == len(buf) or buf[end] not in _WHITESPACE + ",]":
+                    raise ValueError
+            except ValueError:
+                # the element continues past the buffer: read more (doubling, so a large element is
+                # re-parsed O(log n) times) and retry
+                if fill(len(buf) - pos):
+                    continue
+                break
+            yield value
+            pos = end
+        if strict:
+            raise TruncatedJSON(f"{path}: truncated JSON array")
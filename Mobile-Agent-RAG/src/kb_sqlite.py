@@ -0,0 +1,160 @@
+"""SQLite storage backend for the Operator knowledge bases.
+
+All apps share one database with a single table of passages:
+
+    passages(id INTEGER PRIMARY KEY AUTOINCREMENT, app, title, text, image)
+
+The database runs in WAL mode, so readers never block the writer. Writers (the Operator server,
+offline backfills) serialize on SQLite's write lock, with a busy timeout instead of failing. Ids are
+allocated by AUTOINCREMENT: they are never reused and only grow, which makes the id column a change
+feed. A retriever remembers the last id it indexed and, on its next use, indexes only the rows after it
+(`changes`). Allocating an id, appending and reading the feed are all B-tree lookups, so their cost does
+not grow with the size of the KB.
+"""
+
+import sqlite3
+import threading
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS passages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    app TEXT NOT NULL,
+    title TEXT NOT NULL,
+    text TEXT NOT NULL,
+    image TEXT
+);
+CREATE INDEX IF NOT EXISTS passages_app_id ON passages (app, id);
+"""
+
+
+def row_passage(row):
+    return {"id": str(row[0]), "title": row[1], "text": row[2]}
+
+
+class SqliteKB:
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()  # one connection per thread
+        self.conn.executescript(SCHEMA)
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit mode; transactions are started explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # durable at each WAL checkpoint, safe against corruption
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction: takes the write lock up front, commits on success and rolls back on error."""
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield Transaction(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def append(self, app, passages):
+        """Append passages ({"title", "text", optional "image"}) in one transaction; return their ids."""
+        with self.transaction() as txn:
+            return txn.insert(app, passages)
+
+    def has_app(self, app):
+        return self.conn.execute("SELECT 1 FROM passages WHERE app = ? LIMIT 1", (app,)).fetchone() is not None
+
+    def count(self, app):
+        return self.conn.execute("SELECT COUNT(*) FROM passages WHERE app = ?", (app,)).fetchone()[0]
+
+    def last_id(self, app=None):
+        if app is None:
+            row = self.conn.execute("SELECT MAX(id) FROM passages").fetchone()
+        else:
+            row = self.conn.execute("SELECT MAX(id) FROM passages WHERE app = ?", (app,)).fetchone()
+        return row[0] or 0
+
+    def changes(self, after_id, app=None, limit=10000):
+        """Rows appended after `after_id` (of one app, or of all apps), oldest first: [(app, passage)]."""
+        if app is None:
+            rows = self.conn.execute(
+                "SELECT id, title, text, app FROM passages WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+            )
+        else:
+            rows = self.conn.execute(
+                "SELECT id, title, text, app FROM passages WHERE app = ? AND id > ? ORDER BY id LIMIT ?",
+                (app, after_id, limit),
+            )
+        return [(row[3], row_passage(row)) for row in rows]
+
+    def passages(self, app):
+        return SqlitePassages(self, app)
+
+
+class Transaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def next_id(self):
+        # the id the next insert gets; stable until then, since the transaction holds the write lock
+        row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'passages'").fetchone()
+        return (row[0] if row else 0) + 1
+
+    def reserve_ids(self, last_id):
+        # make the next inserts get ids above `last_id`, e.g. ids a KB imported from a TSV file already
+        # used for its screenshot files
+        row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'passages'").fetchone()
+        if row is None:  # no row was ever inserted
+            self.conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('passages', ?)", (last_id,))
+        elif row[0] < last_id:
+            self.conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'passages'", (last_id,))
+
+    def insert(self, app, passages):
+        ids = []
+        for p in passages:
+            cursor = self.conn.execute(
+                "INSERT INTO passages (app, title, text, image) VALUES (?, ?, ?, ?)",
+                (app, p["title"], p["text"], p.get("image")),
+            )
+            ids.append(cursor.lastrowid)
+        return ids
+
+
+class SqlitePassages(Mapping):
+    """Read-only mapping passage id -> {"id", "title", "text"} over the rows of one app."""
+
+    def __init__(self, kb, app):
+        self.kb = kb
+        self.app = app
+
+    def __getitem__(self, passage_id):
+        try:
+            passage_id = int(passage_id)
+        except ValueError:
+            raise KeyError(passage_id)
+        row = self.kb.conn.execute(
+            "SELECT id, title, text FROM passages WHERE id = ? AND app = ?", (passage_id, self.app)
+        ).fetchone()
+        if row is None:
+            raise KeyError(passage_id)
+        return row_passage(row)
+
+    def __iter__(self):
+        for (passage_id,) in self.kb.conn.execute("SELECT id FROM passages WHERE app = ? ORDER BY id", (self.app,)):
+            yield str(passage_id)
+
+    def __len__(self):
+        return self.kb.count(self.app)
+
+    def add(self, passages):
+        pass  # appended passages are already in the database
+
+    def memory_footprint(self):
+        return 0
@@ -0,0 +1,71 @@
+"""Dynamic micro-batching of concurrent requests in the retrieval servers.
+
+Requests submitted while a batch is being processed, or within `max_wait_ms` of the first one, are
+grouped into a single call of `process_batch` (up to `max_batch_size` items). The call runs in
+`executor`, so the event loop keeps accepting requests, and the results are fanned back out to
+the waiting callers. The wait adapts to the load: a batch only waits for as many requests as the
+previous batch held, so a lone client is never delayed and a steady set of clients is not held
+back for the full `max_wait_ms`.
+"""
+
+import asyncio
+
+
+class MicroBatcher:
+    def __init__(self, process_batch, max_batch_size=32, max_wait_ms=5.0, executor=None):
+        # process_batch(items) returns one result per item; an exception instance as a result is
+        # raised to the caller of that item only
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self._loop = None
+        self._queue = None
+        self._worker = None
+        self._last_batch_size = 0
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            if len(batch) >= self._last_batch_size:
+                break
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        self._last_batch_size = len(batch)
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch, [item for item, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():  # the caller went away
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
@@ -0,0 +1,56 @@
+"""onnxruntime backend for the Contriever encoder exported by export_onnx.py.
+
+OnnxEncoder is called like the PyTorch model (`model(**tokenizer_batch)`) and returns a torch
+tensor of embeddings, so Retriever.embed_queries and embed_passages use it unchanged. Inputs and
+outputs are bound with IO binding, which avoids the per-call feed/fetch dictionaries of
+session.run, and the session applies all graph optimizations (attention, GELU and LayerNorm fusion).
+"""
+
+import os
+
+import numpy as np
+import onnxruntime as ort
+import torch
+import transformers
+
+ONNX_FILE = "model.onnx"
+OUTPUT_NAME = "embeddings"
+
+
+class OnnxEncoder:
+    def __init__(self, onnx_path, num_threads=0, use_cuda=False):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads and num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        if use_cuda and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = ort.InferenceSession(onnx_path, options, providers=providers)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.dim = self.session.get_outputs()[0].shape[-1]  # only the batch axis is dynamic
+
+    # no-ops so the encoder can be handled like the PyTorch model
+    def eval(self):
+        return self
+
+    def float(self):
+        return self
+
+    def __call__(self, **inputs):
+        binding = self.session.io_binding()
+        for name in self.input_names:
+            value = inputs[name]
+            if isinstance(value, torch.Tensor):
+                value = value.cpu().numpy()
+            binding.bind_cpu_input(name, np.ascontiguousarray(value, dtype=np.int64))
+        binding.bind_output(OUTPUT_NAME)
+        self.session.run_with_iobinding(binding)
+        return torch.from_numpy(binding.copy_outputs_to_cpu()[0])
+
+
+def load_onnx_encoder(onnx_dir, num_threads=0, use_cuda=False):
+    # export_onnx.py saves the tokenizer next to the model
+    tokenizer = transformers.AutoTokenizer.from_pretrained(onnx_dir)
+    model = OnnxEncoder(os.path.join(onnx_dir, ONNX_FILE), num_threads=num_threads, use_cuda=use_cuda)
+    return model, tokenizer
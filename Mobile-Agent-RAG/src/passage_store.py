@@ -0,0 +1,247 @@
+"""Memory-mapped columnar store of a passage file, used by the retrievers instead of load_passages.
+
+load_passages keeps one dict per passage (and the retrievers a second dict over them), so memory and
+startup time grow with the corpus. The store converts the passage file once into a directory of
+flat files that are memory-mapped when opened:
+
+    text.bin     utf-8 id, title and text of every passage, concatenated
+    offsets.bin  int64 field boundaries: passage i spans fields [3i, 3i + 3), length 3 * count + 1
+    id_hashes.npy, id_rows.npy
+                 64-bit hashes of the passage ids, sorted, and the row of each
+    meta.json    count, and size / mtime / tail digest of the passage file it was built from
+
+A lookup binary-searches the id hash and builds the {"id", "title", "text"} dict of that row only,
+so only the pages of the passages returned are read. When the passage file has only been appended
+to since (the usual case for the Operator KBs), opening the store converts just the new lines.
+Passages added at runtime with `add` are kept in memory until the store is reopened.
+"""
+
+import csv
+import hashlib
+import json
+import mmap
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+FORMAT = "passage-store-v1"
+TAIL_BYTES = 4096
+
+
+def default_store_dir(passages_path):
+    stem = os.path.splitext(os.path.basename(passages_path))[0]
+    return os.path.join(os.path.dirname(passages_path), stem + "_store")
+
+
+def id_hash(passage_id):
+    return int.from_bytes(hashlib.blake2b(passage_id.encode(), digest_size=8).digest(), "little")
+
+
+def parse_line(line, jsonl):
+    """Return (id, title, text) of a line of a passage file, or None for header and empty lines."""
+    if jsonl:
+        if not line.strip():
+            return None
+        ex = json.loads(line)
+        return str(ex["id"]), ex.get("title", ""), ex["text"]
+    row = next(csv.reader([line.decode()], delimiter="\t"), None)
+    if not row or row[0] == "id":
+        return None
+    return row[0], row[2], row[1]
+
+
+def tail_digest(path, size):
+    with open(path, "rb") as f:
+        f.seek(max(0, size - TAIL_BYTES))
+        return hashlib.sha256(f.read(size - f.tell())).hexdigest()
+
+
+class PassageStore(Mapping):
+    """Read-only mapping passage id -> {"id", "title", "text"} over a passage file, plus runtime additions."""
+
+    def __init__(self, passages_path, store_dir=None):
+        self.passages_path = passages_path
+        self.store_dir = store_dir or default_store_dir(passages_path)
+        self.added = {}  # passages added with `add` since the store was opened
+        self.added_nbytes = 0
+        self._sync()
+        self._open()
+
+    # mapping interface
+
+    def __getitem__(self, passage_id):
+        if passage_id in self.added:
+            return self.added[passage_id]
+        row = self.row(passage_id)
+        if row is None:
+            raise KeyError(passage_id)
+        return self.passage(row)
+
+    def __contains__(self, passage_id):
+        return passage_id in self.added or self.row(passage_id) is not None
+
+    def __iter__(self):
+        for row in range(self.count):
+            passage_id = self._field(3 * row)
+            if passage_id not in self.added and self.row(passage_id) == row:  # the last row of a repeated id wins
+                yield passage_id
+        yield from self.added
+
+    def __len__(self):
+        return self.distinct + sum(1 for passage_id in self.added if self.row(passage_id) is None)
+
+    # rows
+
+    def row(self, passage_id):
+        """Row of a passage id in the store (the last one if it is repeated), or None."""
+        h = np.uint64(id_hash(passage_id))
+        lo = np.searchsorted(self.id_hashes, h, side="left")
+        hi = np.searchsorted(self.id_hashes, h, side="right")
+        for row in reversed(self.id_rows[lo:hi].tolist()):
+            if self._field(3 * row) == passage_id:
+                return row
+        return None
+
+    def passage(self, row):
+        return {"id": self._field(3 * row), "title": self._field(3 * row + 1), "text": self._field(3 * row + 2)}
+
+    def add(self, passages):
+        for p in passages:
+            self.added[p["id"]] = p
+        self.added_nbytes += sum(len(p["id"]) + len(p["title"]) + len(p["text"]) for p in passages)
+
+    def memory_footprint(self):
+        # the mapped files are page cache that the OS can drop; only the runtime additions and the
+        # id index, which every lookup touches, are counted as resident
+        return self.added_nbytes + self.id_hashes.nbytes + self.id_rows.nbytes
+
+    def _field(self, i):
+        start, end = self.offsets[i:i + 2].tolist()
+        return self.text[start:end].decode()
+
+    def _open(self):
+        with open(os.path.join(self.store_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.count = meta["count"]
+        self.distinct = meta["distinct"]
+        # plain arrays over the mappings (not np.memmap), whose slicing is much cheaper per lookup
+        self.offsets = np.frombuffer(self._map("offsets.bin", 8 * (3 * self.count + 1)), dtype=np.int64)
+        self.text = self._map("text.bin", int(self.offsets[-1]))
+        self.id_hashes = np.asarray(np.load(os.path.join(self.store_dir, "id_hashes.npy"), mmap_mode="r"))
+        self.id_rows = np.asarray(np.load(os.path.join(self.store_dir, "id_rows.npy"), mmap_mode="r"))
+
+    def _map(self, name, nbytes):
+        if nbytes == 0:  # empty files cannot be mapped
+            return b""
+        with open(os.path.join(self.store_dir, name), "rb") as f:
+            mapping = mmap.mmap(f.fileno(), nbytes, access=mmap.ACCESS_READ)
+        if hasattr(mapping, "madvise"):
+            # lookups are random: without this, readahead pulls in far more than the passages returned
+            mapping.madvise(mmap.MADV_RANDOM)
+        return mapping
+
+    # building
+
+    def _read_meta(self):
+        try:
+            with open(os.path.join(self.store_dir, "meta.json")) as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return meta if meta.get("format") == FORMAT else None
+
+    def _sync(self):
+        # bring the store up to date with the passage file: nothing to do, convert the appended lines, or rebuild
+        stat = os.stat(self.passages_path)
+        meta = self._read_meta()
+        if meta is not None and (meta["source_size"], meta["source_mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+            return
+        if (
+            meta is not None
+            and stat.st_size > meta["source_size"]
+            and tail_digest(self.passages_path, meta["source_size"]) == meta["source_tail"]
+        ):
+            self._convert(meta, stat)
+        else:
+            self._convert(None, stat)
+
+    def _convert(self, meta, stat):
+        # With `meta`, the lines appended since are converted and text.bin and offsets.bin are only
+        # appended to, so readers of the old meta keep working on its rows. Otherwise the files are
+        # rebuilt under new names and swapped in, leaving the ones mapped by readers untouched.
+        os.makedirs(self.store_dir, exist_ok=True)
+        meta_path = os.path.join(self.store_dir, "meta.json")
+        text_path = os.path.join(self.store_dir, "text.bin")
+        offsets_path = os.path.join(self.store_dir, "offsets.bin")
+        if meta is None:
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            start, count, offset, offsets = 0, 0, 0, [0]
+            text_out, offsets_out = text_path + ".tmp", offsets_path + ".tmp"
+        else:
+            start, count, offsets = meta["source_size"], meta["count"], []
+            offset = self._text_size(count)
+            text_out, offsets_out = text_path, offsets_path
+
+        hashes = []
+        jsonl = self.passages_path.endswith(".jsonl")
+        with open(self.passages_path, "rb") as fin, open(text_out, "r+b" if meta else "wb") as ftext:
+            ftext.seek(offset)  # past what a conversion that did not finish may have left behind
+            fin.seek(start)
+            end = start
+            for line in iter(fin.readline, b""):
+                if end + len(line) > stat.st_size:  # appended to after the stat; left for the next sync
+                    break
+                end += len(line)
+                fields = parse_line(line, jsonl)
+                if fields is None:
+                    continue
+                hashes.append(id_hash(fields[0]))
+                for field in fields:
+                    data = field.encode()
+                    ftext.write(data)
+                    offset += len(data)
+                    offsets.append(offset)
+            ftext.truncate()
+        with open(offsets_out, "r+b" if meta else "wb") as f:
+            f.seek(8 * (3 * count + 1) if meta else 0)
+            f.write(np.asarray(offsets, dtype=np.int64).tobytes())
+            f.truncate()
+        if meta is None:
+            os.replace(text_out, text_path)
+            os.replace(offsets_out, offsets_path)
+
+        new_rows = np.arange(count, count + len(hashes), dtype=np.int64)
+        new_hashes = np.asarray(hashes, dtype=np.uint64)
+        if meta:
+            new_hashes = np.concatenate([np.load(os.path.join(self.store_dir, "id_hashes.npy")), new_hashes])
+            new_rows = np.concatenate([np.load(os.path.join(self.store_dir, "id_rows.npy")), new_rows])
+        # stable, so the rows of a repeated id stay in file order
+        order = np.argsort(new_hashes, kind="stable")
+        self._save("id_hashes.npy", new_hashes[order])
+        self._save("id_rows.npy", new_rows[order])
+
+        new_meta = {
+            "format": FORMAT,
+            "count": count + len(hashes),
+            "distinct": int(len(np.unique(new_hashes))),
+            "source_size": end,
+            "source_mtime_ns": stat.st_mtime_ns,
+            "source_tail": tail_digest(self.passages_path, end),
+        }
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(new_meta, f)
+        os.replace(tmp_path, meta_path)
+        print(f"Passage store {self.store_dir}: {len(hashes)} passages converted, {new_meta['count']} in total")
+
+    def _text_size(self, count):
+        with open(os.path.join(self.store_dir, "offsets.bin"), "rb") as f:
+            f.seek(8 * 3 * count)
+            return int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+
+    def _save(self, name, array):
+        tmp_path = os.path.join(self.store_dir, name + ".tmp.npy")
+        np.save(tmp_path, array)
+        os.replace(tmp_path, os.path.join(self.store_dir, name))
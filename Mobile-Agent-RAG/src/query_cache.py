@@ -0,0 +1,76 @@
+"""Bounded LRU cache of query embeddings.
+
+Agents send the same queries over and over (the Operator queries "subtask: ..." on every step and
+retry), so the retrievers look embeddings up here before running the encoder. Keys combine the model
+id, the maximum query length and the normalized query text. The cache can be saved to and loaded
+from an .npz file to survive server restarts.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def query_key(model_id, max_length, query):
+    return f"{model_id}\x00{max_length}\x00{query}"
+
+
+class QueryEmbeddingCache:
+    def __init__(self, max_entries=10000, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self._lock:
+            embedding = self.entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, key, embedding):
+        with self._lock:
+            self.entries[key] = np.array(embedding, copy=True)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def save(self, path=None):
+        path = path or self.path
+        with self._lock:
+            keys = list(self.entries)
+            embeddings = np.stack([self.entries[k] for k in keys]) if keys else np.empty((0, 0), dtype=np.float32)
+        # np.savez appends .npz to names without it, so write to a name that already has the suffix
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, keys=np.array(keys, dtype=str), embeddings=embeddings)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        # entries are stored least recently used first, so the LRU order survives a restart
+        with np.load(path) as data:
+            keys, embeddings = data["keys"], data["embeddings"]
+        for key, embedding in zip(keys[-self.max_entries:], embeddings[-self.max_entries:]):
+            self.entries[str(key)] = embedding
+        print(f"Loaded {len(self.entries)} cached query embeddings from {path}")
@@ -0,0 +1,53 @@
+"""Batch appends of the Operator server under the per-app retriever memory budget.
+
+    python -m unittest tests.test_append_batch
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import src.contriever
+import src.data
+import passage_retrieval_operator_server as server
+from benchmarks.operator_retrieve_latency import write_app_kb, standin_embedding_job
+from benchmarks.standin import load_standin_retriever
+
+N_PASSAGES = 20
+
+
+class AppendBatchTest(unittest.TestCase):
+    def test_two_app_batch_with_one_app_budget(self):
+        with tempfile.TemporaryDirectory() as kb_dir, \
+                mock.patch.object(server, "BASE_IMG_DIR", kb_dir), \
+                mock.patch.object(server, "INDEX_CACHE_DIR", os.path.join(kb_dir, "index_cache")), \
+                mock.patch.object(server, "PASSAGE_STORE_DIR", os.path.join(kb_dir, "passage_store")), \
+                mock.patch.object(server, "kb", None), \
+                mock.patch.object(server, "shared_retriever", None), \
+                mock.patch.object(server, "encoder", None), \
+                mock.patch.object(server, "embedding_caches", {}), \
+                mock.patch.object(server, "retriever_cache", server.RetrieverCache(1)), \
+                mock.patch.object(server.args, "kb_layout", "per_app"), \
+                mock.patch.object(server.subprocess, "run", standin_embedding_job), \
+                mock.patch.object(src.contriever, "load_retriever", load_standin_retriever):
+            for app_name in ("A", "B"):
+                write_app_kb(app_name, N_PASSAGES)
+            # loading B for the batch would evict A before its passages are added
+            ids = server.append_passage_records([
+                ("A", "subtask: open the inbox App: A", "Tap at {\"x\": 1, \"y\": 2}", b"png"),
+                ("B", "subtask: open the cart App: B", "Tap at {\"x\": 3, \"y\": 4}", b"png"),
+            ])
+            self.assertEqual(ids, [N_PASSAGES + 1, N_PASSAGES + 1])
+
+            # only the most recently used retriever stays resident; each app has its passages once
+            self.assertEqual(len(server.retriever_cache.retrievers), 1)
+            for app_name in ("A", "B"):
+                passages = src.data.load_passages(server.get_app_paths(app_name)["tsv"])
+                self.assertEqual(len(passages), N_PASSAGES + 1)
+                retriever = server.load_app_kb(app_name)
+                self.assertEqual(retriever.index.index.ntotal, N_PASSAGES + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
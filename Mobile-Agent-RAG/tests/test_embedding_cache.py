@@ -0,0 +1,35 @@
+"""Concurrent writers of one src.embedding_cache directory.
+
+    python -m unittest tests.test_embedding_cache
+"""
+
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.embedding_cache import EmbeddingCache
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+    def test_compact_same_directory_from_two_instances(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            texts = [f"passage {i}" for i in range(6)]
+            embeddings = np.arange(6 * 4, dtype=np.float32).reshape(6, 4)
+            first = EmbeddingCache(cache_dir, "model", 512)
+            for i in range(3):
+                first.put(texts[i:i + 1], embeddings[i:i + 1])
+            # the second writer (e.g. an embedding job) opens the cache with the same segments
+            second = EmbeddingCache(cache_dir, "model", 512)
+            second.put(texts[3:], embeddings[3:])
+
+            first.compact()
+            second.compact()  # its segments from the first writer are gone already
+
+            reopened = EmbeddingCache(cache_dir, "model", 512)
+            self.assertEqual(len(reopened), len(texts))
+            np.testing.assert_array_equal(np.stack(reopened.get(texts)), embeddings)
+
+
+if __name__ == "__main__":
+    unittest.main()